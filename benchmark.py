@@ -0,0 +1,176 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from src.replay_generator import ReplaySpec, generate_fafreplay
+
+BENCHMARK_DIR = "data/benchmarks/"
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _measure(run: Callable[[], None], repeat: int, items: int, size: int = 0,
+             prepare: Callable[[], None] = lambda: None) -> dict:
+    """Times `run` over all items `repeat` times; `prepare` runs before every repetition, outside of the timing"""
+    times = []
+    for _ in range(repeat):
+        prepare()
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    best = min(times)
+    result = {"best_sec": best, "median_sec": statistics.median(times), "items": items,
+              "ms_per_item": best / items * 1000, "items_per_sec": items / best}
+    if size:
+        result["mb_per_sec"] = size / best / 1e6
+    return result
+
+
+def run_benchmarks(spec: ReplaySpec, replays: int, repeat: int, workers: int) -> dict:
+    # Imported here, as storage paths and the database are relative to the working directory set up by the caller
+    from extract_data import extract_all, METADATA_VERSION
+    from src.body_extractors import ReplayEventsExtractor, run_extractors, required_commands
+    from src.faf_replay import extract_scfa, parse_replay, parse_replay_header, _get_parser
+    from src.replay_db import get_engine, ReplayRecord, ExtractionManifestRecord, NotificationRollupRecord
+    from src.storage import ensure_dirs, write_replay, get_replay, open_replay, write_metadata, flush_metadata
+
+    ensure_dirs()
+    replay_ids = [str(100 + i) for i in range(replays)]
+    data = [generate_fafreplay(ReplaySpec(**{**vars(spec), "seed": spec.seed + i}), int(replay_id))
+            for i, replay_id in enumerate(replay_ids)]
+    compressed_size = sum(len(d) for d in data)
+    scfa = [extract_scfa(d)[0] for d in data]
+    scfa_size = sum(len(s) for s in scfa)
+    results = {}
+
+    logging.info("Benchmarking decompression and parsing")
+    results["extract_scfa"] = _measure(lambda: [extract_scfa(d) for d in data], repeat, replays, compressed_size)
+    results["parse_replay"] = _measure(lambda: [parse_replay(d, "1") for d in data], repeat, replays,
+                                       compressed_size)
+    results["parse_replay_header"] = _measure(lambda: [parse_replay_header(d, "1") for d in data], repeat, replays)
+
+    parser = _get_parser(required_commands([ReplayEventsExtractor]), save_commands=True)
+    parsed = []
+    results["fafreplay_parse"] = _measure(lambda: parsed.extend(parser.parse(s) for s in scfa), repeat, replays,
+                                          scfa_size, prepare=parsed.clear)
+    walked = []
+
+    def parse_for_walk():
+        walked[:] = [parser.parse(s) for s in scfa]
+
+    results["body_walk"] = _measure(
+        lambda: [run_extractors(iter(replay["body"]["commands"]), [ReplayEventsExtractor], replay["header"])
+                 for replay in walked], repeat, replays, prepare=parse_for_walk)
+    del parsed[:], walked[:]
+
+    logging.info("Benchmarking storage")
+    results["write_replay"] = _measure(lambda: [write_replay(i, d) for i, d in zip(replay_ids, data)], repeat,
+                                       replays, compressed_size)
+    results["get_replay"] = _measure(lambda: [get_replay(i) for i in replay_ids], repeat, replays, compressed_size)
+
+    def open_all():
+        for replay_id in replay_ids:
+            with open_replay(replay_id) as replay:
+                len(replay)
+
+    results["open_replay"] = _measure(open_all, repeat, replays)
+    metadata = [parse_replay(d, i) for i, d in zip(replay_ids, data)]
+    engine = get_engine()
+
+    def clear_metadata():
+        with Session(engine) as session, session.begin():
+            session.execute(delete(ReplayRecord))
+            session.execute(delete(ExtractionManifestRecord))
+            session.execute(delete(NotificationRollupRecord))
+
+    def write_all_metadata():
+        for replay_id, m in zip(replay_ids, metadata):
+            write_metadata(replay_id, m, METADATA_VERSION)
+        flush_metadata()
+
+    results["write_metadata"] = _measure(write_all_metadata, repeat, replays, prepare=clear_metadata)
+
+    logging.info("Benchmarking end-to-end extraction")
+    results["extract_all"] = _measure(lambda: extract_all(replay_ids), repeat, replays, compressed_size,
+                                      prepare=clear_metadata)
+    if workers > 1:
+        results[f"extract_all_{workers}_workers"] = _measure(lambda: extract_all(replay_ids, workers=workers),
+                                                             repeat, replays, compressed_size, prepare=clear_metadata)
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    for name, result in results["results"].items():
+        if name in baseline["results"]:
+            ratio = result["best_sec"] / baseline["results"][name]["best_sec"]
+            logging.info(f"{name:>30}: {result['ms_per_item']:10.3f} ms/replay, {ratio:.2f}x of baseline")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parsing and storage on generated replays")
+    parser.add_argument("--replays", type=int, help="Number of generated replays", default=20)
+    parser.add_argument("--players", type=int, default=8)
+    parser.add_argument("--minutes", type=float, help="Game length", default=20.0)
+    parser.add_argument("--chat_messages", type=int, default=100)
+    parser.add_argument("--notifications", type=int, default=20)
+    parser.add_argument("--resource_shares", type=int, default=200)
+    parser.add_argument("--commands_per_tick", type=int, help="Skipped commands per player and tick", default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, help="Repetitions of every benchmark; the best is reported", default=3)
+    parser.add_argument("--workers", type=int, help="Also benchmark extraction with this many processes", default=1)
+    parser.add_argument("--output", type=str, help="Result file; by default named by time and git commit",
+                        default=None)
+    parser.add_argument("--compare", type=str, help="Earlier result file to compare with", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+
+    spec = ReplaySpec(players=args.players, minutes=args.minutes, chat_messages=args.chat_messages,
+                      notifications=args.notifications, resource_shares=args.resource_shares,
+                      commands_per_tick=args.commands_per_tick, seed=args.seed)
+    commit = _git_commit()
+    started_at = datetime.now()
+    output = os.path.abspath(args.output or os.path.join(
+        BENCHMARK_DIR, f"{started_at:%Y%m%d_%H%M%S}_{commit or 'unknown'}.json"))
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            # Extraction logs every replay, which would be measured too
+            logging.getLogger().setLevel(logging.WARNING)
+            results = run_benchmarks(spec, args.replays, args.repeat, args.workers)
+        finally:
+            logging.getLogger().setLevel(logging.INFO)
+            os.chdir(cwd)
+
+    report = {"commit": commit, "started_at": started_at.isoformat(), "python": platform.python_version(),
+              "platform": platform.platform(), "spec": vars(spec), "replays": args.replays, "repeat": args.repeat,
+              "results": results}
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Saved results to {output}")
+    if baseline_path:
+        with open(baseline_path) as f:
+            compare(report, json.load(f))
+    else:
+        for name, result in results.items():
+            logging.info(f"{name:>30}: {result['ms_per_item']:10.3f} ms/replay")
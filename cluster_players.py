@@ -0,0 +1,23 @@
+import argparse
+import logging
+
+from src.clustering import cluster_players, CLUSTER_CACHE_DIR
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster players by who they play with")
+    parser.add_argument("--since_ts", type=int, help="Only games launched at or after this timestamp", default=None)
+    parser.add_argument("--until_ts", type=int, help="Only games launched before this timestamp", default=None)
+    parser.add_argument("--opponent_weight", type=float, help="Weight of games played against each other",
+                        default=0.0)
+    parser.add_argument("--cache_dir", type=str, help="Directory of cached clusters", default=CLUSTER_CACHE_DIR)
+    parser.add_argument("--force", action="store_true", help="Recompute even if cached clusters are fresh",
+                        default=False)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    clustering = cluster_players(args.since_ts, args.until_ts, args.opponent_weight, cache_dir=args.cache_dir,
+                                 force=args.force)
+    sizes = clustering.sizes()
+    logging.info(f"{len(clustering.player_ids)} players in {len(sizes)} clusters, "
+                 f"modularity {clustering.modularity:.3f}")
+    for label, size in enumerate(sizes[:10]):
+        logging.info(f"\tcluster {label}: {size} players, e.g. {', '.join(clustering.members(label)[:5])}")
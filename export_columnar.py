@@ -0,0 +1,12 @@
+import argparse
+import logging
+
+from src.columnar import export_columnar, COLUMNAR_DIR
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export extracted replay metadata into memory-mappable columns")
+    parser.add_argument("--path", type=str, help="Output directory", default=COLUMNAR_DIR)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    export_columnar(args.path)
+    logging.info(f"Exported replay metadata to {args.path}")
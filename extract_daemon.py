@@ -0,0 +1,212 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from dataclasses import fields, is_dataclass, asdict
+from glob import glob
+
+# Only the standard library is imported here, so that `request` starts quickly;
+# the daemon imports the parser and storage once, in `ExtractionDaemon.warm_up`.
+
+DEFAULT_SOCKET = "data/extract.sock"
+SPOOL_POLL_SEC = 0.2
+SPOOL_REQUEST_EXTENSION = ".json"
+SPOOL_DONE_DIR = "done"
+
+
+class RequestStatus:
+    extracted = "extracted"
+    cached = "cached"  # extracted from the same replay with current versions, not parsed again
+    invalid = "invalid"
+    missing = "missing"
+
+
+def _to_json(value):
+    """Metadata as plain JSON values; event tables are turned into lists of events"""
+    if is_dataclass(value):
+        return {field.name: _to_json(getattr(value, field.name)) for field in fields(value)}
+    if isinstance(value, dict):
+        return {str(k): _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if hasattr(value, "__iter__") and not isinstance(value, (str, bytes)):
+        return [asdict(v) if is_dataclass(v) else _to_json(v) for v in value]
+    return value
+
+
+class ExtractionDaemon:
+    """
+    Extracts replays on request, keeping the parser, decompressor and storage handles open between requests.
+    A request is a JSON object: `{"replay_ids": [...], "header_only": false, "extractors": [...], "refresh": false,
+    "return_metadata": false}`; only `replay_ids` is required. Results are stored as by `extract_data.py`,
+    and recorded in the extraction manifest. Requests are handled one at a time, as storage has a single writer.
+    """
+
+    def __init__(self, extractors=()):
+        self.extractors = tuple(extractors)
+        self.lock = threading.Lock()
+
+    def warm_up(self):
+        from extract_data import parse_data
+        from src.replay_generator import ReplaySpec, generate_fafreplay
+        from src.storage import ensure_dirs, has_metadata
+
+        ensure_dirs()
+        # Parsing a tiny generated replay creates the parsers and the decompressor; the lookup opens the database
+        replay = generate_fafreplay(ReplaySpec(players=2, minutes=0.1, chat_messages=1, notifications=1,
+                                               resource_shares=1))
+        parse_data(replay, "0", extractors=self.extractors)
+        parse_data(replay, "0", header_only=True)
+        has_metadata("0", 0)
+
+    def handle(self, request: dict) -> dict:
+        from extract_data import ExtractionTask, parse_data, store_parsed, flush_results, metadata_version, stale_task
+        from src.storage import has_replay, get_metadata, open_replay, replay_fingerprint
+
+        started = time.perf_counter()
+        header_only = bool(request.get("header_only", False))
+        extractors = () if header_only else tuple(request.get("extractors", self.extractors))
+        refresh = bool(request.get("refresh", False))
+        return_metadata = bool(request.get("return_metadata", False))
+        version, kind = metadata_version(header_only)
+        results = {}
+        with self.lock:
+            for replay_id in map(str, request["replay_ids"]):
+                if not has_replay(replay_id):
+                    results[replay_id] = {"status": RequestStatus.missing}
+                    continue
+                fingerprint = replay_fingerprint(replay_id)
+                # Replays are parsed again if they changed, or were extracted with other versions
+                # of the metadata or of the requested extractors, as by `find_new_replays`
+                task = (ExtractionTask(replay_id, True, extractors) if refresh
+                        else stale_task(replay_id, fingerprint, header_only, extractors))
+                if task is None:
+                    parsed = get_metadata(replay_id, version, kind) if return_metadata else None
+                    status = RequestStatus.cached
+                else:
+                    with open_replay(replay_id) as data:
+                        parsed = parse_data(data, replay_id, header_only, task.extractors, task.metadata)
+                    store_parsed(task, parsed, header_only, fingerprint)
+                    status = RequestStatus.extracted if parsed is not None else RequestStatus.invalid
+                    if not task.metadata:
+                        # Only extractors were run, which returned their results rather than metadata
+                        parsed = get_metadata(replay_id, version, kind) if return_metadata else None
+                results[replay_id] = {"status": status}
+                if return_metadata and parsed is not None:
+                    results[replay_id]["metadata"] = _to_json(parsed)
+            flush_results()
+        return {"results": results, "elapsed_ms": (time.perf_counter() - started) * 1000}
+
+    def handle_line(self, line: bytes) -> dict:
+        try:
+            return self.handle(json.loads(line))
+        except Exception as e:
+            logging.exception("\tfailed to handle a request")
+            return {"error": f"{type(e).__name__}: {e}"}
+
+    def serve_socket(self, path: str):
+        """Serves requests sent as JSON lines over a Unix socket, answering each with a JSON line"""
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        self.wfile.write(json.dumps(daemon.handle_line(line)).encode() + b"\n")
+                        self.wfile.flush()
+
+        if os.path.exists(path):
+            os.remove(path)
+        with socketserver.UnixStreamServer(path, Handler) as server:
+            logging.info(f"Listening on {path}")
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(path)
+
+    def serve_spool(self, directory: str, stop: threading.Event):
+        """
+        Handles request files (`*.json`) dropped into the directory, oldest first, writing responses to `done/`.
+        Clients should write requests under another name and rename them, so that no partial file is read.
+        """
+        done = os.path.join(directory, SPOOL_DONE_DIR)
+        os.makedirs(done, exist_ok=True)
+        logging.info(f"Watching {directory}")
+        while not stop.is_set():
+            requests = sorted(glob(os.path.join(directory, "*" + SPOOL_REQUEST_EXTENSION)), key=os.path.getmtime)
+            for path in requests:
+                with open(path, "rb") as f:
+                    response = self.handle_line(f.read())
+                response_path = os.path.join(done, os.path.basename(path))
+                with open(response_path + ".tmp", "w") as f:
+                    json.dump(response, f)
+                os.replace(response_path + ".tmp", response_path)
+                os.remove(path)
+            if not requests:
+                stop.wait(SPOOL_POLL_SEC)
+
+
+def send_request(path: str, request: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(json.dumps(request).encode() + b"\n")
+        with client.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep replay extraction warm, and extract replays on request")
+    parser.add_argument("command", choices=["serve", "request"])
+    parser.add_argument("replay_ids", nargs="*", help="Replay IDs to extract (request)")
+    parser.add_argument("--socket", type=str, help="Unix socket path", default=DEFAULT_SOCKET)
+    parser.add_argument("--spool", type=str, help="Also handle request files dropped into this directory (serve)",
+                        default=None)
+    parser.add_argument("--no_socket", action="store_true", help="Handle spooled requests only (serve)",
+                        default=False)
+    parser.add_argument("--extractors", type=str, default=None,
+                        help="Comma-separated body extractors to run; none by default, which extracts metadata only")
+    parser.add_argument("--header_only", action="store_true", help="Parse replay headers only? (request)",
+                        default=False)
+    parser.add_argument("--refresh", action="store_true", help="Extract already extracted replays again? (request)",
+                        default=False)
+    parser.add_argument("--return_metadata", action="store_true", help="Print extracted metadata (request)",
+                        default=False)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    extractors = [name for name in args.extractors.split(",") if name] if args.extractors is not None else None
+
+    if args.command == "request":
+        request = {"replay_ids": args.replay_ids, "header_only": args.header_only, "refresh": args.refresh,
+                   "return_metadata": args.return_metadata}
+        if extractors is not None:
+            request["extractors"] = extractors
+        print(json.dumps(send_request(args.socket, request), indent=2))
+    else:
+        started = time.perf_counter()
+        from src.body_extractors import EXTRACTORS
+        unknown = [name for name in extractors or () if name not in EXTRACTORS]
+        if unknown:
+            parser.error(f"Unknown extractors: {', '.join(unknown)}")
+        daemon = ExtractionDaemon(extractors or ())
+        daemon.warm_up()
+        logging.info(f"Warmed up in {(time.perf_counter() - started) * 1000:.0f} ms")
+        # Extraction logs every replay, which would take longer than extracting small batches
+        logging.getLogger().setLevel(logging.WARNING)
+        # Stopping cleanly on SIGTERM as well, so that pending results are flushed and the socket is removed
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        stop = threading.Event()
+        if args.spool is not None and args.no_socket:
+            daemon.serve_spool(args.spool, stop)
+        else:
+            if args.spool is not None:
+                threading.Thread(target=daemon.serve_spool, args=(args.spool, stop), daemon=True).start()
+            try:
+                daemon.serve_socket(args.socket)
+            finally:
+                stop.set()
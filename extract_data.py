@@ -1,31 +1,80 @@
 from __future__ import annotations
 
-import io
+import argparse
+import functools
+from contextlib import nullcontext
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from json import JSONDecodeError
 import logging
+from dataclasses import dataclass
+from typing import Iterable, Optional, Union, Any
 
-from src.faf_replay import parse_replay
-from src.storage import has_metadata, get_metadata, write_metadata, list_replays, get_replay
+from src.body_extractors import EXTRACTORS
+from src.faf_replay import parse_replay, parse_replay_header, extract_body, ReplayMetadata, ReplayHeader
+from src.metrics import get_metrics, profile_slowest
+from src.replay_db import MetadataKind
+from src.storage import has_metadata, get_metadata, write_metadata, list_replays, open_replay, flush_metadata, \
+    replay_fingerprints, get_extraction_manifest, write_extractor_result, get_extractor_result, \
+    flush_extractor_results
 
-METADATA_VERSION = 1
+METADATA_VERSION = 2
+HEADER_METADATA_VERSION = 2
+WORKER_CHUNK_SIZE = 8
+MANIFEST_FLUSH_EVERY = 1000
 
 
-def extract_data(replay_id: str):
-    logging.info(f"Extracting data from replay {replay_id}")
+@dataclass(frozen=True)
+class ExtractionTask:
+    """Replay to extract: its metadata, and/or results of the listed extractors (see `src/body_extractors.py`)"""
+    replay_id: str
+    metadata: bool = True
+    extractors: tuple[str, ...] = ()
+
+
+def metadata_version(header_only: bool) -> tuple[int, str]:
+    """Current version and kind of the metadata records that extraction writes"""
+    if header_only:
+        return HEADER_METADATA_VERSION, MetadataKind.header
+    return METADATA_VERSION, MetadataKind.full
+
+
+def _extractor_kind(extractor: str) -> str:
+    """Extractor results are tracked in the extraction manifest next to metadata, under their own kind"""
+    return f"extractor:{extractor}"
+
+
+def _parse_replay(replay_id: str, header_only: bool = False, extractors: Iterable[str] = (),
+                  metadata: bool = True) -> Optional[Union[ReplayMetadata, ReplayHeader, dict[str, Any]]]:
+    """
+    Reads and parses a single replay. Safe to run in a worker process, as it does not touch metadata storage.
+    Without `metadata`, only the extractors are run, and their results are returned.
+    """
+    try:
+        with open_replay(replay_id) as data:
+            return parse_data(data, replay_id, header_only, extractors, metadata)
+    except Exception:
+        logging.error("\tSomething went wrong, unexpectedly!")
+        logging.error(traceback.format_exc())
+        return None
 
-    if has_metadata(replay_id, METADATA_VERSION):
-        logging.info(f"\talready parsed replay {replay_id}")
-        return get_metadata(replay_id, METADATA_VERSION)
 
+def parse_data(data, replay_id: str, header_only: bool = False, extractors: Iterable[str] = (),
+               metadata: bool = True) -> Optional[Union[ReplayMetadata, ReplayHeader, dict[str, Any]]]:
+    """Parses replay data (`bytes`, `mmap`, ...) as `_parse_replay` does, returning None if it is not valid"""
+    metrics = get_metrics()
     try:
-        data = get_replay(replay_id)
-        if data is None or len(data) == 0:
+        if len(data) == 0:
             logging.info(f"\tcould not parse data from replay {replay_id}; skipping")
+            metrics.count("empty_replays")
             return None
-        data = io.BytesIO(data)
-        metadata = parse_replay(data, replay_id)
-        write_metadata(replay_id, metadata, METADATA_VERSION)
+        with metrics.stage("replay", key=replay_id):
+            metrics.add_bytes("replay", bytes_in=len(data))
+            if header_only:
+                return parse_replay_header(data, replay_id)
+            if not metadata:
+                return extract_body(data, extractors)
+            return parse_replay(data, replay_id, extractors)
     except JSONDecodeError:
         logging.warning("\tProvided file is not a valid replay file!")
         return None
@@ -37,11 +86,224 @@ def extract_data(replay_id: str):
         logging.error("\tSomething went wrong, unexpectedly!")
         logging.error(traceback.format_exc())
         return None
+
+
+def _store_metadata(replay_id: str, metadata: Union[ReplayMetadata, ReplayHeader], version: int) -> bool:
+    try:
+        write_metadata(replay_id, metadata, version)
+    except Exception:
+        logging.error("\tSomething went wrong, unexpectedly!")
+        logging.error(traceback.format_exc())
+        return False
     logging.info(f"\tdone!")
+    return True
+
+
+def extract_data(replay_id: str, header_only: bool = False):
+    logging.info(f"Extracting data from replay {replay_id}")
+
+    version, kind = metadata_version(header_only)
+    if has_metadata(replay_id, version, kind):
+        logging.info(f"\talready parsed replay {replay_id}")
+        get_metrics().count("metadata_cache_hits")
+        return get_metadata(replay_id, version, kind)
+    get_metrics().count("metadata_cache_misses")
+
+    metadata = _parse_replay(replay_id, header_only)
+    if metadata is None or not _store_metadata(replay_id, metadata, version):
+        return None
     return metadata
 
 
+def _init_worker(log_level: int):
+    logging.basicConfig(encoding='utf-8', level=log_level)
+
+
+def _extract_task(task: ExtractionTask, header_only: bool = False):
+    logging.info(f"Extracting data from replay {task.replay_id}")
+    return _parse_replay(task.replay_id, header_only, task.extractors, task.metadata)
+
+
+def _extract_in_worker(task: ExtractionTask, header_only: bool = False):
+    # Metrics of the worker process are sent along with every result, to be merged by the parent
+    parsed = _extract_task(task, header_only)
+    return parsed, get_metrics().drain()
+
+
+def _merge_worker_metrics(result):
+    parsed, metrics = result
+    get_metrics().merge(metrics)
+    return parsed
+
+
+def _stale_task(replay_id: str, fingerprint: tuple[int, int], entry: Optional[tuple[int, int, int]],
+                extractor_entries: dict[str, Optional[tuple[int, int, int]]],
+                header_only: bool) -> Optional[ExtractionTask]:
+    """
+    Task extracting what is out of date for a replay, given its manifest entries for metadata and for each extractor;
+    None if everything is up to date
+    """
+    version, kind = metadata_version(header_only)
+    stale_metadata = False
+    if entry is None and has_metadata(replay_id, version, kind):
+        # Extracted before the manifest existed
+        get_extraction_manifest().record(replay_id, kind, fingerprint, version)
+    elif entry != (*fingerprint, version):
+        stale_metadata = True
+    stale_extractors = tuple(name for name, extractor_entry in extractor_entries.items()
+                             if extractor_entry != (*fingerprint, EXTRACTORS[name].version))
+    if stale_metadata or stale_extractors:
+        return ExtractionTask(replay_id, stale_metadata, stale_extractors)
+    return None
+
+
+def stale_task(replay_id: str, fingerprint: tuple[int, int], header_only: bool = False,
+               extractors: Iterable[str] = ()) -> Optional[ExtractionTask]:
+    """
+    Checks a single stored replay against the extraction manifest, as `find_new_replays` does for all of them.
+    Returns the task extracting what is out of date, or None if nothing is.
+    """
+    _, kind = metadata_version(header_only)
+    extractors = () if header_only else tuple(extractors)
+    manifest = get_extraction_manifest()
+    return _stale_task(replay_id, fingerprint, manifest.get(replay_id, kind),
+                       {name: manifest.get(replay_id, _extractor_kind(name)) for name in extractors}, header_only)
+
+
+def find_new_replays(header_only: bool = False,
+                     extractors: Iterable[str] = ()) -> tuple[list[ExtractionTask], dict[str, tuple[int, int]]]:
+    """
+    Diffs fingerprints of stored replays against the extraction manifest. Returns tasks for replays that are new,
+    changed since extraction (e.g. re-downloaded with `--refresh`) or extracted with another metadata version,
+    along with fingerprints of all stored replays.
+    Extractors are compared by their own versions, so replays whose metadata is up to date are parsed again
+    only for the extractors that are new or changed.
+    """
+    _, kind = metadata_version(header_only)
+    extractors = () if header_only else tuple(extractors)
+    fingerprints = replay_fingerprints()
+    manifest = get_extraction_manifest()
+    extracted = manifest.load(kind)
+    extracted_by = {name: manifest.load(_extractor_kind(name)) for name in extractors}
+    pending = []
+    for replay_id, fingerprint in fingerprints.items():
+        task = _stale_task(replay_id, fingerprint, extracted.get(replay_id),
+                           {name: extracted_by[name].get(replay_id) for name in extractors}, header_only)
+        if task is not None:
+            pending.append(task)
+    manifest.flush()
+    get_metrics().count("manifest_up_to_date", len(fingerprints) - len(pending))
+    return pending, fingerprints
+
+
+def _store_extracted(replay_id: str, results: dict[str, Any]):
+    for name, data in results.items():
+        write_extractor_result(replay_id, name, EXTRACTORS[name].version, data)
+
+
+def store_parsed(task: ExtractionTask, parsed, header_only: bool = False,
+                 fingerprint: Optional[tuple[int, int]] = None):
+    """
+    Stores what `parse_data` returned for the task. With the `fingerprint` of the stored replay, the replay is recorded
+    in the extraction manifest, so that it is not extracted again until it changes.
+    """
+    version, kind = metadata_version(header_only)
+    manifest = get_extraction_manifest()
+    replay_id = task.replay_id
+    if task.metadata:
+        stored = parsed is not None and _store_metadata(replay_id, parsed, version)
+        extracted = parsed.extracted if stored and isinstance(parsed, ReplayMetadata) else {}
+        if fingerprint is not None and (stored or parsed is None):
+            manifest.record(replay_id, kind, fingerprint, version)
+    else:
+        extracted = parsed or {}
+    _store_extracted(replay_id, extracted)
+    if fingerprint is not None:
+        for name in task.extractors:
+            if parsed is None or name in extracted:
+                manifest.record(replay_id, _extractor_kind(name), fingerprint, EXTRACTORS[name].version)
+
+
+def flush_results():
+    # Metadata goes first, so that the manifest never lists replays whose metadata is not stored
+    flush_metadata()
+    flush_extractor_results()
+    get_extraction_manifest().flush()
+
+
+def extract_all(replay_ids: Iterable[Union[str, ExtractionTask]], workers: int = 1, header_only: bool = False,
+                fingerprints: Optional[dict[str, tuple[int, int]]] = None, extractors: Iterable[str] = ()):
+    """
+    Extracts metadata from all given replays. With `workers > 1` replays are parsed in a process pool,
+    while the parsed metadata is written by this process only, as metadata storage is not safe for concurrent writes.
+    With `header_only`, only replay headers are parsed, and stored as `ReplayHeader` records.
+    Replays given as IDs are extracted with the named `extractors`, in the same pass over the replay body.
+    With `fingerprints` (see `find_new_replays`), all given replays are parsed, and recorded in the extraction manifest;
+    otherwise replays that already have metadata are parsed only for the extractors whose results are missing.
+    """
+    version, kind = metadata_version(header_only)
+    extractors = () if header_only else tuple(extractors)
+    tasks = [task if isinstance(task, ExtractionTask) else ExtractionTask(task, True, extractors)
+             for task in replay_ids]
+    metrics = get_metrics()
+    if fingerprints is None:
+        pending = []
+        for task in tasks:
+            if has_metadata(task.replay_id, version, kind):
+                missing = tuple(name for name in task.extractors
+                                if get_extractor_result(task.replay_id, name, EXTRACTORS[name].version) is None)
+                if not missing:
+                    logging.info(f"\talready parsed replay {task.replay_id}")
+                    metrics.count("metadata_cache_hits")
+                    continue
+                task = ExtractionTask(task.replay_id, False, missing)
+            else:
+                metrics.count("metadata_cache_misses")
+            pending.append(task)
+    else:
+        pending = tasks
+
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               initargs=(logging.getLogger().level,)) if workers > 1 else nullcontext()
+    with pool as executor:
+        if workers > 1:
+            parse = functools.partial(_extract_in_worker, header_only=header_only)
+            results = map(_merge_worker_metrics, executor.map(parse, pending, chunksize=WORKER_CHUNK_SIZE))
+        else:
+            results = map(functools.partial(_extract_task, header_only=header_only), pending)
+        for i, (task, parsed) in enumerate(zip(pending, results)):
+            store_parsed(task, parsed, header_only, fingerprints[task.replay_id] if fingerprints is not None else None)
+            if (i + 1) % MANIFEST_FLUSH_EVERY == 0:
+                flush_results()
+    flush_results()
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract metadata from downloaded replays")
+    parser.add_argument("--workers", type=int, help="Number of parsing processes", default=1)
+    parser.add_argument("--header_only", action="store_true", help="Parse replay headers only?", default=False)
+    parser.add_argument("--extractors", type=str, help=f"Comma-separated body extractors to run, of {', '.join(EXTRACTORS)}; "
+                             f"none by default, which extracts metadata only",
+                        default="")
+    parser.add_argument("--metrics", type=str, help="Write timings and counters to this file (.json or .prom)",
+                        default=None)
+    parser.add_argument("--profile_slowest", type=int, default=0,
+                        help="Profile the N slowest replays again, writing stack samples to data/profiles/")
+    args = parser.parse_args()
     logging.basicConfig(encoding='utf-8', level=logging.DEBUG)
-    for replay_id in list_replays():
-        extract_data(replay_id)
+    extractors = [name for name in args.extractors.split(",") if name]
+    unknown = [name for name in extractors if name not in EXTRACTORS]
+    if unknown:
+        parser.error(f"Unknown extractors: {', '.join(unknown)}")
+    tasks, fingerprints = find_new_replays(args.header_only, extractors)
+    logging.info(f"{len(tasks)} new or changed replays to extract")
+    try:
+        extract_all(tasks, workers=args.workers, header_only=args.header_only, fingerprints=fingerprints)
+    finally:
+        if args.metrics:
+            get_metrics().write_report(args.metrics)
+    if args.profile_slowest:
+        # Profiled after the report is written, so that the profiled runs are not counted in it
+        profiles = profile_slowest(lambda replay_id: _parse_replay(replay_id, args.header_only, extractors),
+                                   args.profile_slowest)
+        logging.info(f"Wrote profiles of the slowest replays: {', '.join(profiles)}")
@@ -1,46 +1,312 @@
 import logging
-from typing import Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Iterator, Iterable
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from sqlalchemy.orm import sessionmaker
 import argparse
 
 from src.replay_db import get_engine, ReplayDownload
-from src.storage import list_replays, write_replay, has_replay, ensure_dirs
+from src.metrics import get_metrics
+from src.probe_index import ProbeStatus
+from src.storage import list_replays, write_replay, has_replay, ensure_dirs, get_probe_index
 
 REPLAY_URL_BASE = "https://replay.faforever.com/"
+REQUEST_TIMEOUT_SEC = 30
+RETRY_COUNT = 5
+RETRY_BACKOFF_SEC = 0.5
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+DEFAULT_RATE_LIMIT = 20.0  # requests per second, per host
+# Follow mode: an ID counts as past the newest replay only if it and the next few IDs are all missing,
+# as replays may be published out of order
+FRONTIER_CONFIRM_IDS = 3
+POLL_MIN_SEC = 5.0
+POLL_MAX_SEC = 300.0
+RETRY_MISSING_WINDOW_IDS = 500  # misses this close to the newest replay are checked again
+RETRY_MISSING_AFTER_SEC = 120.0
 
+_sessions = threading.local()
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
 
-def _load_replay(url: str):
+
+class ReplayFetchError(Exception):
+    """Raised when a replay could not be fetched because of transient errors, even after retries."""
+
+
+class RateLimiter:
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def restrict(self, rate: float):
+        """Lowers the rate to `rate` if that is lower; 0 means unlimited"""
+        with self.lock:
+            self.interval = max(self.interval, 1.0 / rate if rate else 0.0)
+
+
+def _get_rate_limiter(url: str, rate: float) -> RateLimiter:
+    # All requests to a host share one limit; callers asking for different rates get the lowest of them
+    host = urlsplit(url).netloc
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = RateLimiter(rate)
+        limiter = _rate_limiters[host]
+    limiter.restrict(rate)
+    return limiter
+
+
+def _get_session() -> requests.Session:
+    # Sessions are not guaranteed to be thread-safe, so each worker thread keeps its own keep-alive connection
+    session = getattr(_sessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _sessions.session = session
+    return session
+
+
+def load_replay(url: str, rate: float = DEFAULT_RATE_LIMIT) -> Optional[bytes]:
+    session = _get_session()
+    rate_limiter = _get_rate_limiter(url, rate)
+    metrics = get_metrics()
+    for attempt in range(RETRY_COUNT):
+        if attempt:
+            metrics.count("download_retries")
+            time.sleep(RETRY_BACKOFF_SEC * 2 ** (attempt - 1))
+        with metrics.stage("rate_limit_wait"):
+            rate_limiter.wait()
+        try:
+            # Connection errors are counted by the stage
+            with metrics.stage("download"):
+                response = session.get(url, timeout=REQUEST_TIMEOUT_SEC)
+        except requests.exceptions.SSLError:
+            logging.warning("SSL error occurred")
+            continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            logging.warning("Connection error occurred")
+            continue
+        metrics.count(f"http_status_{response.status_code}")
+        if response.status_code == 200:
+            metrics.add_bytes("download", bytes_in=len(response.content))
+            return response.content
+        logging.info(f"\tReceived response {response.status_code}")
+        if response.status_code not in RETRY_STATUS_CODES:
+            return None
+    raise ReplayFetchError(f"Could not fetch {url} after {RETRY_COUNT} attempts")
+
+
+def download_replay(replay_id: int, refresh: bool = False, url_base: str = REPLAY_URL_BASE,
+                    rate: float = DEFAULT_RATE_LIMIT, record_missing: bool = True) -> str:
+    """Downloads the replay; missing replays are stored as empty files if `record_missing` is set"""
+    logging.info(f"Checking replay {replay_id}...")
+    if has_replay(str(replay_id)):
+        if refresh:
+            logging.info(f"\trefreshing replay {replay_id}")
+        else:
+            logging.info(f"\talready downloaded replay {replay_id}")
+            get_metrics().count("already_downloaded")
+            return ProbeStatus.downloaded
+    url = url_base + str(replay_id)
     try:
-        response = requests.get(url)
-    except requests.exceptions.SSLError:
-        logging.warning("SSL error occurred")
-        return None
-    if response.status_code == 200:
-        return response.content
-    logging.info(f"\tReceived response {response.status_code}")
+        data = load_replay(url, rate)
+    except ReplayFetchError as e:
+        # Not marking the replay as missing, so that it is retried on the next run
+        logging.warning(f"\tgiving up on replay {replay_id} for now")
+        get_metrics().error("download", e)
+        return ProbeStatus.failed
+    if data:
+        write_replay(str(replay_id), data)
+        logging.info(f"\tdone!")
+        get_metrics().count("replays_downloaded")
+        return ProbeStatus.downloaded
+    else:
+        if record_missing:
+            write_replay(str(replay_id), b'')
+        logging.info(f"\treplay not found!")
+        get_metrics().count("replays_missing")
+        return ProbeStatus.missing
+
+
+def replays_to_download(from_id: int, to_id: int, refresh: bool,
+                         reprobe_missing_sec: Optional[float]) -> Iterator[tuple[int, bool]]:
+    """
+    Yields (replay ID, refresh) pairs that need to be (re)downloaded, walking ranges of the probe index
+    instead of checking every ID in storage.
+    Misses last checked within `reprobe_missing_sec` are checked again; older ones are taken as never published,
+    so a replay published later than that after its last check is skipped. Each check restarts the window,
+    so runs repeated more often than `reprobe_missing_sec` keep retrying misses (follow mode retries them by ID
+    distance from the newest replay instead).
+    """
+    if refresh:
+        for replay_id in range(from_id, to_id + 1):
+            yield replay_id, True
+        return
+    reprobe_after = time.time() - reprobe_missing_sec if reprobe_missing_sec is not None else None
+    for start, end, status, checked_at in get_probe_index().segments(from_id, to_id):
+        if status is None:
+            # Never probed, or probed before the probe index existed
+            for replay_id in range(start, end + 1):
+                yield replay_id, False
+        elif status == ProbeStatus.failed:
+            for replay_id in range(start, end + 1):
+                yield replay_id, True
+        elif status == ProbeStatus.missing and reprobe_after is not None and checked_at >= reprobe_after:
+            # Replays may be published some time after the game, so recent misses are checked again
+            for replay_id in range(start, end + 1):
+                yield replay_id, True
+
+
+def _download_and_record(replay_id: int, refresh: bool, url_base: str, rate: float,
+                         record_missing: bool = True) -> str:
+    status = download_replay(replay_id, refresh, url_base, rate, record_missing)
+    get_probe_index().mark(replay_id, status)
+    return status
+
+
+def _download_all(replays: Iterable[tuple[int, bool]], concurrency: int, url_base: str, rate: float,
+                  record_missing: bool = True):
+    if concurrency <= 1:
+        for replay_id, refresh_replay in replays:
+            _download_and_record(replay_id, refresh_replay, url_base, rate, record_missing)
+        return
+
+    # Bounding the number of in-flight tasks, so that huge ID ranges do not get queued up in memory at once
+    slots = threading.BoundedSemaphore(concurrency * 2)
+
+    def _task(replay_id, refresh_replay):
+        try:
+            _download_and_record(replay_id, refresh_replay, url_base, rate, record_missing)
+        except Exception:
+            logging.exception(f"\tfailed to download replay {replay_id}")
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for replay_id, refresh_replay in replays:
+            slots.acquire()
+            executor.submit(_task, replay_id, refresh_replay)
+
+
+def download_replays(from_id: int, to_id: int, refresh: bool = False, concurrency: int = 1,
+                     url_base: str = REPLAY_URL_BASE, rate: float = DEFAULT_RATE_LIMIT,
+                     reprobe_missing_sec: Optional[float] = None):
+    ensure_dirs()
+    try:
+        _download_all(replays_to_download(from_id, to_id, refresh, reprobe_missing_sec), concurrency, url_base, rate)
+    finally:
+        get_probe_index().save()
+
+
+def _first_available(from_id: int, count: int, url_base: str, rate: float) -> Optional[int]:
+    """The first of `count` IDs from `from_id` that is available, downloading it; None if they are all missing"""
+    for replay_id in range(from_id, from_id + count):
+        probed = get_probe_index().get(replay_id)
+        if probed is not None and probed[0] in (ProbeStatus.downloaded, ProbeStatus.extracted):
+            return replay_id
+        get_metrics().count("frontier_probes")
+        if _download_and_record(replay_id, False, url_base, rate, record_missing=False) == ProbeStatus.downloaded:
+            return replay_id
     return None
 
 
-def download_replays(from_id: int, to_id: int, refresh: bool = False):
+def find_frontier(known_id: int, url_base: str = REPLAY_URL_BASE, rate: float = DEFAULT_RATE_LIMIT) -> int:
+    """
+    Finds the newest available replay ID from one known to be available (or a lower bound of it),
+    probing exponentially growing steps ahead, then binary searching between the last hit and the first miss.
+    Takes O(log(distance)) requests; replays found on the way are downloaded, so probes are not wasted.
+    """
+    newest, step = known_id, 1
+    while True:
+        found = _first_available(newest + step, FRONTIER_CONFIRM_IDS, url_base, rate)
+        if found is None:
+            break
+        newest, step = found, step * 2
+    beyond = newest + step  # no replays in [beyond, beyond + FRONTIER_CONFIRM_IDS)
+    while beyond - newest > 1:
+        middle = (newest + beyond) // 2
+        found = _first_available(middle, min(FRONTIER_CONFIRM_IDS, beyond - middle), url_base, rate)
+        if found is None:
+            beyond = middle
+        else:
+            newest = found
+    return newest
+
+
+def _follow_replays(from_id: int, to_id: int, frontier: int) -> Iterator[tuple[int, bool]]:
+    """New IDs up to the frontier that were never probed or failed, then recent misses that are due a retry"""
+    for replay_id, refresh in replays_to_download(from_id, to_id, False, None):
+        yield replay_id, refresh
+    retry_before = time.time() - RETRY_MISSING_AFTER_SEC
+    for start, end, status, checked_at in get_probe_index().segments(
+            max(frontier - RETRY_MISSING_WINDOW_IDS, 0), frontier):
+        if status == ProbeStatus.missing and checked_at <= retry_before:
+            get_metrics().count("missing_retries", end - start + 1)
+            for replay_id in range(start, end + 1):
+                yield replay_id, True
+
+
+def follow_replays(from_id: int, concurrency: int = 1, url_base: str = REPLAY_URL_BASE,
+                   rate: float = DEFAULT_RATE_LIMIT, poll_min_sec: float = POLL_MIN_SEC,
+                   poll_max_sec: float = POLL_MAX_SEC, follow_for_sec: Optional[float] = None,
+                   stop: Optional[threading.Event] = None):
+    """
+    Downloads new replays as they are published. Resumes after the newest replay that was downloaded (or extracted
+    by `pipeline.py`), or starts at the current newest replay at or after `from_id` if there is none yet.
+    Polls the newest replay ID, more often while new replays keep coming and less often while there are none,
+    until `follow_for_sec` passed or `stop` is set.
+    Missing replays are not stored as empty files; the probe index records them, and recent ones are checked again.
+    """
     ensure_dirs()
-    for replay_id in range(from_id, to_id + 1):
-        logging.info(f"Checking replay {replay_id}...")
-        if has_replay(str(replay_id)):
-            if refresh:
-                logging.info(f"\trefreshing replay {replay_id}")
-            else:
-                logging.info(f"\talready downloaded replay {replay_id}")
-                continue
-        url = REPLAY_URL_BASE + str(replay_id)
-        data = _load_replay(url)
-        if data:
-            write_replay(str(replay_id), data)
-            logging.info(f"\tdone!")
+    stop = stop if stop is not None else threading.Event()
+    probe_index = get_probe_index()
+    newest_downloaded = max((replay_id for replay_id in map(probe_index.newest, (
+        ProbeStatus.downloaded, ProbeStatus.extracted)) if replay_id is not None), default=None)
+    started = time.monotonic()
+    interval = poll_min_sec
+    try:
+        if newest_downloaded is None:
+            frontier = find_frontier(from_id - 1, url_base, rate)
+            logging.info(f"Following replays from {frontier}")
         else:
-            write_replay(str(replay_id), b'')
-            logging.info(f"\treplay not found!")
+            frontier = newest_downloaded
+            logging.info(f"Following replays after {frontier}")
+        fetched_to = frontier
+        while True:
+            get_metrics().count("follow_polls")
+            frontier = find_frontier(frontier, url_base, rate)
+            if frontier > fetched_to:
+                logging.info(f"Newest replay is {frontier}, {frontier - fetched_to} new IDs")
+                interval = max(poll_min_sec, interval / 2)
+            else:
+                interval = min(poll_max_sec, interval * 2)
+            _download_all(_follow_replays(fetched_to + 1, frontier, frontier), concurrency, url_base, rate,
+                          record_missing=False)
+            fetched_to = frontier
+            probe_index.save()
+            if follow_for_sec is not None and time.monotonic() - started + interval > follow_for_sec:
+                return
+            if stop.wait(interval):
+                return
+    finally:
+        probe_index.save()
 
 
 if __name__ == "__main__":
@@ -48,6 +314,31 @@ if __name__ == "__main__":
     parser.add_argument("--from_id", type=int, help="Starting Replay ID", default=21_700_000)
     parser.add_argument("--to_id", type=int, help="Ending Replay ID (inclusive)", default=21_708_086)
     parser.add_argument("--refresh", action="store_true", help="Refresh existing replays?", default=False)
+    parser.add_argument("--concurrency", type=int, help="Number of parallel downloads", default=1)
+    parser.add_argument("--rate", type=float, help="Max requests per second per host (0 for unlimited)",
+                        default=DEFAULT_RATE_LIMIT)
+    parser.add_argument("--url_base", type=str, help="Replay server URL prefix", default=REPLAY_URL_BASE)
+    parser.add_argument("--reprobe_missing", type=float, default=None,
+                        help="Check again replays last found missing within this many seconds; older misses "
+                             "count as never published and are not retried")
+    parser.add_argument("--follow", action="store_true", default=False,
+                        help="Keep downloading new replays as they are published, from `--from_id` at the earliest")
+    parser.add_argument("--poll_min", type=float, help="Shortest interval between polls (follow)",
+                        default=POLL_MIN_SEC)
+    parser.add_argument("--poll_max", type=float, help="Longest interval between polls (follow)",
+                        default=POLL_MAX_SEC)
+    parser.add_argument("--follow_for", type=float, help="Stop following after this many seconds", default=None)
+    parser.add_argument("--metrics", type=str, help="Write timings and counters to this file (.json or .prom)",
+                        default=None)
     args = parser.parse_args()
     logging.basicConfig(encoding='utf-8', level=logging.INFO)
-    download_replays(args.from_id, args.to_id)
+    try:
+        if args.follow:
+            follow_replays(args.from_id, concurrency=args.concurrency, url_base=args.url_base, rate=args.rate,
+                           poll_min_sec=args.poll_min, poll_max_sec=args.poll_max, follow_for_sec=args.follow_for)
+        else:
+            download_replays(args.from_id, args.to_id, refresh=args.refresh, concurrency=args.concurrency,
+                             url_base=args.url_base, rate=args.rate, reprobe_missing_sec=args.reprobe_missing)
+    finally:
+        if args.metrics:
+            get_metrics().write_report(args.metrics)
@@ -0,0 +1,44 @@
+import argparse
+import logging
+import shelve
+
+from extract_data import METADATA_VERSION
+from src.storage import write_metadata, flush_metadata
+
+LEGACY_METADATA_FILE = "metadata.shelve"
+LEGACY_METADATA_VERSION_SUFFIX = "_version"
+
+
+def migrate_shelve(path: str = LEGACY_METADATA_FILE):
+    """
+    Imports legacy records with the version they were extracted with. Records of another version than
+    `METADATA_VERSION` are imported as they are, but count as outdated and are extracted again by `extract_data.py`.
+    """
+    migrated = 0
+    outdated = 0
+    with shelve.open(path, flag="r") as legacy:
+        for key in legacy.keys():
+            if key.endswith(LEGACY_METADATA_VERSION_SUFFIX):
+                continue
+            version = legacy.get(key + LEGACY_METADATA_VERSION_SUFFIX)
+            if version is None:
+                logging.warning(f"\tno metadata version stored for replay {key}; skipping")
+                continue
+            write_metadata(key, legacy[key], version)
+            migrated += 1
+            outdated += version != METADATA_VERSION
+            if migrated % 1000 == 0:
+                logging.info(f"Migrated {migrated} replays...")
+    flush_metadata()
+    logging.info(f"Migrated {migrated} replays from {path}")
+    if outdated:
+        logging.warning(f"{outdated} replays were extracted with another metadata version than {METADATA_VERSION}; "
+                        f"`extract_data.py` will extract them again")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import metadata from the legacy metadata.shelve into SQLite")
+    parser.add_argument("--shelve", type=str, help="Path to the legacy shelve file", default=LEGACY_METADATA_FILE)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    migrate_shelve(args.shelve)
@@ -0,0 +1,104 @@
+import argparse
+import logging
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable
+
+from src.replay_generator import ReplaySpec, generate_fafreplay
+
+DEFAULT_PORT = 8123
+REPLAY_SPEC = ReplaySpec(players=2, minutes=0.5, chat_messages=2, notifications=4, resource_shares=4)
+
+
+class MockReplayServer:
+    """
+    Stand-in for the replay server, for trying out `mass_download.py --follow` locally.
+    Replays `first_id`, `first_id + 1`, ... are published at `rate` per second from the start; some of them are
+    published `late_sec` later than their turn, and some never are; `backlog` replays are already due at the start.
+    `GET /<ID>` returns a generated replay if it was published, 404 otherwise; the first `failures` requests
+    of every ID are answered with 503, as by an overloaded server.
+    Time is read from `clock`, which tests may replace to publish replays when they want.
+    """
+
+    def __init__(self, first_id: int, rate: float = 1.0, late_fraction: float = 0.1, late_sec: float = 10.0,
+                 missing_fraction: float = 0.05, backlog: int = 0, failures: int = 0, seed: int = 0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.first_id = first_id
+        self.rate = rate
+        self.late_fraction = late_fraction
+        self.late_sec = late_sec
+        self.missing_fraction = missing_fraction
+        self.failures = failures
+        self.seed = seed
+        self.clock = clock
+        self.started = clock() - backlog / rate
+        self.requests = 0
+        self.requests_by_id: dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def published_at(self, replay_id: int):
+        """Seconds from the start when the replay is published, None if it never is"""
+        if replay_id < self.first_id:
+            return None
+        draw = random.Random(replay_id * 1_000_003 + self.seed).random()
+        if draw < self.missing_fraction:
+            return None
+        turn = (replay_id - self.first_id) / self.rate
+        return turn + self.late_sec if draw < self.missing_fraction + self.late_fraction else turn
+
+    def get(self, replay_id: int):
+        """HTTP status and the replay"""
+        with self.lock:
+            self.requests += 1
+            self.requests_by_id[replay_id] = self.requests_by_id.get(replay_id, 0) + 1
+            if self.requests_by_id[replay_id] <= self.failures:
+                return 503, None
+        published_at = self.published_at(replay_id)
+        if published_at is None or published_at > self.clock() - self.started:
+            return 404, None
+        spec = ReplaySpec(**dict(REPLAY_SPEC.__dict__, seed=replay_id))
+        return 200, generate_fafreplay(spec, replay_id)
+
+    def newest(self) -> int:
+        return self.first_id + int((self.clock() - self.started) * self.rate)
+
+    def serve(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT) -> ThreadingHTTPServer:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.strip("/")
+                status, data = mock.get(int(path)) if path.isdigit() else (404, None)
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(data or b"")))
+                self.end_headers()
+                self.wfile.write(data or b"")
+
+            def log_message(self, *args):
+                pass
+
+        return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve generated replays that are published over time")
+    parser.add_argument("--first_id", type=int, help="ID of the first published replay", default=21_700_000)
+    parser.add_argument("--rate", type=float, help="Replays published per second", default=1.0)
+    parser.add_argument("--late_fraction", type=float, help="Share of replays published late", default=0.1)
+    parser.add_argument("--late_sec", type=float, help="Delay of late replays", default=10.0)
+    parser.add_argument("--missing_fraction", type=float, help="Share of IDs never published", default=0.05)
+    parser.add_argument("--backlog", type=int, help="Replays already published at the start", default=1000)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    mock = MockReplayServer(args.first_id, args.rate, args.late_fraction, args.late_sec, args.missing_fraction,
+                            args.backlog)
+    with mock.serve(port=args.port) as server:
+        logging.info(f"Serving on http://127.0.0.1:{args.port}/, try "
+                     f"`mass_download.py --follow --from_id {args.first_id} --url_base http://127.0.0.1:{args.port}/`")
+        try:
+            server.serve_forever()
+        finally:
+            logging.info(f"Answered {mock.requests} requests, newest replay is {mock.newest()}")
@@ -0,0 +1,35 @@
+import argparse
+import logging
+
+from src.notification_rollups import Dimension, ALL_KEY, GAMES, rebuild_rollups
+from src.storage import get_notification_rollups
+
+QUANTILES = (0.1, 0.5, 0.9)
+
+
+def _format_sec(sec) -> str:
+    return f"{sec / 60:.1f} min" if sec is not None else "-"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show completion notification statistics")
+    parser.add_argument("--dimension", type=str, help="Group by", default=Dimension.all,
+                        choices=[Dimension.all, Dimension.player, Dimension.faction, Dimension.map, Dimension.rating])
+    parser.add_argument("--key", type=str, help="Player ID, faction number, map, or the lower bound of a rating bucket",
+                        default=ALL_KEY)
+    parser.add_argument("--top", type=int, help="Show this many most often completed items", default=20)
+    parser.add_argument("--rebuild", action="store_true", default=False,
+                        help="Recompute statistics from all stored metadata first (needed once for metadata "
+                             "extracted before they were kept)")
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    if args.rebuild:
+        logging.info(f"Rolled up {rebuild_rollups()} replays")
+
+    rollups = get_notification_rollups(args.dimension, args.key)
+    games = next((rollup.games for rollup in rollups if rollup.completed == GAMES), 0)
+    logging.info(f"{args.dimension} {args.key!r}: {games} player-games")
+    for rollup in [rollup for rollup in rollups if rollup.completed != GAMES][:args.top]:
+        quantiles = ", ".join(f"p{q * 100:.0f} {_format_sec(rollup.quantile(q))}" for q in QUANTILES)
+        logging.info(f"\t{rollup.completed}: in {rollup.games} games ({rollup.games / games:.1%}), "
+                     f"{rollup.completions} completions, first after {quantiles}")
@@ -0,0 +1,66 @@
+import argparse
+import logging
+import os
+from glob import glob
+from os.path import basename
+
+from src.replay_pack import ReplayPack, compact_pack
+from src.storage import REPLAY_DIR, FAF_REPLAY_EXTENSION, REPLAY_PACK_FILE, REPLAY_PACK_INDEX_FILE, \
+    get_extraction_manifest
+
+FLUSH_EVERY = 10_000
+
+
+def convert_dir(replay_dir: str = REPLAY_DIR, remove: bool = False):
+    """Moves replays stored one file per replay into the pack. Once the pack exists, storage uses it instead."""
+    pack = ReplayPack(REPLAY_PACK_FILE, REPLAY_PACK_INDEX_FILE)
+    paths = glob(replay_dir + "*" + FAF_REPLAY_EXTENSION)
+    moves = []
+    for i, path in enumerate(paths):
+        replay_id = basename(path)[:-len(FAF_REPLAY_EXTENSION)]
+        if not replay_id.isdigit():
+            logging.warning(f"\tskipping {path}: replay ID is not a number")
+            continue
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            pack.write(int(replay_id), f.read())
+        offset, length = pack.locate(int(replay_id))
+        moves.append((replay_id, (stat.st_size, stat.st_mtime_ns), (length, offset)))
+        if (i + 1) % FLUSH_EVERY == 0:
+            pack.flush()
+            # Replays keep their content, so that they are not extracted again
+            get_extraction_manifest().rebase(moves)
+            moves.clear()
+            logging.info(f"Packed {i + 1}/{len(paths)} replays...")
+    pack.close()
+    get_extraction_manifest().rebase(moves)
+    logging.info(f"Packed {len(paths)} replays into {REPLAY_PACK_FILE}")
+    if remove:
+        for path in paths:
+            os.remove(path)
+        logging.info(f"Removed {len(paths)} replay files")
+
+
+def compact():
+    pack = ReplayPack(REPLAY_PACK_FILE, REPLAY_PACK_INDEX_FILE)
+    size_before = os.path.getsize(REPLAY_PACK_FILE)
+    before = {replay_id: (length, offset) for replay_id, offset, length in pack.entries()}
+    pack = compact_pack(pack)
+    get_extraction_manifest().rebase([(str(replay_id), before[replay_id], (length, offset))
+                                      for replay_id, offset, length in pack.entries()])
+    pack.close()
+    logging.info(f"Compacted {REPLAY_PACK_FILE}: {size_before} -> {os.path.getsize(REPLAY_PACK_FILE)} bytes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the packed replay archive")
+    parser.add_argument("command", choices=["convert", "compact"],
+                        help="`convert` packs replay files from the replay directory, "
+                             "`compact` drops outdated copies of refreshed replays from the pack")
+    parser.add_argument("--remove", action="store_true", help="Remove replay files after converting?", default=False)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    if args.command == "convert":
+        convert_dir(remove=args.remove)
+    else:
+        compact()
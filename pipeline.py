@@ -0,0 +1,271 @@
+import argparse
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from typing import Iterable, Optional
+
+from extract_data import ExtractionTask, parse_data, store_parsed, flush_results
+from mass_download import load_replay, replays_to_download, ReplayFetchError, REPLAY_URL_BASE, DEFAULT_RATE_LIMIT
+from src.body_extractors import EXTRACTORS
+from src.metrics import get_metrics
+from src.probe_index import ProbeStatus
+from src.storage import ensure_dirs, get_probe_index, has_replay, write_replay, replay_fingerprint
+
+QUEUE_SIZE = 64  # fetched replays waiting to be parsed, per parsing worker
+FLUSH_EVERY = 256
+FLUSH_INTERVAL_SEC = 5.0  # results are flushed at least this often, so that they become visible while running
+STOP_POLL_SEC = 0.5  # how often blocked stages check whether the pipeline is stopping
+
+_DONE = None
+
+
+def _init_worker(log_level: int):
+    logging.basicConfig(encoding='utf-8', level=log_level)
+
+
+def _parse_in_worker(replay_id: str, data: bytes, extractors: tuple[str, ...]):
+    logging.info(f"Extracting data from replay {replay_id}")
+    return parse_data(data, replay_id, extractors=extractors)
+
+
+def _parse_in_process(replay_id: str, data: bytes, extractors: tuple[str, ...]):
+    # Metrics of the worker process are sent along with every result, to be merged by the parent
+    return _parse_in_worker(replay_id, data, extractors), get_metrics().drain()
+
+
+class Pipeline:
+    """
+    Downloads, parses and stores replays as overlapping stages:
+    fetcher threads -> bounded queue -> parsing workers -> result queue -> storing (in the calling thread).
+    Fetched data goes to the parser directly; it is also written to replay storage only with `archive`.
+    A full queue blocks the stage before it, so memory use stays bounded however fast replays are fetched.
+    If a stage fails, the others stop, and the error is raised from `run`.
+    """
+
+    def __init__(self, concurrency: int = 1, workers: int = 1, archive: bool = False,
+                 extractors: Iterable[str] = (), url_base: str = REPLAY_URL_BASE, rate: float = DEFAULT_RATE_LIMIT):
+        self.concurrency = max(concurrency, 1)
+        self.workers = max(workers, 1)
+        self.archive = archive
+        self.extractors = tuple(extractors)
+        self.url_base = url_base
+        self.rate = rate
+        self.fetched = queue.Queue(maxsize=QUEUE_SIZE * self.workers)
+        self.parsed = queue.Queue()
+        # Replays being parsed or waiting to be stored
+        self.in_flight = threading.BoundedSemaphore(QUEUE_SIZE * self.workers)
+        self.stopping = threading.Event()
+        self.parse_error: Optional[BaseException] = None
+
+    def _put_fetched(self, item) -> bool:
+        """Waits for room in the queue of fetched replays, unless the pipeline is stopping"""
+        while not self.stopping.is_set():
+            try:
+                self.fetched.put(item, timeout=STOP_POLL_SEC)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get_fetched(self):
+        while True:
+            try:
+                return self.fetched.get(timeout=STOP_POLL_SEC)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    return _DONE
+
+    def _acquire_in_flight(self) -> bool:
+        while not self.stopping.is_set():
+            if self.in_flight.acquire(timeout=STOP_POLL_SEC):
+                return True
+        return False
+
+    def _fetch(self, replay_id: int, refresh: bool):
+        if has_replay(str(replay_id)) and not refresh:
+            logging.info(f"\talready downloaded replay {replay_id}")
+            get_metrics().count("already_downloaded")
+            get_probe_index().mark(replay_id, ProbeStatus.downloaded)
+            return
+        try:
+            data = load_replay(self.url_base + str(replay_id), self.rate)
+        except ReplayFetchError as e:
+            logging.warning(f"\tgiving up on replay {replay_id} for now")
+            get_metrics().error("download", e)
+            get_probe_index().mark(replay_id, ProbeStatus.failed)
+            return
+        if not data:
+            logging.info(f"\treplay {replay_id} not found!")
+            get_metrics().count("replays_missing")
+            get_probe_index().mark(replay_id, ProbeStatus.missing)
+            if self.archive:
+                write_replay(str(replay_id), b'')
+                # Recorded in the extraction manifest as unparseable, as `extract_data.py` would do
+                if self._acquire_in_flight():
+                    self.parsed.put((str(replay_id), replay_fingerprint(str(replay_id)), None))
+            return
+        self._put_fetched((str(replay_id), data))
+
+    def _fetch_all(self, replays: Iterable[tuple[int, bool]]):
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+
+        def _task(replay_id, refresh):
+            try:
+                if not self.stopping.is_set():
+                    self._fetch(replay_id, refresh)
+            except Exception:
+                logging.exception(f"\tfailed to download replay {replay_id}")
+            finally:
+                slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for replay_id, refresh in replays:
+                    slots.acquire()
+                    if self.stopping.is_set():
+                        break
+                    executor.submit(_task, replay_id, refresh)
+        finally:
+            self._put_fetched(_DONE)
+
+    def _parse_all(self):
+        if self.workers > 1:
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                           initargs=(logging.getLogger().level,))
+            parse = _parse_in_process
+        else:
+            # Parsing still overlaps with fetching and storing
+            executor = ThreadPoolExecutor(max_workers=1)
+            parse = _parse_in_worker
+        try:
+            with executor:
+                while True:
+                    item = self._get_fetched()
+                    if item is _DONE:
+                        break
+                    replay_id, data = item
+                    if not self._acquire_in_flight():
+                        break
+                    fingerprint = None
+                    if self.archive:
+                        write_replay(replay_id, data)
+                        fingerprint = replay_fingerprint(replay_id)
+                    future = executor.submit(parse, replay_id, data, self.extractors)
+                    future.add_done_callback(
+                        lambda f, replay_id=replay_id, fingerprint=fingerprint:
+                        self.parsed.put((replay_id, fingerprint, f)))
+        except BaseException as e:
+            logging.exception("\tparsing stage failed, stopping the pipeline")
+            self.parse_error = e
+            self.stopping.set()
+        finally:
+            self.parsed.put(_DONE)
+
+    def _store(self, replay_id: str, fingerprint: Optional[tuple[int, int]], future: Optional[Future]) -> bool:
+        """Stores what parsing returned; returns whether metadata was stored"""
+        task = ExtractionTask(replay_id, True, self.extractors)
+        if future is None:
+            store_parsed(task, None, fingerprint=fingerprint)
+            return False
+        try:
+            parsed = future.result()
+            if self.workers > 1:
+                parsed, metrics = parsed
+                get_metrics().merge(metrics)
+        except Exception as e:
+            # Not recorded in the extraction manifest either, as the replay may well be valid
+            logging.exception(f"\tfailed to parse replay {replay_id}")
+            get_metrics().error("parse", e)
+            return False
+        store_parsed(task, parsed, fingerprint=fingerprint)
+        return parsed is not None
+
+    def _flush(self, stored: list[str]):
+        flush_results()
+        # Marked only once their metadata is flushed, so that an interrupted run processes them again.
+        # Without `archive` there is no stored replay, so they are not marked as downloaded
+        status = ProbeStatus.downloaded if self.archive else ProbeStatus.extracted
+        for replay_id in stored:
+            get_probe_index().mark(int(replay_id), status)
+        stored.clear()
+
+    def run(self, replays: Iterable[tuple[int, bool]]):
+        fetcher = threading.Thread(target=self._fetch_all, args=(replays,), daemon=True)
+        parser = threading.Thread(target=self._parse_all, daemon=True)
+        fetcher.start()
+        parser.start()
+        stored = []
+        flushed_at = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self.parsed.get(timeout=FLUSH_INTERVAL_SEC)
+                except queue.Empty:
+                    item = ()  # nothing was parsed for a while
+                if item is _DONE:
+                    break
+                if item:
+                    replay_id, fingerprint, future = item
+                    stored_metadata = self._store(replay_id, fingerprint, future)
+                    self.in_flight.release()
+                    if stored_metadata:
+                        stored.append(replay_id)
+                    elif future is not None:
+                        # Nothing was stored, so the replay is downloaded and parsed again on the next run
+                        get_probe_index().mark(int(replay_id), ProbeStatus.failed)
+                # Flushing in batches, and at least every `FLUSH_INTERVAL_SEC`
+                if len(stored) >= FLUSH_EVERY or time.monotonic() - flushed_at >= FLUSH_INTERVAL_SEC:
+                    self._flush(stored)
+                    flushed_at = time.monotonic()
+        finally:
+            self.stopping.set()
+            self._flush(stored)
+            get_probe_index().save()
+            fetcher.join()
+            parser.join()
+        if self.parse_error is not None:
+            raise self.parse_error
+
+
+def run_pipeline(from_id: int, to_id: int, refresh: bool = False, concurrency: int = 1, workers: int = 1,
+                 archive: bool = False, extractors: Iterable[str] = (), url_base: str = REPLAY_URL_BASE,
+                 rate: float = DEFAULT_RATE_LIMIT, reprobe_missing_sec: Optional[float] = None):
+    ensure_dirs()
+    pipeline = Pipeline(concurrency, workers, archive, extractors, url_base, rate)
+    pipeline.run(replays_to_download(from_id, to_id, refresh, reprobe_missing_sec))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download replays and extract their metadata in one pass")
+    parser.add_argument("--from_id", type=int, help="Starting Replay ID", default=21_700_000)
+    parser.add_argument("--to_id", type=int, help="Ending Replay ID (inclusive)", default=21_708_086)
+    parser.add_argument("--refresh", action="store_true", help="Refresh existing replays?", default=False)
+    parser.add_argument("--concurrency", type=int, help="Number of parallel downloads", default=1)
+    parser.add_argument("--workers", type=int, help="Number of parsing processes", default=1)
+    parser.add_argument("--archive", action="store_true", help="Also store downloaded replays?", default=False)
+    parser.add_argument("--extractors", type=str, help=f"Comma-separated body extractors to run, of {', '.join(EXTRACTORS)}; "
+                             f"none by default, which extracts metadata only",
+                        default="")
+    parser.add_argument("--rate", type=float, help="Max requests per second per host (0 for unlimited)",
+                        default=DEFAULT_RATE_LIMIT)
+    parser.add_argument("--url_base", type=str, help="Replay server URL prefix", default=REPLAY_URL_BASE)
+    parser.add_argument("--reprobe_missing", type=float, default=None,
+                        help="Check again replays last found missing within this many seconds; older misses "
+                             "count as never published and are not retried")
+    parser.add_argument("--metrics", type=str, help="Write timings and counters to this file (.json or .prom)",
+                        default=None)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    extractors = [name for name in args.extractors.split(",") if name]
+    unknown = [name for name in extractors if name not in EXTRACTORS]
+    if unknown:
+        parser.error(f"Unknown extractors: {', '.join(unknown)}")
+    try:
+        run_pipeline(args.from_id, args.to_id, refresh=args.refresh, concurrency=args.concurrency,
+                     workers=args.workers, archive=args.archive, extractors=extractors, url_base=args.url_base,
+                     rate=args.rate, reprobe_missing_sec=args.reprobe_missing)
+    finally:
+        if args.metrics:
+            get_metrics().write_report(args.metrics)
@@ -0,0 +1,139 @@
+import argparse
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+
+from src.faf_replay import extract_scfa, split_fafreplay
+from src.replay_dictionary import train_dictionary, save_dictionary, get_dictionary, latest_dictionary_id, \
+    encode_fafreplay, Compression, DEFAULT_DICTIONARY_SIZE, RECOMPRESSION_LEVEL
+from src.storage import list_replays, get_replay, replace_replay, replay_fingerprint, flush_replays, \
+    get_extraction_manifest, REPLAY_PACK_FILE
+
+SAMPLE_REPLAYS = 1000
+FLUSH_EVERY = 1000
+
+
+@dataclass
+class RecompressionReport:
+    recompressed: int = 0
+    skipped: int = 0
+    failed: int = 0
+    original_bytes: int = 0
+    recompressed_bytes: int = 0
+    decompressed_bytes: int = 0
+    original_decode_sec: float = 0.0
+    recompressed_decode_sec: float = 0.0
+
+    def log(self):
+        logging.info(f"Recompressed {self.recompressed} replays, skipped {self.skipped}, failed {self.failed}")
+        if not self.recompressed:
+            return
+        logging.info(f"\tsize: {self.original_bytes} -> {self.recompressed_bytes} bytes "
+                     f"({self.recompressed_bytes / self.original_bytes:.3f} of the original, "
+                     f"{self.decompressed_bytes / self.recompressed_bytes:.1f}x compression)")
+        mb = self.decompressed_bytes / 1e6
+        logging.info(f"\tdecoding: {mb / self.original_decode_sec:.0f} MB/s originally, "
+                     f"{mb / self.recompressed_decode_sec:.0f} MB/s recompressed")
+
+
+def _decompressed_samples(replay_ids: list[str]):
+    for replay_id in replay_ids:
+        data = get_replay(replay_id)
+        if not data:
+            continue
+        try:
+            yield extract_scfa(data)[0]
+        except Exception:
+            logging.warning(f"\tskipping replay {replay_id}: it cannot be decompressed")
+
+
+def train(samples: int = SAMPLE_REPLAYS, size: int = DEFAULT_DICTIONARY_SIZE, seed: int = 0) -> int:
+    """Trains a dictionary on a random sample of stored replays, returns its ID"""
+    replay_ids = list_replays()
+    sample = random.Random(seed).sample(replay_ids, min(samples, len(replay_ids)))
+    dictionary_id = save_dictionary(train_dictionary(_decompressed_samples(sample), size))
+    logging.info(f"Trained dictionary {dictionary_id} on {len(sample)} replays")
+    return dictionary_id
+
+
+def _flush(moves: list):
+    # Recompressed replays must be durable before the manifest points at them
+    flush_replays()
+    get_extraction_manifest().rebase(moves)
+    moves.clear()
+
+
+def recompress_all(dictionary_id: int, level: int = RECOMPRESSION_LEVEL) -> RecompressionReport:
+    """
+    Re-encodes stored replays with the dictionary, normalizing zlib-compressed ones into the same format.
+    Every replay is checked to decompress to the same data. The extraction manifest is updated to the new fingerprints,
+    as the replay content does not change, so that replays are not extracted again.
+    """
+    dictionary = get_dictionary(dictionary_id)
+    report = RecompressionReport()
+    moves = []
+    for replay_id in list_replays():
+        data = get_replay(replay_id)
+        if not data:
+            continue
+        try:
+            header, body = split_fafreplay(data)
+            body.release()
+            if header.get("compression") == Compression.zstd_dict and header.get("dictionary") == dictionary_id:
+                report.skipped += 1
+                continue
+            started = time.perf_counter()
+            scfa, file_header = extract_scfa(data)
+            original_decode_sec = time.perf_counter() - started
+            encoded = encode_fafreplay(file_header, scfa, dictionary, level)
+            started = time.perf_counter()
+            decoded, _ = extract_scfa(encoded)
+            recompressed_decode_sec = time.perf_counter() - started
+            if decoded != scfa:
+                raise ValueError("recompressed replay does not decompress to the original data")
+        except Exception:
+            logging.exception(f"\tcould not recompress replay {replay_id}")
+            report.failed += 1
+            continue
+        if len(encoded) >= len(data) and header.get("compression") != Compression.zlib:
+            report.skipped += 1
+            continue
+        old_fingerprint = replay_fingerprint(replay_id)
+        replace_replay(replay_id, encoded)
+        moves.append((replay_id, old_fingerprint, replay_fingerprint(replay_id)))
+        report.recompressed += 1
+        report.original_bytes += len(data)
+        report.recompressed_bytes += len(encoded)
+        report.decompressed_bytes += len(scfa)
+        report.original_decode_sec += original_decode_sec
+        report.recompressed_decode_sec += recompressed_decode_sec
+        if len(moves) >= FLUSH_EVERY:
+            _flush(moves)
+            logging.info(f"Recompressed {report.recompressed} replays...")
+    _flush(moves)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompress stored replays with a trained zstd dictionary")
+    parser.add_argument("command", choices=["train", "recompress"],
+                        help="`train` trains a dictionary on a sample of stored replays, "
+                             "`recompress` re-encodes stored replays with it")
+    parser.add_argument("--samples", type=int, help="Replays to train on", default=SAMPLE_REPLAYS)
+    parser.add_argument("--size", type=int, help="Dictionary size in bytes", default=DEFAULT_DICTIONARY_SIZE)
+    parser.add_argument("--dictionary", type=int, help="Dictionary ID to recompress with; the latest by default",
+                        default=None)
+    parser.add_argument("--level", type=int, help="zstd compression level", default=RECOMPRESSION_LEVEL)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    if args.command == "train":
+        train(args.samples, args.size)
+    else:
+        dictionary_id = args.dictionary if args.dictionary is not None else latest_dictionary_id()
+        if dictionary_id is None:
+            parser.error("No dictionary found, train one first")
+        recompress_all(dictionary_id, args.level).log()
+        if os.path.exists(REPLAY_PACK_FILE):
+            logging.info(f"Run `pack_replays.py compact` to drop the original copies from {REPLAY_PACK_FILE}")
@@ -0,0 +1,76 @@
+import argparse
+import logging
+import os
+from typing import Optional
+
+from extract_data import extract_data, flush_results
+from mass_download import download_replay, REPLAY_URL_BASE, DEFAULT_RATE_LIMIT
+from src.metrics import get_metrics
+from src.storage import ensure_dirs, has_replay, REPLAY_PACK_FILE
+from src.work_chunks import ChunkQueue, DEFAULT_CHUNK_SIZE, DEFAULT_LEASE_SEC, get_queue_engine
+
+
+class Jobs:
+    download = "download"
+    extract = "extract"
+
+
+def _download(replay_id: int, url_base: str, rate: float):
+    download_replay(replay_id, url_base=url_base, rate=rate)
+
+
+def _extract(replay_id: int):
+    if has_replay(str(replay_id)):
+        extract_data(str(replay_id))
+
+
+def work(job: str, owner=None, lease_sec: float = DEFAULT_LEASE_SEC, url_base: str = REPLAY_URL_BASE,
+         rate: float = DEFAULT_RATE_LIMIT, queue_db: Optional[str] = None) -> int:
+    """
+    Works on chunks of the job until none are left. Progress is kept in the chunks rather than in the probe index,
+    which is a local file. Replays must be stored as one file per replay, as the replay pack has a single writer.
+    With a queue database shared by several hosts (`queue_db`), replays are stored on the host that downloaded them,
+    so workers of the extract job must share `data/replays/`; each host writes metadata to its own `replays.sqlite3`.
+    """
+    if os.path.exists(REPLAY_PACK_FILE):
+        raise RuntimeError(f"Sharded jobs cannot write to {REPLAY_PACK_FILE}; it supports a single process only")
+    ensure_dirs()
+    chunks = ChunkQueue(job, engine=get_queue_engine(queue_db), owner=owner, lease_sec=lease_sec)
+    if job == Jobs.download:
+        return chunks.work(lambda replay_id: _download(replay_id, url_base, rate))
+    return chunks.work(_extract, before_checkpoint=flush_results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download or extract replays with several cooperating processes")
+    parser.add_argument("command", choices=["plan", "work", "status"])
+    parser.add_argument("--job", choices=[Jobs.download, Jobs.extract], default=Jobs.download)
+    parser.add_argument("--from_id", type=int, help="Starting Replay ID (plan)", default=21_700_000)
+    parser.add_argument("--to_id", type=int, help="Ending Replay ID, inclusive (plan)", default=21_708_086)
+    parser.add_argument("--chunk_size", type=int, help="Replay IDs per chunk (plan)", default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--owner", type=str, help="Worker name (work); host and process ID by default", default=None)
+    parser.add_argument("--lease", type=float, help="Seconds a chunk stays claimed without a checkpoint (work)",
+                        default=DEFAULT_LEASE_SEC)
+    parser.add_argument("--rate", type=float, help="Max requests per second per host (0 for unlimited)",
+                        default=DEFAULT_RATE_LIMIT)
+    parser.add_argument("--url_base", type=str, help="Replay server URL prefix", default=REPLAY_URL_BASE)
+    parser.add_argument("--queue_db", type=str, default=None,
+                        help="Database URL of the chunks, for workers on several hosts (e.g. postgresql://host/db, "
+                             "or sqlite:////mnt/shared/chunks.sqlite3 on storage with file locks); "
+                             "replays.sqlite3 by default")
+    parser.add_argument("--metrics", type=str, help="Write timings and counters to this file (.json or .prom; work)",
+                        default=None)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    if args.command == "plan":
+        added = ChunkQueue(args.job, get_queue_engine(args.queue_db)).plan(args.from_id, args.to_id, args.chunk_size)
+        logging.info(f"Added {added} chunks to the {args.job} job")
+    elif args.command == "work":
+        try:
+            completed = work(args.job, args.owner, args.lease, args.url_base, args.rate, args.queue_db)
+            logging.info(f"Completed {completed} chunks, no chunks left")
+        finally:
+            if args.metrics:
+                get_metrics().write_report(args.metrics)
+    else:
+        logging.info(f"{args.job} chunks: {ChunkQueue(args.job, get_queue_engine(args.queue_db)).status()}")
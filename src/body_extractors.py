@@ -0,0 +1,175 @@
+from typing import Any, Callable, Iterable
+
+from fafreplay import commands
+
+from src.replay_events import NameTable, ChatMessages, CompletionNotifications, ResourceTransfers, TICKS_PER_SEC
+
+MSG_TICK_TIMEOUT = 20  # for deduplication
+MSG_DONE_SUFFIX = "done!"
+MSG_DONE_SUFFIX2 = "construction done!"
+
+
+class MessageTypes:
+    all = "all"
+    allies = "allies"
+    auto_notify = "notify"
+
+
+class ExtractionContext:
+    """State of the pass over replay commands, shared by all extractors"""
+    __slots__ = ("header", "tick", "command_source")
+
+    def __init__(self, header: dict):
+        self.header = header
+        self.tick = 0
+        self.command_source = None
+
+
+class BodyExtractor:
+    """
+    Collects data from replay body commands. Subclasses list the command types they consume in `commands`
+    and handle them in `on_<command name>` methods (e.g. `on_LuaSimCallback`). Commands kept in the context
+    (`Advance`, `SetCommandSource`) only need to be listed.
+    An instance is created per replay; `result` is called once all commands were dispatched.
+    `version` must be increased whenever the result changes, so that only this extractor is re-run.
+    """
+    name: str
+    version: int = 1
+    commands: tuple[int, ...] = ()
+
+    def __init__(self, context: ExtractionContext):
+        self.context = context
+
+    def handlers(self) -> dict[str, Callable[[dict], None]]:
+        names = (commands.NAMES[command] for command in self.commands)
+        return {name: getattr(self, f"on_{name}") for name in names if hasattr(self, f"on_{name}")}
+
+    def result(self) -> Any:
+        raise NotImplementedError
+
+
+EXTRACTORS: dict[str, type[BodyExtractor]] = {}
+
+
+def register_extractor(cls: type[BodyExtractor]) -> type[BodyExtractor]:
+    """Makes the extractor available to `extract_data.py`; results of registered extractors are stored as JSON"""
+    EXTRACTORS[cls.name] = cls
+    return cls
+
+
+def required_commands(extractors: Iterable[type[BodyExtractor]]) -> list[int]:
+    """Command types the parser has to decode for the extractors; `Advance` is always needed to keep time"""
+    required = {commands.Advance}
+    for extractor in extractors:
+        required.update(extractor.commands)
+    return sorted(required)
+
+
+def run_extractors(replay_commands: Iterable[dict], extractors: Iterable[type[BodyExtractor]],
+                   header: dict) -> tuple[dict[str, Any], int]:
+    """
+    Dispatches every command to the extractors that consume it, in a single pass.
+    Returns results by extractor name, and the number of the last tick.
+    """
+    context = ExtractionContext(header)
+    instances = [extractor(context) for extractor in extractors]
+
+    def advance(cmd):
+        context.tick += cmd["ticks"]
+
+    def set_command_source(cmd):
+        context.command_source = cmd["id"]
+
+    dispatch: dict[str, list[Callable[[dict], None]]] = {"Advance": [advance], "SetCommandSource": [set_command_source]}
+    for instance in instances:
+        for command_name, handler in instance.handlers().items():
+            dispatch.setdefault(command_name, []).append(handler)
+    for cmd in replay_commands:
+        for handler in dispatch.get(cmd["name"], ()):
+            handler(cmd)
+    return {instance.name: instance.result() for instance in instances}, context.tick
+
+
+class ReplayEventsExtractor(BodyExtractor):
+    """Chat messages, completion notifications and resource transfers; part of `ReplayMetadata`"""
+    name = "events"
+    commands = (commands.LuaSimCallback,)
+
+    def __init__(self, context: ExtractionContext):
+        super().__init__(context)
+        self.first_message_sent_at = {}
+        names = NameTable()
+        self.chat_messages = ChatMessages(names)
+        self.notifications = CompletionNotifications(names)
+        self.resource_transfer = ResourceTransfers(names)
+
+    def on_LuaSimCallback(self, cmd: dict):
+        if cmd.get("func") != "GiveResourcesToPlayer":
+            return
+        current_tick = self.context.tick
+        args = cmd.get("args", {})
+        mass, energy = args.get("Mass", 0.0), args.get("Energy", 0.0)
+        message = args.get("Msg", {}).get("text", b'').decode()
+        is_chat = args.get("Msg", {}).get("Chat", None)
+        player = args.get("Sender", b'').decode()
+        message_type = args.get("Msg", {}).get("to", b'').decode()
+        target_player = args.get("To")
+
+        # Skipping duplicates
+        msg_fingerprint = player + str(message)
+        if (msg_fingerprint not in self.first_message_sent_at or
+                self.first_message_sent_at[msg_fingerprint] - current_tick > MSG_TICK_TIMEOUT):
+            self.first_message_sent_at[msg_fingerprint] = current_tick
+        else:
+            return
+        if is_chat:
+            if message_type == MessageTypes.auto_notify:
+                # Handling only completion notifications
+                # (such as commander and factory upgrades, experimental and arty completion)
+                if MSG_DONE_SUFFIX in message:
+                    if MSG_DONE_SUFFIX2 in message:
+                        completed = message[:message.find(MSG_DONE_SUFFIX2)]
+                    else:
+                        completed = message[:message.find(MSG_DONE_SUFFIX)]
+                    completed = completed.strip()
+                    self.notifications.append(
+                        player=player,
+                        completed=completed,
+                        tick=current_tick)
+            else:
+                self.chat_messages.append(
+                    ally_only=message_type == MessageTypes.allies,
+                    player=player,
+                    message=message,
+                    tick=current_tick)
+        else:
+            self.resource_transfer.append(
+                from_player=player, to_player=target_player,
+                mass=mass, energy=energy,
+                tick=current_tick)
+
+    def result(self) -> tuple[ChatMessages, CompletionNotifications, ResourceTransfers]:
+        return self.chat_messages, self.notifications, self.resource_transfer
+
+
+@register_extractor
+class ApmExtractor(BodyExtractor):
+    """Issued unit and factory commands per command source, in total and per minute of the game"""
+    name = "apm"
+    commands = (commands.SetCommandSource, commands.IssueCommand, commands.IssueFactoryCommand)
+
+    def __init__(self, context: ExtractionContext):
+        super().__init__(context)
+        self.counts: dict[int, int] = {}
+
+    def _count(self, cmd: dict):
+        source = self.context.command_source
+        self.counts[source] = self.counts.get(source, 0) + 1
+
+    on_IssueCommand = _count
+    on_IssueFactoryCommand = _count
+
+    def result(self) -> dict[str, dict[str, float]]:
+        minutes = self.context.tick / TICKS_PER_SEC / 60
+        return {str(source): {"commands": count, "apm": count / minutes if minutes else 0.0}
+                for source, count in self.counts.items()}
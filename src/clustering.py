@@ -0,0 +1,155 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select, func
+
+from src.coplay_graph import CoPlayGraph, Relation
+from src.replay_db import get_engine, ReplayRecord, preferred_records, launched_within
+
+CLUSTER_CACHE_DIR = "data/clusters/"
+CHUNK_EDGES = 2_000_000  # edges processed at once by label propagation, bounds its memory use
+MAX_ITERATIONS = 50
+CONVERGED_FRACTION = 0.001  # stop when fewer than this fraction of players change their cluster
+RECOMPUTE_CHANGE = 0.05  # cached clusters are recomputed once the number of games changes by this fraction
+
+
+@dataclass
+class Clustering:
+    player_ids: np.ndarray
+    labels: np.ndarray  # cluster of every player; clusters are numbered by decreasing size
+    games: int  # number of games the clustering was computed on
+    modularity: float
+
+    def cluster_of(self, player_id: str) -> Optional[int]:
+        positions = np.nonzero(self.player_ids == player_id)[0]
+        return int(self.labels[positions[0]]) if len(positions) else None
+
+    def members(self, label: int) -> np.ndarray:
+        return self.player_ids[self.labels == label]
+
+    def sizes(self) -> np.ndarray:
+        return np.bincount(self.labels)
+
+
+def coplay_weights(graph: CoPlayGraph, opponent_weight: float = 0.0) -> sparse.csr_matrix:
+    """Symmetric weights of the graph, as the number of games played together (opponent games count partially)"""
+    graph.consolidate()
+    weights = graph.matrices[Relation.ally, "games"]
+    if opponent_weight:
+        weights = weights + opponent_weight * graph.matrices[Relation.opponent, "games"]
+    return weights.tocsr()
+
+
+def label_propagation(weights: sparse.csr_matrix, seed: int = 0, max_iterations: int = MAX_ITERATIONS) -> np.ndarray:
+    """
+    Assigns every node the cluster that has the largest total weight among its neighbours, until labels settle.
+    Half of the nodes are updated per iteration, which prevents labels from oscillating between two neighbours.
+    Edges are processed in chunks of rows, so memory use does not grow with the number of edges.
+    """
+    n = weights.shape[0]
+    labels = np.arange(n, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    degrees = np.diff(weights.indptr)
+    # Row blocks with roughly CHUNK_EDGES edges each
+    block_ends = np.searchsorted(weights.indptr, np.arange(CHUNK_EDGES, weights.nnz + CHUNK_EDGES, CHUNK_EDGES))
+    block_ends = np.unique(np.clip(block_ends, 1, n)) if n else block_ends[:0]
+
+    for iteration in range(max_iterations):
+        new_labels = labels.copy()
+        block_start = 0
+        for block_end in block_ends:
+            start, end = weights.indptr[block_start], weights.indptr[block_end]
+            if start == end:
+                block_start = block_end
+                continue
+            rows = np.repeat(np.arange(block_start, block_end), degrees[block_start:block_end])
+            neighbour_labels = labels[weights.indices[start:end]]
+            keys, inverse = np.unique((rows - block_start) * n + neighbour_labels, return_inverse=True)
+            scores = np.bincount(inverse, weights=weights.data[start:end])
+            key_rows = keys // n + block_start
+            key_labels = keys % n
+            # Ties are resolved in favour of the current label
+            scores += 1e-9 * (key_labels == labels[key_rows])
+            order = np.lexsort((-scores, key_rows))
+            best = order[np.r_[True, key_rows[order][1:] != key_rows[order][:-1]]]
+            new_labels[key_rows[best]] = key_labels[best]
+            block_start = block_end
+        update = rng.random(n) < 0.5
+        changed = update & (new_labels != labels)
+        labels[changed] = new_labels[changed]
+        logging.debug(f"Label propagation iteration {iteration}: {changed.sum()} changed")
+        if changed.sum() <= CONVERGED_FRACTION * n:
+            break
+
+    # Numbering clusters by decreasing size
+    unique, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    rank = np.empty(len(unique), dtype=np.int64)
+    rank[np.argsort(-counts, kind="stable")] = np.arange(len(unique))
+    return rank[inverse]
+
+
+def modularity(weights: sparse.csr_matrix, labels: np.ndarray) -> float:
+    total = weights.sum()
+    if not total:
+        return 0.0
+    coo = weights.tocoo()
+    within = coo.data[labels[coo.row] == labels[coo.col]].sum()
+    cluster_degrees = np.bincount(labels, weights=np.asarray(weights.sum(axis=1)).ravel())
+    return float(within / total - ((cluster_degrees / total) ** 2).sum())
+
+
+def _count_games(engine, since_ts: Optional[int], until_ts: Optional[int]) -> int:
+    with engine.connect() as connection:
+        return connection.scalar(select(func.count()).select_from(ReplayRecord)
+                                 .where(preferred_records(), *launched_within(since_ts, until_ts)))
+
+
+def _cache_path(cache_dir: str, since_ts: Optional[int], until_ts: Optional[int], opponent_weight: float) -> str:
+    since = "start" if since_ts is None else since_ts
+    until = "end" if until_ts is None else until_ts
+    return os.path.join(cache_dir, f"{since}_{until}_{opponent_weight:g}.npz")
+
+
+def _load_cached(path: str) -> Optional[Clustering]:
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as arrays:
+        return Clustering(player_ids=arrays["player_ids"], labels=arrays["labels"], games=int(arrays["games"]),
+                          modularity=float(arrays["modularity"]))
+
+
+def _save_cached(path: str, clustering: Clustering):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, player_ids=clustering.player_ids, labels=clustering.labels, games=clustering.games,
+                 modularity=clustering.modularity)
+    os.replace(tmp_path, path)
+
+
+def cluster_players(since_ts: Optional[int] = None, until_ts: Optional[int] = None, opponent_weight: float = 0.0,
+                    engine=None, cache_dir: str = CLUSTER_CACHE_DIR, force: bool = False) -> Clustering:
+    """
+    Clusters players of games launched within [since_ts, until_ts) by who they play with.
+    Cached results are reused until the number of games in the window changes by more than RECOMPUTE_CHANGE.
+    """
+    engine = engine if engine is not None else get_engine()
+    path = _cache_path(cache_dir, since_ts, until_ts, opponent_weight)
+    games = _count_games(engine, since_ts, until_ts)
+    cached = None if force else _load_cached(path)
+    if cached is not None and abs(games - cached.games) <= RECOMPUTE_CHANGE * cached.games:
+        logging.info(f"Using cached clusters computed on {cached.games} games")
+        return cached
+
+    graph = CoPlayGraph()
+    graph.update_from_db(engine, since_ts, until_ts)
+    weights = coplay_weights(graph, opponent_weight)
+    labels = label_propagation(weights)
+    clustering = Clustering(player_ids=np.array(graph.player_ids, dtype=str), labels=labels, games=games,
+                            modularity=modularity(weights, labels))
+    _save_cached(path, clustering)
+    return clustering
@@ -0,0 +1,204 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import numpy as np
+from sqlalchemy import select, func, and_
+
+from src.replay_db import get_engine, ReplayRecord, ReplayPlayerRecord, ChatMessageRecord, NotificationRecord, \
+    ResourceTransferRecord, MetadataKind, preferred_records
+
+COLUMNAR_DIR = "data/columnar/"
+EXPORT_CHUNK_SIZE = 50_000
+DICTIONARIES_FILE = "dictionaries.json"
+
+
+class Dictionary:
+    """Maps strings to dense integer codes"""
+
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def encode(self, value) -> int:
+        value = "" if value is None else value
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+@dataclass
+class ColumnarTables:
+    """
+    Replay metadata as flat column arrays, loaded memory-mapped. Tables are `replays`, `players` (player-in-game rows),
+    `chat`, `notifications` and `resource_transfer`; rows of the latter four refer to `replays` rows by `replay_idx`.
+    `replays.record_id` is the database key of the exported record, which changes whenever metadata is written again.
+    Dictionary-encoded columns hold codes into `dictionaries` (e.g. nicknames are codes into `dictionaries["player"]`).
+    """
+    tables: dict[str, dict[str, np.ndarray]]
+    dictionaries: dict[str, list[str]]
+
+    def decode(self, dictionary: str, codes: np.ndarray) -> np.ndarray:
+        return np.asarray(self.dictionaries[dictionary], dtype=object)[codes]
+
+    def chat_message(self, row: int) -> str:
+        chat = self.tables["chat"]
+        start, end = chat["message_offsets"][row], chat["message_offsets"][row + 1]
+        return bytes(chat["message_data"][start:end]).decode()
+
+
+def _to_int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+def _export_table(connection, path: str, statement, columns: list[tuple[str, type, Callable]]):
+    """
+    Streams rows of `statement` into one `.npy` file per column.
+    `columns` are (name, dtype, converter) for every selected column, in the same order.
+    """
+    count = connection.scalar(select(func.count()).select_from(statement.subquery()))
+    arrays = [np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode="w+", dtype=dtype, shape=(count,))
+              for name, dtype, _ in columns]
+    position = 0
+    result = connection.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_SIZE).execute(statement)
+    for rows in result.partitions():
+        end = position + len(rows)
+        for i, (_, _, convert) in enumerate(columns):
+            arrays[i][position:end] = [convert(row[i]) for row in rows]
+        position = end
+    for array in arrays:
+        array.flush()
+    return count
+
+
+def _export_strings(connection, path: str, name: str, statement, count: int):
+    """Stores a string column as concatenated UTF-8 data with an offsets array (`count + 1` entries)"""
+    offsets = np.lib.format.open_memmap(os.path.join(path, f"{name}_offsets.npy"), mode="w+", dtype=np.int64,
+                                        shape=(count + 1,))
+    offsets[0] = 0
+    position, row = 0, 0
+    data_path = os.path.join(path, f"{name}_data.bin")
+    with open(data_path, "wb") as f:
+        result = connection.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_SIZE).execute(statement)
+        for rows in result.partitions():
+            encoded = [(value or "").encode() for value, in rows]
+            f.write(b"".join(encoded))
+            lengths = np.fromiter((len(e) for e in encoded), dtype=np.int64, count=len(encoded))
+            offsets[row + 1:row + 1 + len(encoded)] = position + np.cumsum(lengths)
+            position += int(lengths.sum())
+            row += len(encoded)
+    offsets.flush()
+
+
+def export_columnar(path: str = COLUMNAR_DIR, engine=None, since_record_id: Optional[int] = None):
+    """
+    Exports replay metadata from the metadata store into columnar tables under `path`: all of it, or only records
+    written after the record `since_record_id` (new replays, and replays whose metadata was written again).
+    """
+    engine = engine if engine is not None else get_engine()
+    dictionaries = {name: Dictionary() for name in ("player", "clan", "country", "map", "game_type", "completed")}
+    player, clan, country = dictionaries["player"], dictionaries["clan"], dictionaries["country"]
+    selected = preferred_records()
+    if since_record_id is not None:
+        selected = and_(selected, ReplayRecord.id > since_record_id)
+
+    with engine.connect() as connection:
+        if connection.dialect.name == "sqlite":
+            # pysqlite reads outside of transactions, so every statement would see the database as it is then.
+            # Within one read transaction, row counts, replays and the rows referring to them come from one snapshot,
+            # even while metadata is being written.
+            connection.exec_driver_sql("BEGIN")
+        replay_table = os.path.join(path, "replays")
+        os.makedirs(replay_table, exist_ok=True)
+        _export_table(connection, replay_table, select(
+            ReplayRecord.id, ReplayRecord.replay_id, ReplayRecord.launched_at_ts, ReplayRecord.duration,
+            ReplayRecord.map, ReplayRecord.game_type, ReplayRecord.desync, ReplayRecord.kind,
+        ).where(selected).order_by(ReplayRecord.id), [
+            ("record_id", np.int64, int),
+            ("replay_id", np.int64, _to_int),
+            ("launched_at_ts", np.int64, _to_int),
+            ("duration", np.float32, lambda v: np.nan if v is None else v),
+            ("map", np.int32, dictionaries["map"].encode),
+            ("game_type", np.int32, dictionaries["game_type"].encode),
+            ("desync", np.bool_, bool),
+            ("has_body", np.bool_, lambda kind: kind == MetadataKind.full),
+        ])
+        replay_pks = np.load(os.path.join(replay_table, "record_id.npy"))
+
+        child_tables = {
+            "players": (ReplayPlayerRecord, [
+                (ReplayPlayerRecord.player_id, "player_id", np.int64, _to_int),
+                (ReplayPlayerRecord.nickname, "nickname", np.int32, player.encode),
+                (ReplayPlayerRecord.clan, "clan", np.int32, clan.encode),
+                (ReplayPlayerRecord.country, "country", np.int32, country.encode),
+                (ReplayPlayerRecord.faction, "faction", np.int8, int),
+                (ReplayPlayerRecord.team, "team", np.int8, int),
+                (ReplayPlayerRecord.army, "army", np.int16, _to_int),
+                (ReplayPlayerRecord.rating, "rating", np.float32, float),
+                (ReplayPlayerRecord.rating_mean, "rating_mean", np.float32, float),
+                (ReplayPlayerRecord.rating_std, "rating_std", np.float32, float),
+            ]),
+            "chat": (ChatMessageRecord, [
+                (ChatMessageRecord.player, "player", np.int32, player.encode),
+                (ChatMessageRecord.ally_only, "ally_only", np.bool_, bool),
+                (ChatMessageRecord.sent_at_sec, "sent_at_sec", np.float32, float),
+            ]),
+            "notifications": (NotificationRecord, [
+                (NotificationRecord.player, "player", np.int32, player.encode),
+                (NotificationRecord.completed, "completed", np.int32, dictionaries["completed"].encode),
+                (NotificationRecord.sent_at_sec, "sent_at_sec", np.float32, float),
+            ]),
+            "resource_transfer": (ResourceTransferRecord, [
+                (ResourceTransferRecord.from_player, "from_player", np.int32, player.encode),
+                (ResourceTransferRecord.to_player, "to_player", np.int16, _to_int),
+                (ResourceTransferRecord.mass, "mass", np.float32, float),
+                (ResourceTransferRecord.energy, "energy", np.float32, float),
+                (ResourceTransferRecord.sent_at_sec, "sent_at_sec", np.float32, float),
+            ]),
+        }
+        for name, (record, columns) in child_tables.items():
+            table_path = os.path.join(path, name)
+            os.makedirs(table_path, exist_ok=True)
+            rows_of_selected = (select(record.replay_pk, *(column for column, _, _, _ in columns))
+                                .join(ReplayRecord, ReplayRecord.id == record.replay_pk)
+                                .where(selected).order_by(record.replay_pk, record.id))
+            count = _export_table(connection, table_path, rows_of_selected, [("replay_pk", np.int64, int)] + [
+                (name, dtype, convert) for _, name, dtype, convert in columns])
+            # Replacing database keys with row numbers of the replays table
+            replay_pk = np.load(os.path.join(table_path, "replay_pk.npy"))
+            np.save(os.path.join(table_path, "replay_idx.npy"), np.searchsorted(replay_pks, replay_pk).astype(np.int32))
+            os.remove(os.path.join(table_path, "replay_pk.npy"))
+            if name == "chat":
+                _export_strings(connection, table_path, "message", select(ChatMessageRecord.message)
+                                .join(ReplayRecord, ReplayRecord.id == ChatMessageRecord.replay_pk)
+                                .where(selected).order_by(ChatMessageRecord.replay_pk, ChatMessageRecord.id), count)
+
+    with open(os.path.join(path, DICTIONARIES_FILE), "w") as f:
+        json.dump({name: dictionary.values for name, dictionary in dictionaries.items()}, f)
+
+
+def load_columnar(path: str = COLUMNAR_DIR, mmap_mode: Optional[str] = "r") -> ColumnarTables:
+    tables = {}
+    for table in sorted(os.listdir(path)):
+        table_path = os.path.join(path, table)
+        if not os.path.isdir(table_path):
+            continue
+        columns = {}
+        for file_name in os.listdir(table_path):
+            column, extension = os.path.splitext(file_name)
+            if extension == ".npy":
+                columns[column] = np.load(os.path.join(table_path, file_name), mmap_mode=mmap_mode)
+            elif extension == ".bin":
+                file_path = os.path.join(table_path, file_name)
+                columns[column] = (np.memmap(file_path, dtype=np.uint8, mode="r") if os.path.getsize(file_path)
+                                   else np.zeros(0, dtype=np.uint8))
+        tables[table] = columns
+    with open(os.path.join(path, DICTIONARIES_FILE)) as f:
+        dictionaries = json.load(f)
+    return ColumnarTables(tables=tables, dictionaries=dictionaries)
@@ -0,0 +1,208 @@
+import itertools
+import os
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+
+from src.replay_db import get_engine, ReplayRecord, ReplayPlayerRecord, preferred_records, \
+    launched_within
+
+COPLAY_GRAPH_FILE = "data/coplay_graph.npz"
+CONSOLIDATE_EVERY = 1_000_000  # pending player rows
+READ_CHUNK_SIZE = 50_000
+NO_TEAM = 1  # FAF team number of players that play for themselves
+
+
+class Relation:
+    ally = "ally"
+    opponent = "opponent"
+
+
+# Per relation: number of games, sum of the other player's rating, sum of own team's rating advantage
+STATISTICS = ("games", "rating", "advantage")
+
+
+@dataclass
+class CoPlayStats:
+    player_id: str
+    games: int
+    mean_rating: float  # of the other player
+    mean_advantage: float  # mean rating of own team minus mean rating of opponents
+
+
+class CoPlayGraph:
+    """
+    Sparse ally and opponent co-occurrence matrices over interned player IDs.
+    Entry (i, j) of a matrix aggregates the games where players i and j were allies (or opponents),
+    as seen from player i. Games are added incrementally; each replay is counted once.
+    Metadata records are read from the database past the highest record ID already read (`last_record_id`).
+    """
+
+    def __init__(self):
+        self.player_ids: list[str] = []
+        self.player_index: dict[str, int] = {}
+        self.replay_ids: set[str] = set()
+        self.last_record_id = 0
+        self.matrices = {(relation, stat): sparse.csr_matrix((0, 0), dtype=np.float64)
+                         for relation in (Relation.ally, Relation.opponent) for stat in STATISTICS}
+        # Players of games added since the last consolidation, as flat columns with game boundaries
+        self.pending_players: list[int] = []
+        self.pending_teams: list[int] = []
+        self.pending_ratings: list[float] = []
+        self.pending_sizes: list[int] = []
+
+    def _intern(self, player_id: str) -> int:
+        index = self.player_index.get(player_id)
+        if index is None:
+            index = self.player_index[player_id] = len(self.player_ids)
+            self.player_ids.append(player_id)
+        return index
+
+    def add_game(self, replay_id: str, players: Iterable[tuple[str, int, float]]) -> bool:
+        """
+        Adds a game given as (player ID, team, rating) of every player.
+        Returns False if the replay was already added.
+        """
+        if replay_id in self.replay_ids:
+            return False
+        self.replay_ids.add(replay_id)
+        players = list(players)
+        if len(players) < 2:
+            return True
+        for i, (player_id, team, rating) in enumerate(players):
+            self.pending_players.append(self._intern(player_id))
+            # Players without a team are put on teams of their own
+            self.pending_teams.append(team if team != NO_TEAM else -i - 1)
+            self.pending_ratings.append(rating)
+        self.pending_sizes.append(len(players))
+        if len(self.pending_players) >= CONSOLIDATE_EVERY:
+            self.consolidate()
+        return True
+
+    def _pending_pairs(self) -> dict[str, list[tuple[np.ndarray, ...]]]:
+        """Ally and opponent pairs of pending games, computed at once for all games of the same size"""
+        players = np.array(self.pending_players, dtype=np.int64)
+        teams = np.array(self.pending_teams, dtype=np.int64)
+        ratings = np.array(self.pending_ratings, dtype=np.float64)
+        sizes = np.array(self.pending_sizes, dtype=np.int64)
+        starts = np.cumsum(sizes) - sizes
+        pairs = {Relation.ally: [], Relation.opponent: []}
+        for size in np.unique(sizes):
+            # (games, size) matrices of the games with `size` players
+            positions = starts[sizes == size][:, None] + np.arange(size)
+            game_players, game_teams, game_ratings = players[positions], teams[positions], ratings[positions]
+            same_team = game_teams[:, :, None] == game_teams[:, None, :]
+            team_rating = (same_team * game_ratings[:, None, :]).sum(axis=2) / same_team.sum(axis=2)
+            opponents = (~same_team).sum(axis=2)
+            opponent_rating = (~same_team * game_ratings[:, None, :]).sum(axis=2) / np.maximum(opponents, 1)
+            advantage = np.where(opponents > 0, team_rating - opponent_rating, 0.0)
+            other = ~np.eye(size, dtype=bool)
+            for relation, mask in ((Relation.ally, same_team & other), (Relation.opponent, ~same_team)):
+                games, rows, cols = np.nonzero(mask)
+                pairs[relation].append((game_players[games, rows], game_players[games, cols],
+                                        game_ratings[games, cols], advantage[games, rows]))
+        return pairs
+
+    def consolidate(self):
+        """Merges pending games into the matrices"""
+        n = len(self.player_ids)
+        pairs = self._pending_pairs() if self.pending_sizes else {}
+        for relation in (Relation.ally, Relation.opponent):
+            values = None
+            if pairs.get(relation):
+                rows, cols, ratings, advantages = (np.concatenate(parts) for parts in zip(*pairs[relation]))
+                values = {"games": np.ones(len(rows)), "rating": ratings, "advantage": advantages}
+            for stat in STATISTICS:
+                matrix = self.matrices[relation, stat]
+                matrix.resize((n, n))
+                if values is not None:
+                    matrix = matrix + sparse.coo_matrix((values[stat], (rows, cols)), shape=(n, n)).tocsr()
+                self.matrices[relation, stat] = matrix
+        self.pending_players, self.pending_teams, self.pending_ratings, self.pending_sizes = [], [], [], []
+
+    def update_from_db(self, engine=None, since_ts: Optional[int] = None, until_ts: Optional[int] = None) -> int:
+        """
+        Adds games of the metadata store that were not added yet, returns the number of added games.
+        Only records written since the last update are read, so the cost depends on the number of new games.
+        `since_ts` and `until_ts` limit games to those launched within [since_ts, until_ts); windowed updates
+        do not move the high-water mark, as records outside the window are not added.
+        """
+        self.consolidate()
+        engine = engine if engine is not None else get_engine()
+        statement = (select(ReplayRecord.id, ReplayRecord.replay_id, ReplayPlayerRecord.player_id,
+                            ReplayPlayerRecord.team, ReplayPlayerRecord.rating)
+                     .join(ReplayPlayerRecord, ReplayPlayerRecord.replay_pk == ReplayRecord.id)
+                     .where(ReplayRecord.id > self.last_record_id, preferred_records(),
+                            *launched_within(since_ts, until_ts))
+                     .order_by(ReplayRecord.id, ReplayPlayerRecord.id))
+        windowed = since_ts is not None or until_ts is not None
+        added = 0
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=READ_CHUNK_SIZE).execute(statement)
+            for (record_id, replay_id), rows in itertools.groupby(result, key=lambda row: (row[0], row[1])):
+                if replay_id not in self.replay_ids:
+                    added += self.add_game(replay_id,
+                                           ((player_id, team, rating) for _, _, player_id, team, rating in rows))
+                if not windowed:
+                    self.last_record_id = record_id
+        self.consolidate()
+        return added
+
+    def top(self, player_id: str, k: int = 10, relation: str = Relation.ally) -> list[CoPlayStats]:
+        """Returns up to `k` players that shared the most games with the player, as allies or opponents"""
+        if self.pending_sizes:
+            self.consolidate()
+        index = self.player_index.get(player_id)
+        if index is None:
+            return []
+        games = self.matrices[relation, "games"]
+        start, end = games.indptr[index], games.indptr[index + 1]
+        counts = games.data[start:end]
+        if len(counts) > k:
+            best = np.argpartition(-counts, k)[:k]
+        else:
+            best = np.arange(len(counts))
+        best = best[np.argsort(-counts[best], kind="stable")]
+        others = games.indices[start:end][best]
+        ratings = self.matrices[relation, "rating"][[index]][:, others].toarray().ravel()
+        advantages = self.matrices[relation, "advantage"][[index]][:, others].toarray().ravel()
+        return [CoPlayStats(player_id=self.player_ids[other], games=int(count), mean_rating=float(rating / count),
+                            mean_advantage=float(advantage / count))
+                for other, count, rating, advantage in zip(others, counts[best], ratings, advantages)]
+
+    def save(self, path: str = COPLAY_GRAPH_FILE):
+        self.consolidate()
+        arrays = {"player_ids": np.array(self.player_ids, dtype=str),
+                  "replay_ids": np.array(sorted(self.replay_ids), dtype=str),
+                  "last_record_id": np.array(self.last_record_id, dtype=np.int64)}
+        for (relation, stat), matrix in self.matrices.items():
+            arrays[f"{relation}_{stat}_indptr"] = matrix.indptr
+            arrays[f"{relation}_{stat}_indices"] = matrix.indices
+            arrays[f"{relation}_{stat}_data"] = matrix.data
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = COPLAY_GRAPH_FILE) -> "CoPlayGraph":
+        graph = cls()
+        with np.load(path) as arrays:
+            graph.player_ids = arrays["player_ids"].tolist()
+            graph.player_index = {player_id: i for i, player_id in enumerate(graph.player_ids)}
+            graph.replay_ids = set(arrays["replay_ids"].tolist())
+            # Graphs saved before the high-water mark was kept read all records once more
+            graph.last_record_id = int(arrays["last_record_id"]) if "last_record_id" in arrays else 0
+            n = len(graph.player_ids)
+            for relation, stat in graph.matrices:
+                graph.matrices[relation, stat] = sparse.csr_matrix(
+                    (arrays[f"{relation}_{stat}_data"], arrays[f"{relation}_{stat}_indices"],
+                     arrays[f"{relation}_{stat}_indptr"]), shape=(n, n))
+        return graph
+
+
+def load_coplay_graph(path: str = COPLAY_GRAPH_FILE) -> CoPlayGraph:
+    return CoPlayGraph.load(path) if os.path.exists(path) else CoPlayGraph()
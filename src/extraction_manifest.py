@@ -0,0 +1,75 @@
+from typing import Optional
+
+from sqlalchemy import select, update, bindparam
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from src.replay_db import get_engine, ExtractionManifestRecord
+
+
+class ExtractionManifest:
+    """
+    Per-replay record of the source fingerprint (size and a change token, such as mtime) and the metadata version
+    used for extraction. Comparing it against current fingerprints gives the set of new or changed replays
+    without opening any of them.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else get_engine()
+        self.pending: list[dict] = []
+
+    def load(self, kind: str) -> dict[str, tuple[int, int, int]]:
+        """Returns {replay_id: (source size, source token, metadata version)}"""
+        with Session(self.engine) as session:
+            rows = session.execute(
+                select(ExtractionManifestRecord.replay_id, ExtractionManifestRecord.source_size,
+                       ExtractionManifestRecord.source_token, ExtractionManifestRecord.metadata_version)
+                .where(ExtractionManifestRecord.kind == kind))
+            return {replay_id: (size, token, version) for replay_id, size, token, version in rows}
+
+    def get(self, replay_id: str, kind: str) -> Optional[tuple[int, int, int]]:
+        """Entry of a single replay, as in `load`, including records that were not flushed yet"""
+        for pending in reversed(self.pending):
+            if pending["replay_id"] == replay_id and pending["kind"] == kind:
+                return pending["source_size"], pending["source_token"], pending["metadata_version"]
+        with Session(self.engine) as session:
+            record = session.get(ExtractionManifestRecord, (replay_id, kind))
+            if record is None:
+                return None
+            return record.source_size, record.source_token, record.metadata_version
+
+    def record(self, replay_id: str, kind: str, fingerprint: tuple[int, int], version: int):
+        size, token = fingerprint
+        self.pending.append(dict(replay_id=replay_id, kind=kind, source_size=size, source_token=token,
+                                 metadata_version=version))
+
+    def flush(self):
+        """Must be called only after the metadata the pending records describe has been flushed"""
+        if not self.pending:
+            return
+        statement = insert(ExtractionManifestRecord)
+        statement = statement.on_conflict_do_update(
+            index_elements=[ExtractionManifestRecord.replay_id, ExtractionManifestRecord.kind],
+            set_=dict(source_size=statement.excluded.source_size, source_token=statement.excluded.source_token,
+                      metadata_version=statement.excluded.metadata_version))
+        with Session(self.engine) as session, session.begin():
+            session.execute(statement, self.pending)
+        self.pending.clear()
+
+    def rebase(self, moves: list[tuple[str, tuple[int, int], tuple[int, int]]]):
+        """
+        Points entries extracted from the old fingerprint of a replay at its new one, given as
+        (replay ID, old fingerprint, new fingerprint), for rewrites that keep the replay content (e.g. recompression).
+        Entries of other fingerprints are left stale.
+        """
+        if not moves:
+            return
+        table = ExtractionManifestRecord.__table__
+        statement = (update(table)
+                     .where(table.c.replay_id == bindparam("b_replay_id"),
+                            table.c.source_size == bindparam("b_old_size"),
+                            table.c.source_token == bindparam("b_old_token"))
+                     .values(source_size=bindparam("b_new_size"), source_token=bindparam("b_new_token")))
+        with self.engine.begin() as connection:
+            connection.execute(statement, [dict(b_replay_id=replay_id, b_old_size=old[0], b_old_token=old[1],
+                                                b_new_size=new[0], b_new_token=new[1]) for replay_id, old, new in moves])
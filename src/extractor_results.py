@@ -0,0 +1,43 @@
+from typing import Any, Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from src.replay_db import get_engine, ExtractorResultRecord
+
+
+class ExtractorResultStore:
+    """
+    Results of optional body extractors, one JSON document per replay and extractor.
+    Writes are buffered until `flush`; buffered writes are visible to `get`.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine if engine is not None else get_engine()
+        self.pending: dict[tuple[str, str], dict] = {}
+
+    def write(self, replay_id: str, extractor: str, version: int, data: Any):
+        self.pending[(replay_id, extractor)] = dict(replay_id=replay_id, extractor=extractor, version=version,
+                                                    data=data)
+
+    def flush(self):
+        if not self.pending:
+            return
+        statement = insert(ExtractorResultRecord)
+        statement = statement.on_conflict_do_update(
+            index_elements=[ExtractorResultRecord.replay_id, ExtractorResultRecord.extractor],
+            set_=dict(version=statement.excluded.version, data=statement.excluded.data))
+        with Session(self.engine) as session, session.begin():
+            session.execute(statement, list(self.pending.values()))
+        self.pending.clear()
+
+    def get(self, replay_id: str, extractor: str, version: int) -> Optional[Any]:
+        if (replay_id, extractor) in self.pending:
+            pending = self.pending[(replay_id, extractor)]
+            return pending["data"] if pending["version"] == version else None
+        with Session(self.engine) as session:
+            return session.scalar(
+                select(ExtractorResultRecord.data)
+                .where(ExtractorResultRecord.replay_id == replay_id, ExtractorResultRecord.extractor == extractor,
+                       ExtractorResultRecord.version == version))
@@ -1,10 +1,19 @@
+import base64
+import io
 import json
-from dataclasses import dataclass
-from typing import Union
+import zlib
+from dataclasses import dataclass, field
+from typing import Union, Iterable, Any, Optional
 
 import zstandard
 from datetime import timedelta
-from fafreplay import Parser, commands
+from fafreplay import Parser, ReplayReadError, commands
+
+from src.body_extractors import MessageTypes, EXTRACTORS, ReplayEventsExtractor, required_commands, run_extractors
+from src.metrics import get_metrics
+from src.replay_dictionary import Compression, get_dictionary
+from src.replay_events import ChatMessage, CompletionNotification, ResourceSent, ChatMessages, \
+    CompletionNotifications, ResourceTransfers
 
 all_commands = [commands.Advance, commands.SetCommandSource, commands.CommandSourceTerminated,
                 commands.VerifyChecksum,
@@ -20,39 +29,16 @@ all_commands = [commands.Advance, commands.SetCommandSource, commands.CommandSou
                 commands.ExecuteLuaInSim, commands.LuaSimCallback,
                 commands.EndGame]
 
-MSG_TICK_TIMEOUT = 20  # for deduplication
-MSG_DONE_SUFFIX = "done!"
-MSG_DONE_SUFFIX2 = "construction done!"
-
-
-class MessageTypes:
-    all = "all"
-    allies = "allies"
-    auto_notify = "notify"
-
-
-@dataclass(frozen=True)
-class ChatMessage:
-    ally_only: bool
-    player: str
-    message: str
-    sent_at_sec: float
-
+# Commands `parse_replay` needs besides those of the extractors: `VerifyChecksum` for desync detection.
+# All commands no extractor consumes are skipped without decoding.
+metadata_commands = [commands.VerifyChecksum]
 
-@dataclass(frozen=True)
-class CompletionNotification:
-    player: str
-    completed: str
-    sent_at_sec: float
+HEADER_READ_CHUNK_SIZE = 64 * 1024
+HEADER_LINE_SEARCH_SIZE = 4 * 1024
 
 
-@dataclass(frozen=True)
-class ResourceSent:
-    from_player: str
-    to_player: str
-    mass: float
-    energy: float
-    sent_at_sec: float
+_decompressors = {}
+_parsers = {}
 
 
 @dataclass
@@ -69,15 +55,17 @@ class ReplayPlayerMetadata:
     faction: int
     team: int
 
+    army: Optional[int] = None  # 1-based army number, which sim callbacks (such as resource transfers) refer to
+
 
 @dataclass
 class ReplayMetadata:
     title: str
     replay_id: str
 
-    chat_messages: list[ChatMessage]
-    notifications: list[CompletionNotification]
-    resource_transfer: list[ResourceSent]
+    chat_messages: ChatMessages
+    notifications: CompletionNotifications
+    resource_transfer: ResourceTransfers
 
     launched_at_ts: int
     duration: float
@@ -87,6 +75,22 @@ class ReplayMetadata:
     desync: bool
     players: list[ReplayPlayerMetadata]
 
+    # Results of the optional body extractors that were run, by extractor name (see `src/body_extractors.py`)
+    extracted: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class ReplayHeader:
+    """Lightweight replay record, built from the replay header only"""
+    title: str
+    replay_id: str
+
+    launched_at_ts: int
+    map: str
+
+    game_type: str
+    players: list[ReplayPlayerMetadata]
+
 
 def ensure_str(str_or_bytes: Union[str, bytes]):
     if isinstance(str_or_bytes, bytes):
@@ -97,29 +101,131 @@ def ensure_str(str_or_bytes: Union[str, bytes]):
     return str_or_bytes
 
 
-# Based on `fafreplay`'s extract_scfa function
-def extract_scfa(fobj):
-    """Turns data from `.fafreplay` format into `.scfareplay` format."""
-    header = json.loads(fobj.readline().decode())
-    buf = fobj.read()
+def _get_decompressor(dictionary_id=None):
+    if dictionary_id not in _decompressors:
+        _decompressors[dictionary_id] = zstandard.ZstdDecompressor(
+            dict_data=get_dictionary(dictionary_id) if dictionary_id is not None else None)
+    return _decompressors[dictionary_id]
+
+
+def _decompress_zlib(body) -> bytes:
+    decoded = base64.decodebytes(bytes(body))
+    # Prefixed with the decompressed size, so output is allocated once
+    size = int.from_bytes(decoded[:4], "big")
+    return zlib.decompress(decoded[4:], bufsize=max(size, 1))
+
+
+def _get_parser(replay_commands, save_commands: bool) -> Parser:
+    """Parsers only hold their configuration, so they are created once and reused across replays"""
+    key = (tuple(replay_commands), save_commands)
+    if key not in _parsers:
+        _parsers[key] = Parser(
+            commands=list(replay_commands),
+            save_commands=save_commands,
+            limit=None,
+            stop_on_desync=False
+        )
+    return _parsers[key]
+
+
+def _find_newline(view: memoryview) -> int:
+    """Finds the end of the header line, looking only at the beginning of the data"""
+    size = HEADER_LINE_SEARCH_SIZE
+    while True:
+        newline = bytes(view[:size]).find(b"\n")
+        if newline >= 0:
+            return newline
+        if size >= len(view):
+            return len(view)
+        size *= 2
+
+
+def split_fafreplay(buf):
+    """
+    Splits `.fafreplay` data (`bytes`, `mmap`, ...) into its JSON file header and a view of its compressed body.
+    The body is not copied; the returned view must be released before `buf` is closed.
+    """
+    with memoryview(buf) as view:
+        newline = _find_newline(view)
+        header = json.loads(bytes(view[:newline]))
+        return header, view[newline + 1:]
+
+
+def _open_scfa_stream(header: dict, body):
+    """Returns a stream of decompressed `.scfareplay` data from the compressed `.fafreplay` body."""
     compression_type = header.get("compression")
 
-    if compression_type == "zlib":
-        raise Exception("Cannot decode zstd compression type, as they lack header")
-        # decoded = base64.decodebytes(buf)
-        # decoded = decoded[4:]  # skip the decoded size
-        # if return_file_header:
-        #     return zlib.decompress(decoded), None
-        # else:
-        #     return zlib.decompress(decoded)
-    elif compression_type == "zstd":
+    if compression_type == Compression.zlib:
+        # zlib data cannot be decoded before all of it is base64-decoded anyway
+        return io.BytesIO(_decompress_zlib(body))
+    elif compression_type == Compression.zstd:
         if zstandard is None:
             raise RuntimeError(
                 "zstd is required for decompressing this replay"
             )
-        reader = zstandard.ZstdDecompressor().stream_reader(buf)
-        data = reader.read()
-        return data, header
+        return _get_decompressor().stream_reader(body)
+    elif compression_type == Compression.zstd_dict:
+        return _get_decompressor(header["dictionary"]).stream_reader(body)
+    raise Exception(f"Unknown compression type {compression_type}")
+
+
+def _decompress_scfa(header: dict, body) -> bytes:
+    metrics = get_metrics()
+    with metrics.stage("decompress"):
+        compression_type = header.get("compression")
+        if compression_type in (Compression.zstd, Compression.zstd_dict) and zstandard.frame_content_size(body) > 0:
+            # The decompressed size is stored in the frame, so output is allocated once, with the exact size
+            data = _get_decompressor(header.get("dictionary")).decompress(body)
+        elif compression_type == Compression.zlib:
+            data = _decompress_zlib(body)
+        else:
+            with _open_scfa_stream(header, body) as reader:
+                data = reader.read()
+    metrics.add_bytes("decompress", len(body), len(data))
+    return data
+
+
+def _decompress_scfa_header(header: dict, body, parser: Parser) -> dict:
+    # Reads grow geometrically, so that a long header is parsed only a few times, and copied O(size) times in total.
+    # A header cut short may also fail to parse as invalid (e.g. "missing map name"), so both errors are retried.
+    with _open_scfa_stream(header, body) as reader:
+        data = bytearray()
+        size = HEADER_READ_CHUNK_SIZE
+        while True:
+            chunk = reader.read(size)
+            data += chunk
+            try:
+                return parser.parse_header(bytes(data))
+            except (EOFError, ReplayReadError):
+                if not chunk:
+                    raise
+            size *= 2
+
+
+def _load_scfa(data, load):
+    """Applies `load` to the file header and compressed body of `.fafreplay` data, given as a file object or buffer"""
+    if isinstance(data, io.IOBase):
+        header = json.loads(data.readline().decode())
+        return load(header, data.read()), header
+    header, body = split_fafreplay(data)
+    try:
+        return load(header, body), header
+    finally:
+        body.release()
+
+
+# Based on `fafreplay`'s extract_scfa function
+def extract_scfa(fobj):
+    """Turns data from `.fafreplay` format into `.scfareplay` format."""
+    return _load_scfa(fobj, _decompress_scfa)
+
+
+def extract_scfa_header(fobj, parser: Parser):
+    """
+    Decompresses `.scfareplay` data only until its header can be parsed, and returns the parsed header.
+    The replay body is never decompressed nor decoded.
+    """
+    return _load_scfa(fobj, lambda header, body: _decompress_scfa_header(header, body, parser))
 
 
 def _replay_header_parser(game_header: dict, file_header: dict):
@@ -129,7 +235,8 @@ def _replay_header_parser(game_header: dict, file_header: dict):
     map_file = ensure_str(game_header["map_file"])
     map_file = map_file.strip("/")[-1]
     players = []
-    for army_id, player in game_header["armies"].items():
+    # Armies come in no particular order; sorting them keeps player lists the same between runs
+    for army_id, player in sorted(game_header["armies"].items()):
         if not player["Human"]:
             continue
         nickname = ensure_str(player["PlayerName"])
@@ -144,78 +251,37 @@ def _replay_header_parser(game_header: dict, file_header: dict):
             clan=ensure_str(clan if clan else ""),
             team=int(player["Team"]),
             rating=game_header["scenario"]["Options"]["Ratings"][nickname],
+            army=int(army_id) + 1,
         ))
     return title, launched_at, map_file, players, game_type
 
 
-def _replay_body_parser(replay):
-    current_tick = 0
-    current_time = timedelta()
-    first_message_sent_at = {}
-    chat_messages, notifications, resource_transfer = [], [], []
-    for cmd in replay["body"]["commands"]:
-        if cmd["name"] == "LuaSimCallback" and cmd.get("func") == "GiveResourcesToPlayer":
-            args = cmd.get("args", {})
-            mass, energy = args.get("Mass", 0.0), args.get("Energy", 0.0)
-            message = args.get("Msg", {}).get("text", b'').decode()
-            is_chat = args.get("Msg", {}).get("Chat", None)
-            player = args.get("Sender", b'').decode()
-            message_type = args.get("Msg", {}).get("to", b'').decode()
-            target_player = args.get("To")
-
-            # Skipping duplicates
-            msg_fingerprint = player + str(message)
-            if (msg_fingerprint not in first_message_sent_at or
-                    first_message_sent_at[msg_fingerprint] - current_tick > MSG_TICK_TIMEOUT):
-                first_message_sent_at[msg_fingerprint] = current_tick
-            else:
-                continue
-            if is_chat:
-                if message_type == MessageTypes.auto_notify:
-                    # Handling only completion notifications
-                    # (such as commander and factory upgrades, experimental and arty completion)
-                    if MSG_DONE_SUFFIX in message:
-                        if MSG_DONE_SUFFIX2 in message:
-                            completed = message[:message.find(MSG_DONE_SUFFIX2)]
-                        else:
-                            completed = message[:message.find(MSG_DONE_SUFFIX)]
-                        completed = completed.strip()
-                        msg = CompletionNotification(
-                            player=player,
-                            completed=completed,
-                            sent_at_sec=current_time.total_seconds())
-                        notifications.append(msg)
-                else:
-                    msg = ChatMessage(
-                        ally_only=message_type == MessageTypes.allies,
-                        player=player,
-                        message=message,
-                        sent_at_sec=current_time.total_seconds())
-                    chat_messages.append(msg)
-            else:
-                msg = ResourceSent(
-                    from_player=player, to_player=target_player,
-                    mass=mass, energy=energy,
-                    sent_at_sec=current_time.total_seconds())
-                resource_transfer.append(msg)
-        if cmd["name"] == "Advance":
-            current_tick += cmd["ticks"]
-            current_time = timedelta(milliseconds=current_tick * 100)
-    return chat_messages, notifications, resource_transfer, current_time.seconds
-
-
-def parse_replay(data_stream, replay_id: str):
-    parser = Parser(
-        commands=all_commands,
-        save_commands=True,
-        limit=None,
-        stop_on_desync=False
-    )
+def _iter_commands(replay):
+    """Yields body commands one by one, releasing each of them once it is consumed."""
+    replay_commands = replay["body"].pop("commands")
+    replay_commands.reverse()
+    while replay_commands:
+        yield replay_commands.pop()
+
 
+def _parse_body(data_stream, extractors: list, extra_commands: list[int]):
+    parser = _get_parser(sorted(set(required_commands(extractors) + extra_commands)), save_commands=True)
     data, file_header = extract_scfa(data_stream)
-    replay = parser.parse(data)
+    metrics = get_metrics()
+    with metrics.stage("fafreplay_parse"):
+        replay = parser.parse(data)
+    with metrics.stage("body_walk"):
+        results, last_tick = run_extractors(_iter_commands(replay), extractors, replay["header"])
+    return replay, file_header, results, last_tick
+
+
+def parse_replay(data_stream, replay_id: str, extractors: Iterable[str] = ()):
+    """Parses replay metadata, running the named optional extractors in the same pass over the body"""
+    replay, file_header, results, last_tick = _parse_body(
+        data_stream, [ReplayEventsExtractor] + [EXTRACTORS[name] for name in extractors], metadata_commands)
     desync = bool(replay["body"]["sim"]["desync_ticks"])
-    chat_messages, notifications, resource_transfer, duration = _replay_body_parser(replay)
+    chat_messages, notifications, resource_transfer = results.pop(ReplayEventsExtractor.name)
+    duration = timedelta(milliseconds=last_tick * 100).seconds
     title, launched_at, map_file, players, game_type = _replay_header_parser(
         game_header=replay["header"],
         file_header=file_header
@@ -231,6 +297,31 @@ def parse_replay(data_stream, replay_id: str):
         replay_id=replay_id,
         resource_transfer=resource_transfer,
         launched_at_ts=launched_at,
+        map=map_file,
+        extracted=results
+    )
+
+
+def extract_body(data_stream, extractors: Iterable[str]) -> dict[str, Any]:
+    """Runs only the named optional extractors, decoding only the commands they consume"""
+    _, _, results, _ = _parse_body(data_stream, [EXTRACTORS[name] for name in extractors], [])
+    return results
+
+
+def parse_replay_header(data_stream, replay_id: str):
+    parser = _get_parser([], save_commands=False)
+    with get_metrics().stage("decompress_header"):
+        game_header, file_header = extract_scfa_header(data_stream, parser)
+    title, launched_at, map_file, players, game_type = _replay_header_parser(
+        game_header=game_header,
+        file_header=file_header
+    )
+    return ReplayHeader(
+        title=title,
+        players=players,
+        game_type=game_type,
+        replay_id=replay_id,
+        launched_at_ts=launched_at,
         map=map_file
     )
 
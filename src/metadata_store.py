@@ -0,0 +1,190 @@
+from typing import Optional, Union, Sequence
+
+from sqlalchemy import select, delete
+from sqlalchemy.orm import Session, selectinload
+
+from src.faf_replay import ReplayMetadata, ReplayPlayerMetadata, ReplayHeader
+from src.replay_events import NameTable, ChatMessages, CompletionNotifications, ResourceTransfers, sec_to_ticks
+from src.replay_db import get_engine, ReplayRecord, ReplayPlayerRecord, ChatMessageRecord, NotificationRecord, \
+    ResourceTransferRecord, MetadataKind, preferred_records, launched_within, lock_for_writing
+from src.notification_rollups import rollup_replays, stored_rollups, apply_rollups
+
+METADATA_BATCH_SIZE = 256
+
+
+def _metadata_kind(metadata: Union[ReplayMetadata, ReplayHeader]) -> str:
+    return MetadataKind.header if isinstance(metadata, ReplayHeader) else MetadataKind.full
+
+
+def _to_players(record: ReplayRecord) -> list[ReplayPlayerMetadata]:
+    return [ReplayPlayerMetadata(
+        player_id=p.player_id, nickname=p.nickname, clan=p.clan, country=p.country,
+        rating_mean=p.rating_mean, rating_std=p.rating_std, rating=p.rating,
+        faction=p.faction, team=p.team, army=p.army,
+    ) for p in record.players]
+
+
+def _to_record(replay_id: str, metadata: Union[ReplayMetadata, ReplayHeader], version: int) -> ReplayRecord:
+    record = ReplayRecord(
+        replay_id=replay_id,
+        kind=_metadata_kind(metadata),
+        metadata_version=version,
+        title=metadata.title,
+        launched_at_ts=metadata.launched_at_ts,
+        map=metadata.map,
+        game_type=metadata.game_type,
+        players=[ReplayPlayerRecord(
+            player_id=p.player_id, nickname=p.nickname, clan=p.clan, country=p.country,
+            rating_mean=p.rating_mean, rating_std=p.rating_std, rating=p.rating,
+            faction=p.faction, team=p.team, army=p.army,
+        ) for p in metadata.players],
+    )
+    if isinstance(metadata, ReplayHeader):
+        return record
+    record.duration = metadata.duration
+    record.desync = metadata.desync
+    record.chat_messages = [ChatMessageRecord(
+        ally_only=m.ally_only, player=m.player, message=m.message, sent_at_sec=m.sent_at_sec
+    ) for m in metadata.chat_messages]
+    record.notifications = [NotificationRecord(
+        player=n.player, completed=n.completed, sent_at_sec=n.sent_at_sec
+    ) for n in metadata.notifications]
+    record.resource_transfer = [ResourceTransferRecord(
+        from_player=r.from_player, to_player=r.to_player, mass=r.mass, energy=r.energy,
+        sent_at_sec=r.sent_at_sec
+    ) for r in metadata.resource_transfer]
+    return record
+
+
+def _from_record(record: ReplayRecord) -> Union[ReplayMetadata, ReplayHeader]:
+    if record.kind == MetadataKind.header:
+        return ReplayHeader(
+            title=record.title,
+            replay_id=record.replay_id,
+            launched_at_ts=record.launched_at_ts,
+            map=record.map,
+            game_type=record.game_type,
+            players=_to_players(record),
+        )
+    names = NameTable()
+    chat_messages = ChatMessages(names)
+    for m in record.chat_messages:
+        chat_messages.append(ally_only=m.ally_only, player=m.player, message=m.message,
+                             tick=sec_to_ticks(m.sent_at_sec))
+    notifications = CompletionNotifications(names)
+    for n in record.notifications:
+        notifications.append(player=n.player, completed=n.completed, tick=sec_to_ticks(n.sent_at_sec))
+    resource_transfer = ResourceTransfers(names)
+    for r in record.resource_transfer:
+        resource_transfer.append(from_player=r.from_player, to_player=r.to_player, mass=r.mass, energy=r.energy,
+                                 tick=sec_to_ticks(r.sent_at_sec))
+    return ReplayMetadata(
+        title=record.title,
+        replay_id=record.replay_id,
+        chat_messages=chat_messages,
+        notifications=notifications,
+        resource_transfer=resource_transfer,
+        launched_at_ts=record.launched_at_ts,
+        duration=record.duration,
+        map=record.map,
+        game_type=record.game_type,
+        desync=record.desync,
+        players=_to_players(record),
+    )
+
+
+class MetadataStore:
+    """
+    Replay metadata stored in normalized SQLite tables.
+    Full metadata (`ReplayMetadata`) and header-only records (`ReplayHeader`) are stored side by side,
+    each with their own version.
+    Writes are buffered and committed in batches of `batch_size` replays per transaction;
+    buffered writes are visible to `has`/`get` before they are flushed.
+    Notification rollups (see `src/notification_rollups.py`) are updated in the same transaction as full metadata.
+    """
+
+    def __init__(self, engine=None, batch_size: int = METADATA_BATCH_SIZE):
+        self.engine = engine if engine is not None else get_engine()
+        self.batch_size = batch_size
+        self.pending: dict[tuple[str, str], tuple[Union[ReplayMetadata, ReplayHeader], int]] = {}
+
+    def write(self, replay_id: str, metadata: Union[ReplayMetadata, ReplayHeader], version: int):
+        self.pending[(replay_id, _metadata_kind(metadata))] = (metadata, version)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with Session(self.engine) as session, session.begin():
+            # Rollups are read and updated, so other writers must wait until the transaction ends
+            lock_for_writing(session)
+            full = [(replay_id, metadata) for (replay_id, kind), (metadata, _) in self.pending.items()
+                    if kind == MetadataKind.full]
+            if full:
+                apply_rollups(session, rollup_replays(metadata for _, metadata in full),
+                              stored_rollups(session, [replay_id for replay_id, _ in full]))
+            for kind in (MetadataKind.full, MetadataKind.header):
+                replay_ids = [replay_id for replay_id, pending_kind in self.pending if pending_kind == kind]
+                if replay_ids:
+                    session.execute(delete(ReplayRecord).where(ReplayRecord.kind == kind,
+                                                               ReplayRecord.replay_id.in_(replay_ids)))
+            session.add_all(_to_record(replay_id, metadata, version)
+                            for (replay_id, _), (metadata, version) in self.pending.items())
+        self.pending.clear()
+
+    def has(self, replay_id: str, version: int, kind: str = MetadataKind.full) -> bool:
+        if (replay_id, kind) in self.pending:
+            return self.pending[(replay_id, kind)][1] == version
+        with Session(self.engine) as session:
+            stored_version = session.scalar(
+                select(ReplayRecord.metadata_version)
+                .where(ReplayRecord.replay_id == replay_id, ReplayRecord.kind == kind))
+        return stored_version == version
+
+    def get(self, replay_id: str, version: int,
+            kind: str = MetadataKind.full) -> Optional[Union[ReplayMetadata, ReplayHeader]]:
+        if (replay_id, kind) in self.pending:
+            metadata, pending_version = self.pending[(replay_id, kind)]
+            return metadata if pending_version == version else None
+        with Session(self.engine) as session:
+            record = session.scalar(
+                select(ReplayRecord)
+                .where(ReplayRecord.replay_id == replay_id, ReplayRecord.kind == kind,
+                       ReplayRecord.metadata_version == version)
+                .options(selectinload(ReplayRecord.players), selectinload(ReplayRecord.chat_messages),
+                         selectinload(ReplayRecord.notifications), selectinload(ReplayRecord.resource_transfer)))
+            if record is None:
+                return None
+            return _from_record(record)
+
+    def find(self, player_id: Optional[str] = None, nickname: Optional[str] = None, map: Optional[str] = None,
+             game_type: Optional[str] = None, desync: Optional[bool] = None, since_ts: Optional[int] = None,
+             until_ts: Optional[int] = None, kind: Optional[str] = None, fields: Optional[Sequence[str]] = None,
+             limit: Optional[int] = None) -> list:
+        """
+        Finds replays matching all given filters, ordered by launch time, using the table indexes.
+        Returns replay IDs, or tuples of the requested `ReplayRecord` fields if `fields` are given.
+        Without `kind`, full metadata of every replay is preferred over its header-only record.
+        """
+        self.flush()
+        columns = [getattr(ReplayRecord, field) for field in fields] if fields else [ReplayRecord.replay_id]
+        statement = select(*columns).where(
+            preferred_records() if kind is None else ReplayRecord.kind == kind,
+            *launched_within(since_ts, until_ts))
+        if player_id is not None:
+            statement = statement.where(ReplayRecord.id.in_(
+                select(ReplayPlayerRecord.replay_pk).where(ReplayPlayerRecord.player_id == player_id)))
+        if nickname is not None:
+            statement = statement.where(ReplayRecord.id.in_(
+                select(ReplayPlayerRecord.replay_pk).where(ReplayPlayerRecord.nickname == nickname)))
+        if map is not None:
+            statement = statement.where(ReplayRecord.map == map)
+        if game_type is not None:
+            statement = statement.where(ReplayRecord.game_type == game_type)
+        if desync is not None:
+            statement = statement.where(ReplayRecord.desync == desync)
+        statement = statement.order_by(ReplayRecord.launched_at_ts, ReplayRecord.id).limit(limit)
+        with self.engine.connect() as connection:
+            result = connection.execute(statement)
+            return result.scalars().all() if not fields else [tuple(row) for row in result]
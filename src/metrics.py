@@ -0,0 +1,268 @@
+import bisect
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Optional
+
+# Upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+SLOWEST_KEPT = 20  # slowest replays remembered for profiling
+PROFILE_DIR = "data/profiles/"
+PROFILE_INTERVAL_SEC = 0.001
+PROMETHEUS_PREFIX = "faf"
+
+_metrics = None
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # the last bucket is unbounded
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, state: list):
+        counts, total, count, maximum = state
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.total += total
+        self.count += count
+        self.max = max(self.max, maximum)
+
+    def state(self) -> list:
+        return [self.counts, self.total, self.count, self.max]
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the quantile (the max for the unbounded bucket)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    Per-stage latency histograms, bytes in and out, error counts by exception class and plain counters
+    of one process. Recording takes a lock and a few dict operations, so stages are timed per replay,
+    never per replay command. Worker processes send their metrics back with `drain`, to be `merge`d.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.histograms: dict[str, Histogram] = {}
+        self.bytes_in = Counter()
+        self.bytes_out = Counter()
+        self.errors = Counter()  # by (stage, exception class)
+        self.counters = Counter()
+        self.slowest: list[tuple[float, str]] = []  # min-heap of (seconds, replay ID)
+
+    def observe(self, stage: str, seconds: float, key: Optional[str] = None):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+            if key is not None:
+                if len(self.slowest) < SLOWEST_KEPT:
+                    heapq.heappush(self.slowest, (seconds, key))
+                elif seconds > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, (seconds, key))
+
+    @contextmanager
+    def stage(self, stage: str, key: Optional[str] = None):
+        """Times the block; exceptions leaving it are counted as errors of the stage. `key` names the replay"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(stage, e)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started, key)
+
+    def add_bytes(self, stage: str, bytes_in: int = 0, bytes_out: int = 0):
+        with self.lock:
+            self.bytes_in[stage] += bytes_in
+            self.bytes_out[stage] += bytes_out
+
+    def error(self, stage: str, exception: BaseException):
+        with self.lock:
+            self.errors[(stage, type(exception).__name__)] += 1
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def drain(self) -> dict:
+        """Returns the metrics recorded so far as plain data, and starts over"""
+        with self.lock:
+            state = {"histograms": {stage: h.state() for stage, h in self.histograms.items()},
+                     "bytes_in": dict(self.bytes_in), "bytes_out": dict(self.bytes_out),
+                     "errors": list(self.errors.items()), "counters": dict(self.counters),
+                     "slowest": list(self.slowest)}
+            self.histograms.clear()
+            self.bytes_in.clear()
+            self.bytes_out.clear()
+            self.errors.clear()
+            self.counters.clear()
+            self.slowest.clear()
+        return state
+
+    def merge(self, state: dict):
+        with self.lock:
+            for stage, histogram in state["histograms"].items():
+                self.histograms.setdefault(stage, Histogram()).merge(histogram)
+            self.bytes_in.update(state["bytes_in"])
+            self.bytes_out.update(state["bytes_out"])
+            self.errors.update(dict(state["errors"]))
+            self.counters.update(state["counters"])
+            self.slowest = heapq.nlargest(SLOWEST_KEPT, self.slowest + state["slowest"])
+            heapq.heapify(self.slowest)
+
+    def slowest_replays(self, n: int) -> list[tuple[str, float]]:
+        with self.lock:
+            return [(key, seconds) for seconds, key in heapq.nlargest(n, self.slowest)]
+
+    def report(self) -> dict:
+        elapsed = time.time() - self.started_at
+        with self.lock:
+            stages = {}
+            for stage, h in sorted(self.histograms.items()):
+                stages[stage] = {
+                    "count": h.count, "total_sec": h.total, "mean_sec": h.total / h.count if h.count else None,
+                    "p50_sec": h.quantile(0.5), "p90_sec": h.quantile(0.9), "p99_sec": h.quantile(0.99),
+                    "max_sec": h.max, "per_sec": h.count / elapsed if elapsed else None,
+                    "bytes_in": self.bytes_in.get(stage, 0), "bytes_out": self.bytes_out.get(stage, 0),
+                    "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], h.counts)),
+                }
+            return {"started_at": self.started_at, "elapsed_sec": elapsed, "stages": stages,
+                    "errors": [{"stage": stage, "exception": exception, "count": count}
+                               for (stage, exception), count in sorted(self.errors.items())],
+                    "counters": dict(sorted(self.counters.items())),
+                    "slowest": [{"replay_id": key, "seconds": seconds}
+                                for seconds, key in heapq.nlargest(len(self.slowest), self.slowest)]}
+
+    def prometheus(self) -> str:
+        """The report in the Prometheus text exposition format"""
+        report = self.report()
+        p = PROMETHEUS_PREFIX
+        lines = [f"# TYPE {p}_stage_seconds histogram"]
+        for stage, s in report["stages"].items():
+            cumulative = 0
+            for bound, count in s["buckets"].items():
+                cumulative += count
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {s["total_sec"]}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {s["count"]}')
+        lines.append(f"# TYPE {p}_stage_bytes_total counter")
+        for stage, s in report["stages"].items():
+            for direction in ("in", "out"):
+                if s[f"bytes_{direction}"]:
+                    lines.append(f'{p}_stage_bytes_total{{stage="{stage}",direction="{direction}"}} '
+                                 f'{s[f"bytes_{direction}"]}')
+        lines.append(f"# TYPE {p}_errors_total counter")
+        for e in report["errors"]:
+            lines.append(f'{p}_errors_total{{stage="{e["stage"]}",exception="{e["exception"]}"}} {e["count"]}')
+        for name, value in report["counters"].items():
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            lines.append(f"{p}_{name}_total {value}")
+        lines.append(f"# TYPE {p}_elapsed_seconds gauge")
+        lines.append(f"{p}_elapsed_seconds {report['elapsed_sec']}")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path: str):
+        """Writes the report as Prometheus text if the path ends with `.prom`, and as JSON otherwise"""
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.report(), f, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+def get_metrics() -> Metrics:
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stack of the thread that entered it, every `interval` seconds, from a background thread.
+    Stacks are counted in the collapsed format of flame graph tools. Native code that holds the GIL
+    (decompression, `fafreplay` parsing) delays the samples, so it shows up as fewer samples of its caller.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_SEC):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread_id = None
+        self._sampler = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._sampler.join()
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def profile_slowest(run: Callable[[str], Any], n: int, directory: str = PROFILE_DIR,
+                    profiler: Callable[[], Any] = SamplingProfiler) -> list[str]:
+    """
+    Runs `run(replay_id)` again for the `n` slowest replays seen so far, each under a new `profiler`
+    (a context manager with a `write(path)` method), and writes the profiles to `directory`.
+    Returns the written paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for replay_id, _ in get_metrics().slowest_replays(n):
+        with profiler() as p:
+            run(replay_id)
+        path = os.path.join(directory, f"{replay_id}.folded")
+        p.write(path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,239 @@
+import math
+from dataclasses import dataclass, field
+from typing import Iterable, Optional
+
+from sqlalchemy import select, delete, tuple_
+from sqlalchemy.orm import Session, selectinload
+
+from src.replay_db import get_engine, NotificationRollupRecord, ReplayRecord, MetadataKind, lock_for_writing
+
+RATING_BUCKET = 200
+# Quantiles are estimated within this relative error; completion times up to hours take a few hundred buckets
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+SKETCH_MIN_SEC = 1.0  # shorter times share the first bucket
+KEYS_PER_QUERY = 300  # rollup keys looked up per query, within SQLite's limit of bound parameters
+REBUILD_BATCH_SIZE = 256
+
+ALL_KEY = ""  # key of the `Dimension.all` rollups
+GAMES = ""  # `completed` of the rollups counting every player-game of a key, whatever was completed
+
+
+class Dimension:
+    """What notification rollups are grouped by; keys are strings"""
+    all = "all"  # every player-game
+    player = "player"  # player ID
+    faction = "faction"  # `Factions` value
+    map = "map"
+    rating = "rating"  # lower bound of the `RATING_BUCKET` wide rating bucket
+
+
+class QuantileSketch:
+    """
+    Counts of values in logarithmically growing buckets, which estimate quantiles within `SKETCH_RELATIVE_ACCURACY`.
+    Sketches merge exactly by adding bucket counts, and values are removed by subtracting them.
+    """
+    __slots__ = ("counts",)
+
+    def __init__(self, counts: Optional[dict] = None):
+        self.counts: dict[int, int] = {int(bucket): count for bucket, count in (counts or {}).items()}
+
+    @staticmethod
+    def bucket(value: float) -> int:
+        return math.ceil(math.log(max(value, SKETCH_MIN_SEC) / SKETCH_MIN_SEC, SKETCH_GAMMA))
+
+    def add(self, value: float, count: int = 1):
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + count
+        if not self.counts[bucket]:
+            del self.counts[bucket]
+
+    def merge(self, other: "QuantileSketch", sign: int = 1):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + sign * count
+            if not self.counts[bucket]:
+                del self.counts[bucket]
+
+    def __len__(self) -> int:
+        return sum(self.counts.values())
+
+    def quantile(self, q: float) -> Optional[float]:
+        total = len(self)
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen > rank:
+                return SKETCH_MIN_SEC * 2 * SKETCH_GAMMA ** bucket / (SKETCH_GAMMA + 1)
+        return SKETCH_MIN_SEC * 2 * SKETCH_GAMMA ** max(self.counts) / (SKETCH_GAMMA + 1)
+
+    def state(self) -> dict[str, int]:
+        return {str(bucket): count for bucket, count in sorted(self.counts.items())}
+
+
+@dataclass
+class NotificationRollup:
+    dimension: str
+    key: str
+    completed: str
+    games: int = 0
+    completions: int = 0
+    first_sec_sum: float = 0.0
+    first_sec: QuantileSketch = field(default_factory=QuantileSketch)
+
+    @property
+    def mean_first_sec(self) -> Optional[float]:
+        return self.first_sec_sum / self.games if self.games else None
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimated quantile of the time of the first completion in a game"""
+        return self.first_sec.quantile(q)
+
+    def add(self, other: "NotificationRollup", sign: int = 1):
+        self.games += sign * other.games
+        self.completions += sign * other.completions
+        self.first_sec_sum += sign * other.first_sec_sum
+        self.first_sec.merge(other.first_sec, sign)
+
+
+def _player_keys(replay_map: str, player) -> list[tuple[str, str]]:
+    keys = [(Dimension.all, ALL_KEY), (Dimension.player, str(player.player_id)),
+            (Dimension.faction, str(int(player.faction))), (Dimension.map, replay_map)]
+    if player.rating is not None and math.isfinite(player.rating):
+        keys.append((Dimension.rating, str(math.floor(player.rating / RATING_BUCKET) * RATING_BUCKET)))
+    return keys
+
+
+def rollup_replays(replays: Iterable) -> dict[tuple[str, str, str], NotificationRollup]:
+    """
+    Rollups of the notifications of full replay metadata, by (dimension, key, completed).
+    Takes `ReplayMetadata` or `ReplayRecord`s with players and notifications loaded; notifications are matched
+    to players by nickname, and those of observers are left out.
+    """
+    rollups = {}
+
+    def add(dimension, key, completed, completions, first_sec=None):
+        rollup_key = (dimension, key, completed)
+        if rollup_key not in rollups:
+            rollups[rollup_key] = NotificationRollup(dimension, key, completed)
+        rollup = rollups[rollup_key]
+        rollup.games += 1
+        rollup.completions += completions
+        if first_sec is not None:
+            rollup.first_sec_sum += first_sec
+            rollup.first_sec.add(first_sec)
+
+    for replay in replays:
+        players = {player.nickname: player for player in replay.players}
+        # (completions, first completion time) of every completed item, by player
+        completed_by = {nickname: {} for nickname in players}
+        for notification in replay.notifications:
+            if notification.player not in players:
+                continue
+            completions, first_sec = completed_by[notification.player].get(notification.completed, (0, math.inf))
+            completed_by[notification.player][notification.completed] = (
+                completions + 1, min(first_sec, notification.sent_at_sec))
+        for nickname, player in players.items():
+            for dimension, key in _player_keys(replay.map, player):
+                add(dimension, key, GAMES, 0)
+                for completed, (completions, first_sec) in completed_by[nickname].items():
+                    add(dimension, key, completed, completions, first_sec)
+    return rollups
+
+
+def _from_record(record: NotificationRollupRecord) -> NotificationRollup:
+    return NotificationRollup(record.dimension, record.key, record.completed, record.games, record.completions,
+                              record.first_sec_sum, QuantileSketch(record.first_sec_sketch))
+
+
+def apply_rollups(session: Session, added: dict[tuple[str, str, str], NotificationRollup],
+                  removed: Optional[dict[tuple[str, str, str], NotificationRollup]] = None):
+    """
+    Adds rollups of new replays to the stored ones, and subtracts those of replaced replays, within the session.
+    The session must hold the write lock (see `lock_for_writing`) since before the replaced replays were read.
+    """
+    changes = {key: NotificationRollup(*key) for key in {*added, *(removed or {})}}
+    for key, rollup in added.items():
+        changes[key].add(rollup)
+    for key, rollup in (removed or {}).items():
+        changes[key].add(rollup, -1)
+    keys = list(changes)
+    for start in range(0, len(keys), KEYS_PER_QUERY):
+        chunk = keys[start:start + KEYS_PER_QUERY]
+        stored = {(record.dimension, record.key, record.completed): record for record in session.scalars(
+            select(NotificationRollupRecord).where(tuple_(
+                NotificationRollupRecord.dimension, NotificationRollupRecord.key, NotificationRollupRecord.completed
+            ).in_(chunk)))}
+        for key in chunk:
+            rollup = changes[key]
+            record = stored.get(key)
+            if record is not None:
+                change = rollup
+                rollup = _from_record(record)
+                rollup.add(change)
+            if rollup.games <= 0:
+                if record is not None:
+                    session.delete(record)
+                continue
+            if record is None:
+                record = NotificationRollupRecord(dimension=rollup.dimension, key=rollup.key,
+                                                  completed=rollup.completed)
+                session.add(record)
+            record.games = rollup.games
+            record.completions = rollup.completions
+            record.first_sec_sum = rollup.first_sec_sum
+            record.first_sec_sketch = rollup.first_sec.state()
+
+
+def stored_rollups(session: Session, replay_ids: list[str]) -> dict[tuple[str, str, str], NotificationRollup]:
+    """Rollups of the full metadata currently stored for the replays, to be subtracted when it is replaced"""
+    records = session.scalars(
+        select(ReplayRecord)
+        .where(ReplayRecord.kind == MetadataKind.full, ReplayRecord.replay_id.in_(replay_ids))
+        .options(selectinload(ReplayRecord.players), selectinload(ReplayRecord.notifications)))
+    return rollup_replays(records)
+
+
+def get_rollup(dimension: str, key: str, completed: str = GAMES, engine=None) -> Optional[NotificationRollup]:
+    """A single rollup, read by its primary key"""
+    with Session(engine if engine is not None else get_engine()) as session:
+        record = session.get(NotificationRollupRecord, (dimension, key, completed))
+        return _from_record(record) if record is not None else None
+
+
+def get_rollups(dimension: str, key: str, engine=None) -> list[NotificationRollup]:
+    """Rollups of everything completed by a key, most often completed first; `GAMES` is included"""
+    with Session(engine if engine is not None else get_engine()) as session:
+        records = session.scalars(
+            select(NotificationRollupRecord)
+            .where(NotificationRollupRecord.dimension == dimension, NotificationRollupRecord.key == key)
+            .order_by(NotificationRollupRecord.games.desc()))
+        return [_from_record(record) for record in records]
+
+
+def rebuild_rollups(engine=None, batch_size: int = REBUILD_BATCH_SIZE) -> int:
+    """
+    Recomputes all rollups from the stored metadata, in one transaction; needed once for metadata written
+    before rollups existed. Returns the number of replays rolled up.
+    """
+    rolled_up = 0
+    with Session(engine if engine is not None else get_engine()) as session, session.begin():
+        lock_for_writing(session)
+        session.execute(delete(NotificationRollupRecord))
+        last_id = 0
+        while True:
+            records = session.scalars(
+                select(ReplayRecord)
+                .where(ReplayRecord.kind == MetadataKind.full, ReplayRecord.id > last_id)
+                .order_by(ReplayRecord.id).limit(batch_size)
+                .options(selectinload(ReplayRecord.players), selectinload(ReplayRecord.notifications))).all()
+            if not records:
+                break
+            apply_rollups(session, rollup_replays(records))
+            session.flush()
+            session.expunge_all()
+            last_id = records[-1].id
+            rolled_up += len(records)
+    return rolled_up
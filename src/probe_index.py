@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+from typing import Iterator, Optional
+
+# Adjacent ranges with the same status are merged only if they were checked within this time of each other,
+# so that check times stay meaningful for re-probing
+MERGE_WINDOW_SEC = 3600
+SAVE_EVERY = 1000
+
+
+class ProbeStatus:
+    downloaded = "downloaded"
+    extracted = "extracted"  # metadata was stored by `pipeline.py` without archiving the replay
+    missing = "missing"
+    failed = "failed"
+
+
+class ProbeIndex:
+    """
+    Persistent record of which replay IDs were probed on the replay server, as a sorted list of non-overlapping
+    [start, end] ranges with a status and the time they were checked.
+    Its size and the cost of walking it depend on the number of ranges, not on the number of IDs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.starts: list[int] = []
+        self.ranges: list[list] = []  # [start, end, status, checked_at]
+        self.unsaved = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                self.ranges = json.load(f)
+            self.starts = [r[0] for r in self.ranges]
+
+    def _can_merge(self, left: list, right: list) -> bool:
+        return (left[1] + 1 == right[0] and left[2] == right[2]
+                and abs(left[3] - right[3]) <= MERGE_WINDOW_SEC)
+
+    def _merge_at(self, i: int):
+        """Merges range `i` into range `i - 1`, if possible"""
+        if 0 < i < len(self.ranges) and self._can_merge(self.ranges[i - 1], self.ranges[i]):
+            left, right = self.ranges[i - 1], self.ranges.pop(i)
+            self.starts.pop(i)
+            left[1] = right[1]
+            left[3] = max(left[3], right[3])
+
+    def mark(self, replay_id: int, status: str, checked_at: Optional[float] = None):
+        checked_at = time.time() if checked_at is None else checked_at
+        with self.lock:
+            i = bisect_right(self.starts, replay_id) - 1
+            if i >= 0 and self.ranges[i][1] >= replay_id:
+                start, end, old_status, old_checked_at = self.ranges[i]
+                if old_status == status and abs(old_checked_at - checked_at) <= MERGE_WINDOW_SEC:
+                    self.ranges[i][3] = max(old_checked_at, checked_at)
+                    self._on_change()
+                    return
+                # Splitting the range around the ID
+                del self.ranges[i], self.starts[i]
+                parts = [[start, replay_id - 1, old_status, old_checked_at],
+                         [replay_id, replay_id, status, checked_at],
+                         [replay_id + 1, end, old_status, old_checked_at]]
+                parts = [p for p in parts if p[0] <= p[1]]
+                self.ranges[i:i] = parts
+                self.starts[i:i] = [p[0] for p in parts]
+                i += 1 if start < replay_id else 0
+            else:
+                i += 1
+                self.ranges.insert(i, [replay_id, replay_id, status, checked_at])
+                self.starts.insert(i, replay_id)
+            self._merge_at(i + 1)
+            self._merge_at(i)
+            self._on_change()
+
+    def _on_change(self):
+        self.unsaved += 1
+        if self.unsaved >= SAVE_EVERY:
+            self._save()
+
+    def get(self, replay_id: int) -> Optional[tuple[str, float]]:
+        """Returns status and check time of the ID, or None if it was never probed"""
+        with self.lock:
+            i = bisect_right(self.starts, replay_id) - 1
+            if i >= 0 and self.ranges[i][1] >= replay_id:
+                return self.ranges[i][2], self.ranges[i][3]
+            return None
+
+    def newest(self, status: str) -> Optional[int]:
+        """The highest ID probed with the status, if any"""
+        with self.lock:
+            for start, end, range_status, _ in reversed(self.ranges):
+                if range_status == status:
+                    return end
+            return None
+
+    def segments(self, from_id: int, to_id: int) -> Iterator[tuple[int, int, Optional[str], Optional[float]]]:
+        """
+        Covers [from_id, to_id] with (start, end, status, checked_at) segments;
+        IDs that were never probed are reported with None status.
+        """
+        with self.lock:
+            i = max(bisect_right(self.starts, from_id) - 1, 0)
+            overlapping = []
+            while i < len(self.ranges) and self.ranges[i][0] <= to_id:
+                if self.ranges[i][1] >= from_id:
+                    overlapping.append(tuple(self.ranges[i]))
+                i += 1
+        position = from_id
+        for start, end, status, checked_at in overlapping:
+            if start > position:
+                yield position, start - 1, None, None
+            yield max(start, position), min(end, to_id), status, checked_at
+            position = end + 1
+        if position <= to_id:
+            yield position, to_id, None, None
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.ranges, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        self.unsaved = 0
+
+    def save(self):
+        with self.lock:
+            self._save()
@@ -4,10 +4,12 @@ from typing import TypeVar, Any, Optional
 from uuid import uuid4
 
 import sqlalchemy
-from sqlalchemy import JSON, TIMESTAMP, create_engine, func, BLOB, Integer, ForeignKey
-from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped, Session, relationship
+from sqlalchemy import JSON, TIMESTAMP, create_engine, func, BLOB, Integer, ForeignKey, event, UniqueConstraint, \
+    Index, exists, and_, or_, not_, make_url
+from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped, Session, relationship, aliased
 
 _engine = None
+DB_LOCK_TIMEOUT_SEC = 60
 
 
 class Timestamp(int):
@@ -52,9 +54,237 @@ class ReplayDownload(Base):
     data: Mapped[bytes]
 
 
+class MetadataKind:
+    full = "full"
+    header = "header"
+
+
+class ReplayRecord(Base):
+    __tablename__ = "replay"
+    __table_args__ = (
+        UniqueConstraint("replay_id", "kind"),
+        Index("ix_replay_launched_at_ts", "launched_at_ts"),
+        Index("ix_replay_map", "map", "launched_at_ts"),
+        Index("ix_replay_game_type", "game_type", "launched_at_ts"),
+        Index("ix_replay_desync", "desync"),
+        # IDs of deleted records are never reused, so readers can keep a high-water mark of records they have read
+        {"sqlite_autoincrement": True},
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    replay_id: Mapped[str]
+    kind: Mapped[str] = mapped_column(default=MetadataKind.full)
+    metadata_version: Mapped[int]
+    title: Mapped[str]
+    launched_at_ts: Mapped[int]
+    duration: Mapped[Optional[float]]
+    map: Mapped[str]
+    game_type: Mapped[str]
+    desync: Mapped[Optional[bool]]
+
+    players: Mapped[list["ReplayPlayerRecord"]] = relationship(
+        cascade="all, delete-orphan", passive_deletes=True, order_by="ReplayPlayerRecord.id")
+    chat_messages: Mapped[list["ChatMessageRecord"]] = relationship(
+        cascade="all, delete-orphan", passive_deletes=True, order_by="ChatMessageRecord.id")
+    notifications: Mapped[list["NotificationRecord"]] = relationship(
+        cascade="all, delete-orphan", passive_deletes=True, order_by="NotificationRecord.id")
+    resource_transfer: Mapped[list["ResourceTransferRecord"]] = relationship(
+        cascade="all, delete-orphan", passive_deletes=True, order_by="ResourceTransferRecord.id")
+
+
+class ReplayPlayerRecord(Base):
+    __tablename__ = "replay_player"
+    # Player lookups are answered from the indexes alone, as they include the replay key
+    __table_args__ = (
+        Index("ix_replay_player_player_id", "player_id", "replay_pk"),
+        Index("ix_replay_player_nickname", "nickname", "replay_pk"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    replay_pk: Mapped[int] = mapped_column(ForeignKey("replay.id", ondelete="CASCADE"), index=True)
+    player_id: Mapped[str]
+    nickname: Mapped[str]
+    clan: Mapped[str]
+    country: Mapped[Optional[str]]
+    rating_mean: Mapped[float]
+    rating_std: Mapped[float]
+    rating: Mapped[float]
+    faction: Mapped[int]
+    team: Mapped[int]
+    army: Mapped[Optional[int]]  # empty for metadata extracted before it was stored
+
+
+class ChatMessageRecord(Base):
+    __tablename__ = "chat_message"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    replay_pk: Mapped[int] = mapped_column(ForeignKey("replay.id", ondelete="CASCADE"), index=True)
+    ally_only: Mapped[bool]
+    player: Mapped[str]
+    message: Mapped[str]
+    sent_at_sec: Mapped[float]
+
+
+class NotificationRecord(Base):
+    __tablename__ = "notification"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    replay_pk: Mapped[int] = mapped_column(ForeignKey("replay.id", ondelete="CASCADE"), index=True)
+    player: Mapped[str]
+    completed: Mapped[str]
+    sent_at_sec: Mapped[float]
+
+
+class ResourceTransferRecord(Base):
+    __tablename__ = "resource_transfer"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    replay_pk: Mapped[int] = mapped_column(ForeignKey("replay.id", ondelete="CASCADE"), index=True)
+    from_player: Mapped[str]
+    to_player: Mapped[Optional[int]]  # army number; read back as a float from databases created before
+    mass: Mapped[float]
+    energy: Mapped[float]
+    sent_at_sec: Mapped[float]
+
+
+def preferred_records():
+    """Filter selecting full metadata of every replay, or its header-only record if there is no full metadata"""
+    full = aliased(ReplayRecord)
+    has_full = exists().where(full.replay_id == ReplayRecord.replay_id, full.kind == MetadataKind.full)
+    return or_(ReplayRecord.kind == MetadataKind.full,
+               and_(ReplayRecord.kind == MetadataKind.header, not_(has_full)))
+
+
+def launched_within(since_ts: Optional[int], until_ts: Optional[int]) -> list:
+    """Conditions selecting replays launched within [since_ts, until_ts); None means unbounded"""
+    conditions = []
+    if since_ts is not None:
+        conditions.append(ReplayRecord.launched_at_ts >= since_ts)
+    if until_ts is not None:
+        conditions.append(ReplayRecord.launched_at_ts < until_ts)
+    return conditions
+
+
+class ExtractionManifestRecord(Base):
+    """Fingerprint of the source replay each metadata record was extracted from"""
+    __tablename__ = "extraction_manifest"
+    replay_id: Mapped[str] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(primary_key=True)
+    source_size: Mapped[int]
+    source_token: Mapped[int]
+    metadata_version: Mapped[int]
+
+
+class ExtractorResultRecord(Base):
+    """Result of an optional body extractor (see `src/body_extractors.py`), versioned per extractor"""
+    __tablename__ = "extractor_result"
+    replay_id: Mapped[str] = mapped_column(primary_key=True)
+    extractor: Mapped[str] = mapped_column(primary_key=True)
+    version: Mapped[int]
+    data: Mapped[Optional[dict[str, Any]]]
+
+
+class NotificationRollupRecord(Base):
+    """
+    Completion notification statistics of a player, faction, map or rating bucket, kept up to date as metadata is
+    written (see `src/notification_rollups.py`)
+    """
+    __tablename__ = "notification_rollup"
+    dimension: Mapped[str] = mapped_column(primary_key=True)
+    key: Mapped[str] = mapped_column(primary_key=True)
+    completed: Mapped[str] = mapped_column(primary_key=True)
+    games: Mapped[int]  # player-games in which it was completed
+    completions: Mapped[int]
+    first_sec_sum: Mapped[float]
+    first_sec_sketch: Mapped[dict[str, Any]]  # bucket counts of `QuantileSketch`
+
+
+class WorkChunkRecord(Base):
+    """Range of replay IDs that workers of a job claim with expiring leases (see `src/work_chunks.py`)"""
+    __tablename__ = "work_chunk"
+    __table_args__ = (UniqueConstraint("job", "start_id"),)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    job: Mapped[str]
+    start_id: Mapped[int]
+    end_id: Mapped[int]
+    done: Mapped[bool] = mapped_column(default=False)
+    checkpoint: Mapped[Optional[int]]  # last processed ID
+    owner: Mapped[Optional[str]]
+    lease_expires_at: Mapped[Optional[float]]
+    claims: Mapped[int] = mapped_column(default=0)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers and a writer work concurrently, but only between processes of one host
+    # (see `create_shared_engine` for databases shared between hosts)
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def _set_shared_sqlite_pragmas(dbapi_connection, connection_record):
+    # A rollback journal, as WAL needs memory shared by the processes; locking is left to the file system
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=DELETE")
+    cursor.close()
+
+
+def create_shared_engine(url: str, tables: list[type[Base]]):
+    """
+    Engine of a database that processes on several hosts share, with only the given tables created in it:
+    a database server (e.g. `postgresql://host/replays`), or an SQLite file on shared storage, which is used
+    with a rollback journal instead of WAL. The shared file system must support file locks.
+    """
+    if make_url(url).get_backend_name() == "sqlite":
+        engine = create_engine(url, connect_args={"timeout": DB_LOCK_TIMEOUT_SEC})
+        event.listen(engine, "connect", _set_shared_sqlite_pragmas)
+    else:
+        engine = create_engine(url)
+    Base.metadata.create_all(engine, tables=[table.__table__ for table in tables])
+    return engine
+
+
+def lock_for_writing(session: Session):
+    """
+    Takes the database write lock for the rest of the session's transaction. pysqlite starts transactions only
+    before the first write, so transactions that read what they are about to update (such as rollups) must take
+    the lock first, or concurrent writers read the same rows and overwrite each other's updates.
+    """
+    connection = session.connection()
+    if connection.dialect.name == "sqlite" and not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+class SchemaMismatchError(Exception):
+    """Raised when an existing database lacks columns that cannot be added in place"""
+
+
+def _migrate_columns(engine):
+    """
+    create_all skips existing tables, so columns added to a table later are added here.
+    Only nullable columns can be added in place; their values stay empty for existing rows.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing = [column for column in table.columns if column.name not in existing]
+        not_nullable = [column.name for column in missing if not column.nullable]
+        if not_nullable:
+            raise SchemaMismatchError(f"Table {table.name} lacks columns {', '.join(not_nullable)}, which cannot be "
+                                      f"added to existing rows; move replays.sqlite3 away and extract again")
+        with engine.begin() as connection:
+            for column in missing:
+                column_type = column.type.compile(engine.dialect)
+                connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+
+
 def get_engine():
     global _engine
     if _engine is None:
-        _engine = create_engine("sqlite:///replays.sqlite3", echo=False)
+        # Several processes may share the database (see `sharded.py`), so writers wait for each other's locks
+        _engine = create_engine("sqlite:///replays.sqlite3", echo=False, connect_args={"timeout": DB_LOCK_TIMEOUT_SEC})
+        event.listen(_engine, "connect", _set_sqlite_pragmas)
         Base.metadata.create_all(_engine)
+        _migrate_columns(_engine)
+        # create_all skips existing tables, so indexes added later are created separately
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(_engine, checkfirst=True)
     return _engine
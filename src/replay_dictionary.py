@@ -0,0 +1,68 @@
+import json
+import os
+from glob import glob
+from typing import Iterable, Optional
+
+import zstandard
+
+DICTIONARY_DIR = "data/dictionaries/"
+DICTIONARY_EXTENSION = ".zdict"
+DEFAULT_DICTIONARY_SIZE = 112 * 1024
+# Replays are cut into samples of this size for training; the trainer works best on many small samples
+SAMPLE_CHUNK_SIZE = 64 * 1024
+MAX_SAMPLE_CHUNKS = 16  # per replay, from its start, where headers and early build orders repeat the most
+RECOMPRESSION_LEVEL = 19
+
+_dictionaries = {}
+
+
+class Compression:
+    """Values of `compression` in `.fafreplay` file headers"""
+    zlib = "zlib"  # base64 of Qt's qCompress: 4 bytes of big-endian decompressed size, then zlib data
+    zstd = "zstd"
+    zstd_dict = "zstd_dict"  # recompressed with the dictionary named by `dictionary` in the header
+
+
+def train_dictionary(replays: Iterable[bytes], size: int = DEFAULT_DICTIONARY_SIZE) -> zstandard.ZstdCompressionDict:
+    """Trains a dictionary on decompressed `.scfareplay` data"""
+    samples = []
+    for data in replays:
+        chunks = range(0, min(len(data), SAMPLE_CHUNK_SIZE * MAX_SAMPLE_CHUNKS), SAMPLE_CHUNK_SIZE)
+        samples.extend(bytes(data[start:start + SAMPLE_CHUNK_SIZE]) for start in chunks)
+    return zstandard.train_dictionary(size, samples)
+
+
+def save_dictionary(dictionary: zstandard.ZstdCompressionDict, directory: str = DICTIONARY_DIR) -> int:
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{dictionary.dict_id()}{DICTIONARY_EXTENSION}")
+    with open(path + ".tmp", "wb") as f:
+        f.write(dictionary.as_bytes())
+    os.replace(path + ".tmp", path)
+    return dictionary.dict_id()
+
+
+def get_dictionary(dictionary_id: int, directory: str = DICTIONARY_DIR) -> zstandard.ZstdCompressionDict:
+    """Dictionaries are loaded once; replays compressed with a dictionary cannot be read without it"""
+    key = (directory, dictionary_id)
+    if key not in _dictionaries:
+        with open(os.path.join(directory, f"{dictionary_id}{DICTIONARY_EXTENSION}"), "rb") as f:
+            _dictionaries[key] = zstandard.ZstdCompressionDict(f.read())
+    return _dictionaries[key]
+
+
+def latest_dictionary_id(directory: str = DICTIONARY_DIR) -> Optional[int]:
+    paths = glob(os.path.join(directory, "*" + DICTIONARY_EXTENSION))
+    if not paths:
+        return None
+    return int(os.path.basename(max(paths, key=os.path.getmtime))[:-len(DICTIONARY_EXTENSION)])
+
+
+def encode_fafreplay(file_header: dict, scfa: bytes, dictionary: zstandard.ZstdCompressionDict,
+                     level: int = RECOMPRESSION_LEVEL) -> bytes:
+    """
+    Encodes `.scfareplay` data as a `.fafreplay` file compressed with the dictionary.
+    The frame keeps the decompressed size, so that readers allocate their output buffer once.
+    """
+    header = dict(file_header, compression=Compression.zstd_dict, dictionary=dictionary.dict_id())
+    compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary, write_content_size=True)
+    return json.dumps(header).encode() + b"\n" + compressor.compress(scfa)
@@ -0,0 +1,167 @@
+from array import array
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+TICKS_PER_SEC = 10
+NO_RECEIVER = -1  # army number stored for resource transfers without a receiver
+
+
+@dataclass(frozen=True)
+class ChatMessage:
+    ally_only: bool
+    player: str
+    message: str
+    sent_at_sec: float
+
+
+@dataclass(frozen=True)
+class CompletionNotification:
+    player: str
+    completed: str
+    sent_at_sec: float
+
+
+@dataclass(frozen=True)
+class ResourceSent:
+    from_player: str
+    to_player: Optional[int]  # army number of the receiver
+    mass: float
+    energy: float
+    sent_at_sec: float
+
+
+def ticks_to_sec(tick: int) -> float:
+    return tick / TICKS_PER_SEC
+
+
+def sec_to_ticks(sent_at_sec: float) -> int:
+    return round(sent_at_sec * TICKS_PER_SEC)
+
+
+class NameTable:
+    """Strings of one replay (player names, completed units), each stored once and referred to by index"""
+    __slots__ = ("names", "index")
+
+    def __init__(self, names=()):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def intern(self, name: str) -> int:
+        i = self.index.get(name)
+        if i is None:
+            i = self.index[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def __getitem__(self, i: int) -> str:
+        return self.names[i]
+
+    def __getstate__(self):
+        return self.names
+
+    def __setstate__(self, names):
+        self.__init__(names)
+
+
+class EventTable:
+    """
+    Events of one replay stored column-wise, with names as indices into a shared `NameTable` and times in ticks.
+    Iterating or indexing yields the same event objects as before (`ChatMessage`, ...), built on demand.
+    """
+    __slots__ = ("names", "ticks")
+
+    def __init__(self, names: Optional[NameTable] = None):
+        self.names = names if names is not None else NameTable()
+        self.ticks = array("q")
+
+    def __len__(self) -> int:
+        return len(self.ticks)
+
+    def _event(self, i: int):
+        raise NotImplementedError
+
+    def __getitem__(self, i: int):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        return self._event(i % len(self))
+
+    def __iter__(self) -> Iterator:
+        return (self._event(i) for i in range(len(self)))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (EventTable, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({list(self)!r})"
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for cls in type(self).__mro__ for slot in getattr(cls, "__slots__", ())}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+
+class ChatMessages(EventTable):
+    __slots__ = ("players", "ally_only", "messages")
+
+    def __init__(self, names: Optional[NameTable] = None):
+        super().__init__(names)
+        self.players = array("I")
+        self.ally_only = array("b")
+        self.messages: list[str] = []
+
+    def append(self, ally_only: bool, player: str, message: str, tick: int):
+        self.players.append(self.names.intern(player))
+        self.ally_only.append(ally_only)
+        self.messages.append(message)
+        self.ticks.append(tick)
+
+    def _event(self, i: int) -> ChatMessage:
+        return ChatMessage(ally_only=bool(self.ally_only[i]), player=self.names[self.players[i]],
+                           message=self.messages[i], sent_at_sec=ticks_to_sec(self.ticks[i]))
+
+
+class CompletionNotifications(EventTable):
+    __slots__ = ("players", "completed")
+
+    def __init__(self, names: Optional[NameTable] = None):
+        super().__init__(names)
+        self.players = array("I")
+        self.completed = array("I")
+
+    def append(self, player: str, completed: str, tick: int):
+        self.players.append(self.names.intern(player))
+        self.completed.append(self.names.intern(completed))
+        self.ticks.append(tick)
+
+    def _event(self, i: int) -> CompletionNotification:
+        return CompletionNotification(player=self.names[self.players[i]], completed=self.names[self.completed[i]],
+                                      sent_at_sec=ticks_to_sec(self.ticks[i]))
+
+
+class ResourceTransfers(EventTable):
+    __slots__ = ("players", "to_players", "mass", "energy")
+
+    def __init__(self, names: Optional[NameTable] = None):
+        super().__init__(names)
+        self.players = array("I")
+        self.to_players = array("q")  # army number of the receiver, `NO_RECEIVER` if missing
+        self.mass = array("d")
+        self.energy = array("d")
+
+    def append(self, from_player: str, to_player, mass: float, energy: float, tick: int):
+        self.players.append(self.names.intern(from_player))
+        # Sim callbacks pass army numbers as Lua numbers, which are floats
+        self.to_players.append(NO_RECEIVER if to_player is None else int(to_player))
+        self.mass.append(mass)
+        self.energy.append(energy)
+        self.ticks.append(tick)
+
+    def _event(self, i: int) -> ResourceSent:
+        to_player = self.to_players[i]
+        return ResourceSent(from_player=self.names[self.players[i]],
+                            to_player=None if to_player == NO_RECEIVER else to_player,
+                            mass=self.mass[i], energy=self.energy[i], sent_at_sec=ticks_to_sec(self.ticks[i]))
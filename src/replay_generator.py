@@ -0,0 +1,124 @@
+import json
+import random
+import struct
+from dataclasses import dataclass
+
+import zstandard
+from fafreplay import commands
+
+TICKS_PER_SEC = 10
+FACTORY_NOTIFICATIONS = ["T2 Land Factory", "T3 Land Factory", "T2 Air Factory", "T3 Air Factory"]
+EXPERIMENTAL_NOTIFICATIONS = ["Experimental construction", "T3 Artillery construction"]
+
+
+@dataclass
+class ReplaySpec:
+    """Shape of a synthetic replay"""
+    players: int = 8
+    minutes: float = 20.0
+    chat_messages: int = 100
+    notifications: int = 20
+    resource_shares: int = 200
+    commands_per_tick: int = 2  # other commands of every player in every tick, skipped by the body parser
+    seed: int = 0
+
+
+def _lua(value) -> bytes:
+    """Encodes a value in the Lua serialization format of replay commands and headers"""
+    if isinstance(value, bool):
+        return b"\x03" + (b"\x01" if value else b"\x00")
+    if isinstance(value, (int, float)):
+        return b"\x00" + struct.pack("<f", value)
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b"\x01" + value + b"\x00"
+    if value is None:
+        return b"\x02"
+    if isinstance(value, dict):
+        return b"\x04" + b"".join(_lua(k) + _lua(v) for k, v in value.items()) + b"\x05"
+    raise TypeError(f"Cannot encode {value!r}")
+
+
+def _cstr(value: str) -> bytes:
+    return value.encode() + b"\x00"
+
+
+def _command(command_type: int, payload: bytes = b"") -> bytes:
+    return struct.pack("<BH", command_type, len(payload) + 3) + payload
+
+
+def _header(spec: ReplaySpec, names: list[str], rnd: random.Random) -> bytes:
+    map_name = f"generated_map_{spec.seed}"
+    map_file = f"/maps/{map_name}/{map_name}.scmap"
+    ratings = {name: float(rnd.randrange(0, 2500, 100)) for name in names}
+    scenario = {"Options": {"Ratings": ratings, "ClanTags": {name: "" for name in names}, "Share": "FullShare",
+                            "Victory": "demoralization", "ScenarioFile": map_file}}
+    header = _cstr("Supreme Commander v1.50.3779") + _cstr("\r\n") + _cstr(f"Replay v1.9\r\n{map_file}") \
+        + _cstr("\r\n\x1a")
+    mods = _lua({})
+    header += struct.pack("<I", len(mods)) + mods
+    scenario = _lua(scenario)
+    header += struct.pack("<I", len(scenario)) + scenario
+    header += bytes([len(names)])
+    for i, name in enumerate(names):
+        header += _cstr(name) + struct.pack("<i", i)
+    header += b"\x00" + bytes([len(names)])
+    for i, name in enumerate(names):
+        army = _lua({"PlayerName": name, "Human": True, "OwnerID": str(1000 + i), "Faction": 1 + i % 4,
+                     "MEAN": ratings[name] + 200.0, "DEV": 75.0, "Team": 2 + i % 2, "Country": "de",
+                     "PlayerClan": ""})
+        header += struct.pack("<I", len(army)) + army + bytes([i]) + b"\xff"
+    header += struct.pack("<I", spec.seed)
+    return header
+
+
+def _callback(sender: str, args: dict) -> bytes:
+    return _command(commands.LuaSimCallback,
+                    _cstr("GiveResourcesToPlayer") + _lua(dict(args, Sender=sender)) + struct.pack("<I", 0))
+
+
+def generate_scfa(spec: ReplaySpec) -> bytes:
+    """Generates the uncompressed `.scfareplay` data of a game"""
+    rnd = random.Random(spec.seed)
+    names = [f"player_{spec.seed}_{i}" for i in range(spec.players)]
+    ticks = max(int(spec.minutes * 60 * TICKS_PER_SEC), 1)
+    events: dict[int, list[bytes]] = {}
+
+    def add(event: bytes):
+        events.setdefault(rnd.randrange(ticks), []).append(event)
+
+    for i in range(spec.chat_messages):
+        to = rnd.choice(["all", "allies"])
+        add(_callback(rnd.choice(names), {"Msg": {"text": f"gl hf {i}", "to": to, "Chat": True}, "To": -1.0}))
+    for i in range(spec.notifications):
+        completed = rnd.choice(FACTORY_NOTIFICATIONS if i % 2 else EXPERIMENTAL_NOTIFICATIONS)
+        add(_callback(rnd.choice(names), {"Msg": {"text": f"{completed} done!", "to": "notify", "Chat": True},
+                                          "To": -1.0}))
+    for _ in range(spec.resource_shares):
+        add(_callback(rnd.choice(names), {"Mass": float(rnd.randrange(10, 1000)),
+                                          "Energy": float(rnd.randrange(0, 5000)),
+                                          "To": float(rnd.randrange(spec.players) + 1)}))
+
+    body = []
+    advance = _command(commands.Advance, struct.pack("<I", 1))
+    sources = [_command(commands.SetCommandSource, bytes([i])) for i in range(spec.players)]
+    for tick in range(ticks):
+        for source in sources:
+            body.append(source)
+            for _ in range(spec.commands_per_tick):
+                body.append(_command(commands.DestroyEntity, struct.pack("<I", tick)))
+        for event in events.get(tick, ()):
+            body.append(sources[0])
+            body.append(event)
+        if tick % 50 == 0:
+            body.append(_command(commands.VerifyChecksum, bytes(16) + struct.pack("<I", tick)))
+        body.append(advance)
+    return _header(spec, names, rnd) + b"".join(body)
+
+
+def generate_fafreplay(spec: ReplaySpec, replay_id: int = 1) -> bytes:
+    """Generates a `.fafreplay` file: a JSON header line followed by the zstd-compressed `.scfareplay` data"""
+    file_header = {"uid": replay_id, "title": f"Generated game {replay_id}", "launched_at": 1700000000 + replay_id,
+                   "game_type": "0", "featured_mod": "faf", "compression": "zstd", "version": 2}
+    return json.dumps(file_header).encode() + b"\n" + zstandard.ZstdCompressor().compress(generate_scfa(spec))
@@ -0,0 +1,207 @@
+import mmap
+import os
+import struct
+import threading
+from typing import Iterator, Optional
+
+# Pack starts with a header holding a random pack UID; index files refer to it, so a stale index is never used
+PACK_HEADER = struct.Struct("<8sQ")
+PACK_MAGIC = b"FAFPACK1"
+# Every record in the pack is prefixed with its replay ID and length, so that the index can be rebuilt from the pack
+RECORD_HEADER = struct.Struct("<QI")
+# Index is a header (magic, pack UID, indexed pack size), followed by (replay ID, offset, length) entries,
+# sorted by replay ID
+INDEX_HEADER = struct.Struct("<8sQQ")
+INDEX_ENTRY = struct.Struct("<QQI")
+INDEX_MAGIC = b"FAFPIDX1"
+
+
+class ReplayPack:
+    """
+    Append-only archive of replays: a single pack file with replay data, and a compact index file mapping replay IDs
+    to (offset, length) in the pack. Both are read through mmap; the index is binary-searched in place.
+
+    Writes are appended to the pack right away, and kept in memory until `flush` rewrites the index.
+    If the process dies before that, records past the indexed end of the pack are recovered when the pack is opened.
+    Refreshed replays are appended again, and the older copy becomes garbage until the pack is compacted.
+    Only one process may write to a pack at a time.
+    """
+
+    def __init__(self, pack_path: str, index_path: str):
+        self.pack_path = pack_path
+        self.index_path = index_path
+        self.lock = threading.RLock()
+        self.pending: dict[int, tuple[int, int]] = {}
+        self._index = None
+        self._index_size = 0
+        self._data = None
+        self._pack_file = open(pack_path, "ab")
+        self.pack_uid = self._read_pack_uid()
+        self._load_index()
+
+    def _read_pack_uid(self) -> int:
+        if self._pack_file.tell() == 0:
+            pack_uid = int.from_bytes(os.urandom(8), "little")
+            self._pack_file.write(PACK_HEADER.pack(PACK_MAGIC, pack_uid))
+            self._pack_file.flush()
+            return pack_uid
+        with open(self.pack_path, "rb") as f:
+            magic, pack_uid = PACK_HEADER.unpack(f.read(PACK_HEADER.size))
+        if magic != PACK_MAGIC:
+            raise ValueError(f"{self.pack_path} is not a replay pack")
+        return pack_uid
+
+    def _load_index(self):
+        indexed_until = PACK_HEADER.size
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, pack_uid, index_until = INDEX_HEADER.unpack_from(index, 0)
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"{self.index_path} is not a replay pack index")
+            if pack_uid == self.pack_uid:
+                self._index = index
+                self._index_size = (len(index) - INDEX_HEADER.size) // INDEX_ENTRY.size
+                indexed_until = index_until
+            # Otherwise index belongs to another pack (e.g. compaction was interrupted), and it is rebuilt
+        self._recover(indexed_until)
+
+    def _recover(self, offset: int):
+        """
+        Adds records appended after the last index flush to pending entries.
+        A record torn by a crash is cut off, so that new records are appended right after the last complete one.
+        """
+        pack_size = os.path.getsize(self.pack_path)
+        if offset >= pack_size:
+            return
+        data = self._get_data(pack_size)
+        while offset + RECORD_HEADER.size <= pack_size:
+            replay_id, length = RECORD_HEADER.unpack_from(data, offset)
+            if offset + RECORD_HEADER.size + length > pack_size:
+                break  # truncated record
+            self.pending[replay_id] = (offset + RECORD_HEADER.size, length)
+            offset += RECORD_HEADER.size + length
+        if offset < pack_size:
+            self._data.close()
+            self._data = None
+            self._pack_file.truncate(offset)
+            self._pack_file.seek(0, os.SEEK_END)
+
+    def _get_data(self, until: int):
+        if self._data is None or len(self._data) < until:
+            # Pack has grown since it was mapped, remapping it. Old maps stay alive while views of them exist
+            with open(self.pack_path, "rb") as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._data
+
+    def _find(self, replay_id: int) -> Optional[tuple[int, int]]:
+        if replay_id in self.pending:
+            return self.pending[replay_id]
+        lo, hi = 0, self._index_size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_id, offset, length = INDEX_ENTRY.unpack_from(self._index, INDEX_HEADER.size + mid * INDEX_ENTRY.size)
+            if entry_id == replay_id:
+                return offset, length
+            if entry_id < replay_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _iter_index(self) -> Iterator[tuple[int, int, int]]:
+        for i in range(self._index_size):
+            yield INDEX_ENTRY.unpack_from(self._index, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+
+    def has(self, replay_id: int) -> bool:
+        with self.lock:
+            return self._find(replay_id) is not None
+
+    def locate(self, replay_id: int) -> Optional[tuple[int, int]]:
+        """Returns (offset, length) of the latest copy of the replay"""
+        with self.lock:
+            return self._find(replay_id)
+
+    def view(self, replay_id: int) -> Optional[memoryview]:
+        """Returns a zero-copy view of the replay data, which must be released before the pack is closed"""
+        with self.lock:
+            location = self._find(replay_id)
+            if location is None:
+                return None
+            offset, length = location
+            if length == 0:
+                return memoryview(b'')
+            with memoryview(self._get_data(offset + length)) as data:
+                return data[offset:offset + length]
+
+    def get(self, replay_id: int) -> Optional[bytes]:
+        view = self.view(replay_id)
+        if view is None:
+            return None
+        with view:
+            return bytes(view)
+
+    def write(self, replay_id: int, data: bytes):
+        with self.lock:
+            self._pack_file.write(RECORD_HEADER.pack(replay_id, len(data)))
+            offset = self._pack_file.tell()
+            self._pack_file.write(data)
+            # Written through to the OS, so that the record survives a crash of this process
+            self._pack_file.flush()
+            self.pending[replay_id] = (offset, len(data))
+            return len(data)
+
+    def ids(self) -> list[int]:
+        return [replay_id for replay_id, _, _ in self.entries()]
+
+    def entries(self) -> list[tuple[int, int, int]]:
+        """Returns all live (replay ID, offset, length) entries, sorted by replay ID"""
+        with self.lock:
+            entries = {replay_id: (offset, length) for replay_id, offset, length in self._iter_index()}
+            entries.update(self.pending)
+            return [(replay_id, offset, length) for replay_id, (offset, length) in sorted(entries.items())]
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            self._pack_file.flush()
+            os.fsync(self._pack_file.fileno())
+            entries = self.entries()
+            _write_index(self.index_path, entries, self.pack_uid, self._pack_file.tell())
+            self.pending.clear()
+            self._index = None
+            self._index_size = 0
+            self._load_index()
+
+    def close(self):
+        self.flush()
+        self._pack_file.close()
+
+
+def _write_index(index_path: str, entries: list[tuple[int, int, int]], pack_uid: int, indexed_until: int):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, pack_uid, indexed_until))
+        for entry in entries:
+            f.write(INDEX_ENTRY.pack(*entry))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, index_path)
+
+
+def compact_pack(pack: ReplayPack) -> ReplayPack:
+    """Rewrites the pack with only the latest copy of every replay, in replay ID order. Returns the reopened pack."""
+    pack.flush()
+    tmp_pack_path, tmp_index_path = pack.pack_path + ".compact", pack.index_path + ".compact"
+    if os.path.exists(tmp_pack_path):
+        os.remove(tmp_pack_path)
+    compacted = ReplayPack(tmp_pack_path, tmp_index_path)
+    for replay_id, _, _ in pack.entries():
+        compacted.write(replay_id, pack.get(replay_id))
+    compacted.close()
+    pack.close()
+    # If interrupted between these, pack UIDs do not match, and the index gets rebuilt from the pack
+    os.replace(tmp_pack_path, pack.pack_path)
+    os.replace(tmp_index_path, pack.index_path)
+    return ReplayPack(pack.pack_path, pack.index_path)
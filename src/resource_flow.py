@@ -0,0 +1,290 @@
+import os
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+from scipy import sparse
+
+from src.columnar import ColumnarTables
+
+RESOURCE_FLOW_FILE = "data/resource_flow.npz"
+BUCKET_SEC = 60  # share curves are per minute of the game
+UNKNOWN_PLAYER = -1
+
+FLOW_COLUMNS = ("replay_id", "from_player", "to_player", "mass", "energy", "transfers")
+CURVE_COLUMNS = ("replay_id", "bucket", "mass", "energy")
+
+
+class Resource:
+    mass = "mass"
+    energy = "energy"
+
+
+class Role:
+    feeder = "feeder"
+    receiver = "receiver"
+
+
+@dataclass
+class ShareCurve:
+    bucket_sec: int
+    games: int  # games the curve sums over, including those without transfers
+    mass: np.ndarray  # shared in each bucket, summed over the games
+    energy: np.ndarray
+
+
+@dataclass
+class FlowProfile:
+    player_id: int
+    mass_sent: float
+    mass_received: float
+    energy_sent: float
+    energy_received: float
+    transfers_sent: int
+    transfers_received: int
+    feeder_ratio: float  # share of the player's mass flow that was sent: 1 for pure feeders, 0 for pure receivers
+
+
+def _empty_columns(columns: Iterable[str]) -> dict[str, np.ndarray]:
+    return {column: np.zeros(0, dtype=np.float64 if column in (Resource.mass, Resource.energy) else np.int64)
+            for column in columns}
+
+
+def _group_sum(keys: list[np.ndarray], values: list[np.ndarray]):
+    """Unique rows of the key columns, with values summed and rows counted per unique row"""
+    if not len(keys[0]):
+        return [k[:0] for k in keys], [v[:0].astype(np.float64) for v in values], np.zeros(0, dtype=np.int64)
+    order = np.lexsort(keys[::-1])
+    keys = [k[order] for k in keys]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = np.any([k[1:] != k[:-1] for k in keys], axis=0)
+    groups = np.cumsum(starts) - 1
+    sums = [np.bincount(groups, weights=value[order], minlength=groups[-1] + 1) for value in values]
+    return [k[starts] for k in keys], sums, np.bincount(groups)
+
+
+def _resolve_players(tables: ColumnarTables, event_replays: np.ndarray, senders: np.ndarray,
+                     receivers: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Player IDs of senders (nickname codes) and receivers (army numbers) of transfers, `UNKNOWN_PLAYER` if not found.
+    Transfers to AI armies, and those of metadata extracted before army numbers were stored, are not resolved.
+    """
+    players = tables.tables["players"]
+    player_replays = np.asarray(players["replay_idx"], dtype=np.int64)
+    player_ids = np.asarray(players["player_id"], dtype=np.int64)
+    if not len(player_ids):
+        unknown = np.full(len(event_replays), UNKNOWN_PLAYER, dtype=np.int64)
+        return unknown, unknown.copy()
+
+    def join(player_keys: np.ndarray, width: int, event_keys: np.ndarray) -> np.ndarray:
+        """Player IDs of events, matching their keys to those of players of the same replay"""
+        keys = player_replays * width + player_keys
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        event_keys = event_replays * width + event_keys
+        positions = np.minimum(np.searchsorted(sorted_keys, event_keys), len(sorted_keys) - 1)
+        return np.where(sorted_keys[positions] == event_keys, player_ids[order[positions]], UNKNOWN_PLAYER)
+
+    from_ids = join(np.asarray(players["nickname"], dtype=np.int64), len(tables.dictionaries["player"]), senders)
+    # Army numbers start at 1; players without a stored army number get 0, which no resolved transfer refers to
+    armies = np.maximum(np.asarray(players["army"], dtype=np.int64), 0)
+    width = int(max(armies.max(initial=0), receivers.max(initial=0))) + 1
+    to_ids = np.where(receivers >= 1, join(armies, width, np.maximum(receivers, 0)), UNKNOWN_PLAYER)
+    return from_ids, to_ids
+
+
+class ResourceFlows:
+    """
+    Resource transfers aggregated per game: directed flows between players (`flows`) and amounts shared per
+    minute of the game (`curves`), as flat columns. Games are added incrementally from the columnar tables
+    (see `src/columnar.py`), so updates only cost work for new games and for games whose metadata was written again,
+    which replace their earlier rows. `last_record_id` is the newest metadata record seen, so that updates can read
+    an export of only the records written since (`export_columnar(since_record_id=...)`).
+    Cross-game matrices, share curves and feeder/receiver profiles are derived from these columns.
+    """
+
+    def __init__(self):
+        self.replay_ids = np.zeros(0, dtype=np.int64)  # added replays, with or without transfers
+        self.record_ids = np.zeros(0, dtype=np.int64)  # metadata record each of them was computed from
+        self.replay_unresolved = np.zeros(0, dtype=np.int64)  # unresolved transfers of each of them
+        self.flows = _empty_columns(FLOW_COLUMNS)
+        self.curves = _empty_columns(CURVE_COLUMNS)
+        self.last_record_id = 0
+
+    @property
+    def unresolved(self) -> int:
+        """Transfers whose sender or receiver is not a player of the game"""
+        return int(self.replay_unresolved.sum())
+
+    def _stored_record_ids(self, replay_ids: np.ndarray) -> np.ndarray:
+        """Record IDs the replays were computed from, -1 for replays that were not added"""
+        if not len(self.replay_ids):
+            return np.full(len(replay_ids), -1, dtype=np.int64)
+        order = np.argsort(self.replay_ids)
+        positions = np.minimum(np.searchsorted(self.replay_ids[order], replay_ids), len(order) - 1)
+        rows = order[positions]
+        return np.where(self.replay_ids[rows] == replay_ids, self.record_ids[rows], -1)
+
+    def _remove(self, replay_ids: np.ndarray):
+        """Drops rows of the replays"""
+        kept = ~np.isin(self.replay_ids, replay_ids)
+        self.replay_ids, self.record_ids = self.replay_ids[kept], self.record_ids[kept]
+        self.replay_unresolved = self.replay_unresolved[kept]
+        for table in (self.flows, self.curves):
+            kept = ~np.isin(table["replay_id"], replay_ids)
+            for name in table:
+                table[name] = table[name][kept]
+
+    def update(self, tables: ColumnarTables) -> int:
+        """
+        Adds replays of the columnar tables that were not added yet, and replaces those that were added from another
+        metadata record. Returns the number of added or replaced replays.
+        """
+        replays = tables.tables["replays"]
+        replay_ids = np.asarray(replays["replay_id"], dtype=np.int64)
+        record_ids = np.asarray(replays["record_id"], dtype=np.int64)
+        self.last_record_id = max(self.last_record_id, int(record_ids.max(initial=0)))
+        stored = self._stored_record_ids(replay_ids)
+        changed = (stored != -1) & (stored != record_ids)
+        # Header-only records have no transfers; they are added once their full metadata is extracted
+        new = np.asarray(replays["has_body"], dtype=bool) & ((stored == -1) | changed)
+        if not new.any() and not changed.any():
+            return 0
+        self._remove(replay_ids[changed])
+
+        transfers = tables.tables["resource_transfer"]
+        event_replays = np.asarray(transfers["replay_idx"], dtype=np.int64)
+        selected = new[event_replays]
+        event_replays = event_replays[selected]
+        mass = np.asarray(transfers["mass"], dtype=np.float64)[selected]
+        energy = np.asarray(transfers["energy"], dtype=np.float64)[selected]
+        sent_at_sec = np.asarray(transfers["sent_at_sec"], dtype=np.float64)[selected]
+        from_ids, to_ids = _resolve_players(tables, event_replays,
+                                            np.asarray(transfers["from_player"], dtype=np.int64)[selected],
+                                            np.asarray(transfers["to_player"], dtype=np.int64)[selected])
+        event_replay_ids = replay_ids[event_replays]
+
+        resolved = (from_ids != UNKNOWN_PLAYER) & (to_ids != UNKNOWN_PLAYER)
+        unresolved = np.bincount(event_replays[~resolved], minlength=len(replay_ids))
+        (flow_replays, senders, receivers), (flow_mass, flow_energy), counts = _group_sum(
+            [event_replay_ids[resolved], from_ids[resolved], to_ids[resolved]], [mass[resolved], energy[resolved]])
+        self._append(self.flows, [flow_replays, senders, receivers, flow_mass, flow_energy, counts])
+
+        buckets = np.floor(sent_at_sec / BUCKET_SEC).astype(np.int64)
+        (curve_replays, curve_buckets), (curve_mass, curve_energy), _ = _group_sum(
+            [event_replay_ids, buckets], [mass, energy])
+        self._append(self.curves, [curve_replays, curve_buckets, curve_mass, curve_energy])
+
+        self.replay_ids = np.concatenate([self.replay_ids, replay_ids[new]])
+        self.record_ids = np.concatenate([self.record_ids, record_ids[new]])
+        self.replay_unresolved = np.concatenate([self.replay_unresolved, unresolved[new]])
+        return int(new.sum())
+
+    @staticmethod
+    def _append(table: dict[str, np.ndarray], columns: list[np.ndarray]):
+        for name, column in zip(table, columns):
+            table[name] = np.concatenate([table[name], column.astype(table[name].dtype)])
+
+    @staticmethod
+    def _select(table: dict[str, np.ndarray], replay_ids: Optional[Iterable[int]]) -> dict[str, np.ndarray]:
+        if replay_ids is None:
+            return table
+        mask = np.isin(table["replay_id"], np.fromiter(replay_ids, dtype=np.int64))
+        return {name: column[mask] for name, column in table.items()}
+
+    def flow_matrix(self, resource: str = Resource.mass,
+                    replay_ids: Optional[Iterable[int]] = None) -> tuple[np.ndarray, sparse.csr_matrix]:
+        """
+        Player IDs and the sparse matrix of resources they sent each other over the selected games (all by default):
+        entry (i, j) is the amount player i sent to player j.
+        """
+        flows = self._select(self.flows, replay_ids)
+        player_ids, indices = np.unique(np.concatenate([flows["from_player"], flows["to_player"]]),
+                                        return_inverse=True)
+        senders, receivers = np.split(indices.ravel(), 2)
+        n = len(player_ids)
+        matrix = sparse.coo_matrix((flows[resource], (senders, receivers)), shape=(n, n)).tocsr()
+        return player_ids, matrix
+
+    def game_flows(self, replay_id: int, resource: str = Resource.mass) -> tuple[np.ndarray, np.ndarray]:
+        """Player IDs and the dense matrix of resources they sent each other in one game"""
+        player_ids, matrix = self.flow_matrix(resource, [replay_id])
+        return player_ids, matrix.toarray()
+
+    def share_curve(self, replay_ids: Optional[Iterable[int]] = None) -> ShareCurve:
+        """Mass and energy shared per minute of the game, summed over the selected games (all by default)"""
+        if replay_ids is not None:
+            replay_ids = np.fromiter(replay_ids, dtype=np.int64)
+        curves = self._select(self.curves, replay_ids)
+        length = int(curves["bucket"].max()) + 1 if len(curves["bucket"]) else 0
+        games = len(self.replay_ids) if replay_ids is None else int(np.isin(replay_ids, self.replay_ids).sum())
+        return ShareCurve(bucket_sec=BUCKET_SEC, games=games,
+                          mass=np.bincount(curves["bucket"], weights=curves["mass"], minlength=length),
+                          energy=np.bincount(curves["bucket"], weights=curves["energy"], minlength=length))
+
+    def profiles(self, replay_ids: Optional[Iterable[int]] = None) -> dict[str, np.ndarray]:
+        """Sent and received totals of every player over the selected games, as columns sorted by player ID"""
+        flows = self._select(self.flows, replay_ids)
+        player_ids, indices = np.unique(np.concatenate([flows["from_player"], flows["to_player"]]),
+                                        return_inverse=True)
+        senders, receivers = np.split(indices.ravel(), 2)
+        n = len(player_ids)
+        columns = {"player_id": player_ids}
+        for resource in (Resource.mass, Resource.energy):
+            columns[f"{resource}_sent"] = np.bincount(senders, weights=flows[resource], minlength=n)
+            columns[f"{resource}_received"] = np.bincount(receivers, weights=flows[resource], minlength=n)
+        columns["transfers_sent"] = np.bincount(senders, weights=flows["transfers"], minlength=n).astype(np.int64)
+        columns["transfers_received"] = np.bincount(receivers, weights=flows["transfers"],
+                                                    minlength=n).astype(np.int64)
+        total = columns["mass_sent"] + columns["mass_received"]
+        columns["feeder_ratio"] = np.divide(columns["mass_sent"], total, out=np.full(n, 0.5), where=total > 0)
+        return columns
+
+    @staticmethod
+    def _profile(columns: dict[str, np.ndarray], row: int) -> FlowProfile:
+        return FlowProfile(**{name: column[row].item() for name, column in columns.items()})
+
+    def profile(self, player_id: int) -> Optional[FlowProfile]:
+        columns = self.profiles()
+        row = np.searchsorted(columns["player_id"], player_id)
+        if row == len(columns["player_id"]) or columns["player_id"][row] != player_id:
+            return None
+        return self._profile(columns, row)
+
+    def top(self, k: int = 10, role: str = Role.feeder) -> list[FlowProfile]:
+        """Players who sent (or received) the most mass"""
+        columns = self.profiles()
+        amounts = columns["mass_sent" if role == Role.feeder else "mass_received"]
+        best = np.argsort(-amounts, kind="stable")[:k]
+        return [self._profile(columns, row) for row in best]
+
+    def save(self, path: str = RESOURCE_FLOW_FILE):
+        arrays = {"replay_ids": self.replay_ids, "record_ids": self.record_ids,
+                  "replay_unresolved": self.replay_unresolved, "last_record_id": np.array(self.last_record_id)}
+        arrays.update({f"flows_{name}": column for name, column in self.flows.items()})
+        arrays.update({f"curves_{name}": column for name, column in self.curves.items()})
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = RESOURCE_FLOW_FILE) -> "ResourceFlows":
+        flows = cls()
+        with np.load(path) as arrays:
+            flows.replay_ids = arrays["replay_ids"]
+            if "record_ids" in arrays:
+                flows.record_ids = arrays["record_ids"]
+                flows.replay_unresolved = arrays["replay_unresolved"]
+                flows.last_record_id = int(arrays["last_record_id"])
+            else:
+                # Files saved before record IDs were kept: every replay is replaced when it is exported next
+                flows.record_ids = np.zeros(len(flows.replay_ids), dtype=np.int64)
+                flows.replay_unresolved = np.zeros(len(flows.replay_ids), dtype=np.int64)
+            flows.flows = {name: arrays[f"flows_{name}"] for name in FLOW_COLUMNS}
+            flows.curves = {name: arrays[f"curves_{name}"] for name in CURVE_COLUMNS}
+        return flows
+
+
+def load_resource_flows(path: str = RESOURCE_FLOW_FILE) -> ResourceFlows:
+    return ResourceFlows.load(path) if os.path.exists(path) else ResourceFlows()
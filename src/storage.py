@@ -1,15 +1,71 @@
+import atexit
+import mmap
 import os.path
+from contextlib import contextmanager
 from glob import glob
 from os.path import basename
-import shelve
 
-METADATA_FILE = "metadata.shelve"
-METADATA_VERSION_SUFFIX = "_version"
+from src.extraction_manifest import ExtractionManifest
+from src.extractor_results import ExtractorResultStore
+from src.metadata_store import MetadataStore
+from src.metrics import get_metrics
+from src.notification_rollups import get_rollup, get_rollups, GAMES
+from src.probe_index import ProbeIndex
+from src.replay_pack import ReplayPack
+from src.replay_db import MetadataKind
+
 REPLAY_DIR = "data/replays/"
 CHAT_DIR = "data/chats/"
 FAF_REPLAY_EXTENSION = ".fafreplay"
+REPLAY_PACK_FILE = "data/replays.pack"
+REPLAY_PACK_INDEX_FILE = "data/replays.idx"
+PROBE_INDEX_FILE = "data/probes.json"
+
+_metadata_store = None
+_replay_pack = None
+_probe_index = None
+_extraction_manifest = None
+_extractor_results = None
+
+
+def _get_metadata_store():
+    global _metadata_store
+    if _metadata_store is None:
+        _metadata_store = MetadataStore()
+        atexit.register(_metadata_store.flush)
+    return _metadata_store
+
+
+def _get_replay_pack():
+    """Replays are stored in a pack if it exists (see `pack_replays.py`), and as one file per replay otherwise"""
+    global _replay_pack
+    if _replay_pack is None and os.path.exists(REPLAY_PACK_FILE):
+        _replay_pack = ReplayPack(REPLAY_PACK_FILE, REPLAY_PACK_INDEX_FILE)
+        atexit.register(_replay_pack.flush)
+    return _replay_pack
+
+
+def get_probe_index():
+    global _probe_index
+    if _probe_index is None:
+        _probe_index = ProbeIndex(PROBE_INDEX_FILE)
+        atexit.register(_probe_index.save)
+    return _probe_index
 
-metadata = shelve.open(METADATA_FILE)
+
+def get_extraction_manifest():
+    global _extraction_manifest
+    if _extraction_manifest is None:
+        _extraction_manifest = ExtractionManifest()
+    return _extraction_manifest
+
+
+def _get_extractor_results():
+    global _extractor_results
+    if _extractor_results is None:
+        _extractor_results = ExtractorResultStore()
+        atexit.register(_extractor_results.flush)
+    return _extractor_results
 
 
 def ensure_dirs():
@@ -20,35 +76,154 @@ def ensure_dirs():
 
 
 def list_replays():
+    pack = _get_replay_pack()
+    if pack is not None:
+        return [str(replay_id) for replay_id in pack.ids()]
     replay_files = [basename(_)[:-len(FAF_REPLAY_EXTENSION)] for _ in glob(REPLAY_DIR + "*" + FAF_REPLAY_EXTENSION)]
     return replay_files
 
 
+def replay_fingerprints():
+    """Returns {replay_id: (size, change token)} for all stored replays, without opening any of them"""
+    pack = _get_replay_pack()
+    if pack is not None:
+        # Refreshed replays are appended to the pack again, so their offset changes
+        return {str(replay_id): (length, offset) for replay_id, offset, length in pack.entries()}
+    fingerprints = {}
+    with os.scandir(REPLAY_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(FAF_REPLAY_EXTENSION):
+                stat = entry.stat()
+                fingerprints[entry.name[:-len(FAF_REPLAY_EXTENSION)]] = (stat.st_size, stat.st_mtime_ns)
+    return fingerprints
+
+
+def replay_fingerprint(replay_id):
+    """Fingerprint of a single stored replay, as in `replay_fingerprints`"""
+    pack = _get_replay_pack()
+    if pack is not None:
+        offset, length = pack.locate(int(replay_id))
+        return length, offset
+    stat = os.stat(REPLAY_DIR + replay_id + FAF_REPLAY_EXTENSION)
+    return stat.st_size, stat.st_mtime_ns
+
+
 def has_replay(replay_id):
+    pack = _get_replay_pack()
+    if pack is not None:
+        return pack.has(int(replay_id))
     return os.path.exists(REPLAY_DIR + replay_id + FAF_REPLAY_EXTENSION)
 
 
 def get_replay(replay_id):
+    metrics = get_metrics()
+    with metrics.stage("storage.get_replay"):
+        pack = _get_replay_pack()
+        if pack is not None:
+            data = pack.get(int(replay_id))
+        else:
+            with open(REPLAY_DIR + replay_id + FAF_REPLAY_EXTENSION, "rb") as f:
+                data = f.read()
+    metrics.add_bytes("storage.get_replay", bytes_in=len(data) if data else 0)
+    return data
+
+
+@contextmanager
+def open_replay(replay_id):
+    """Memory-maps a stored replay, so that it can be parsed without reading it into memory first"""
+    pack = _get_replay_pack()
+    if pack is not None:
+        view = pack.view(int(replay_id))
+        if view is None:
+            raise FileNotFoundError(f"Replay {replay_id} is not in {REPLAY_PACK_FILE}")
+        with view:
+            yield view
+        return
     with open(REPLAY_DIR + replay_id + FAF_REPLAY_EXTENSION, "rb") as f:
-        return f.read()
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be memory-mapped
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
 
 
 def write_replay(replay_id, data):
-    with open(REPLAY_DIR + replay_id + FAF_REPLAY_EXTENSION, "wb") as f:
-        return f.write(data)
+    metrics = get_metrics()
+    metrics.add_bytes("storage.write_replay", bytes_out=len(data))
+    with metrics.stage("storage.write_replay"):
+        pack = _get_replay_pack()
+        if pack is not None:
+            return pack.write(int(replay_id), data)
+        with open(REPLAY_DIR + replay_id + FAF_REPLAY_EXTENSION, "wb") as f:
+            return f.write(data)
+
+
+def replace_replay(replay_id, data):
+    """Rewrites a stored replay; a replay file is replaced atomically, so it is never left half-written"""
+    if _get_replay_pack() is not None:
+        return write_replay(replay_id, data)
+    path = REPLAY_DIR + replay_id + FAF_REPLAY_EXTENSION
+    with open(path + ".tmp", "wb") as f:
+        written = f.write(data)
+    os.replace(path + ".tmp", path)
+    return written
+
+
+def flush_replays():
+    pack = _get_replay_pack()
+    if pack is not None:
+        with get_metrics().stage("storage.flush_replays"):
+            pack.flush()
 
 
 def write_metadata(replay_id, obj, version):
-    metadata[replay_id] = obj
-    metadata[replay_id + METADATA_VERSION_SUFFIX] = version
-    metadata.sync()
+    with get_metrics().stage("storage.write_metadata"):
+        _get_metadata_store().write(replay_id, obj, version)
+
+
+def flush_metadata():
+    with get_metrics().stage("storage.flush_metadata"):
+        _get_metadata_store().flush()
+
+
+def has_metadata(replay_id, version, kind=MetadataKind.full):
+    with get_metrics().stage("storage.has_metadata"):
+        return _get_metadata_store().has(replay_id, version, kind)
+
+
+def get_metadata(replay_id, version, kind=MetadataKind.full):
+    with get_metrics().stage("storage.get_metadata"):
+        return _get_metadata_store().get(replay_id, version, kind)
+
+
+def write_extractor_result(replay_id, extractor, version, data):
+    with get_metrics().stage("storage.write_extractor_result"):
+        _get_extractor_results().write(replay_id, extractor, version, data)
+
+
+def flush_extractor_results():
+    with get_metrics().stage("storage.flush_extractor_results"):
+        _get_extractor_results().flush()
+
+
+def get_extractor_result(replay_id, extractor, version):
+    return _get_extractor_results().get(replay_id, extractor, version)
+
+
+def find_replays(**filters):
+    """Replay IDs (or projected fields) matching the filters, see `MetadataStore.find`"""
+    return _get_metadata_store().find(**filters)
 
 
-def has_metadata(replay_id, version):
-    return metadata.get(replay_id + METADATA_VERSION_SUFFIX) == version
+def get_notification_rollup(dimension, key, completed=GAMES):
+    """Completion statistics of a player, faction, map or rating bucket, see `src/notification_rollups.py`"""
+    store = _get_metadata_store()
+    store.flush()
+    return get_rollup(dimension, key, completed, store.engine)
 
 
-def get_metadata(replay_id, version):
-    if not has_metadata(replay_id, version):
-        return None
-    return metadata[replay_id]
+def get_notification_rollups(dimension, key):
+    store = _get_metadata_store()
+    store.flush()
+    return get_rollups(dimension, key, store.engine)
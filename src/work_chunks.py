@@ -0,0 +1,168 @@
+import logging
+import os
+import socket
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from sqlalchemy import select, update, func, or_, and_, case
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.orm import Session
+
+from src.replay_db import get_engine, create_shared_engine, WorkChunkRecord
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_LEASE_SEC = 300
+CHECKPOINT_EVERY = 50  # IDs
+CHECKPOINT_INTERVAL_SEC = 30
+
+
+class LeaseLostError(Exception):
+    """Raised when the lease of a chunk expired and the chunk was claimed by another worker."""
+
+
+@dataclass
+class WorkChunk:
+    id: int
+    start_id: int
+    end_id: int
+    checkpoint: Optional[int]
+
+    @property
+    def next_id(self) -> int:
+        return self.start_id if self.checkpoint is None else self.checkpoint + 1
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_queue_engine(url: Optional[str] = None):
+    """
+    Database of the chunk queues: `replays.sqlite3` by default, which serves the processes of this host only,
+    or a database shared by several hosts (see `create_shared_engine`)
+    """
+    return get_engine() if url is None else create_shared_engine(url, [WorkChunkRecord])
+
+
+def _insert(engine):
+    """INSERT statement of the engine's dialect, which supports ON CONFLICT"""
+    dialects = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+    if engine.dialect.name not in dialects:
+        raise ValueError(f"Chunk queues are not supported on {engine.dialect.name}")
+    return dialects[engine.dialect.name](WorkChunkRecord)
+
+
+class ChunkQueue:
+    """
+    Replay ID space of a job split into chunks, stored in the database, so that processes sharing the database
+    can work on the job together. A worker claims a chunk with a lease that it renews with every checkpoint;
+    chunks whose lease expired (e.g. their worker was killed) are claimed again, and processing resumes
+    after the last checkpoint.
+    `replays.sqlite3` is in WAL mode, which works only between processes of one host; workers on several hosts
+    share a database of their own instead (see `get_queue_engine`). Leases then rely on the clocks of the hosts
+    being roughly in sync.
+    """
+
+    def __init__(self, job: str, engine=None, owner: Optional[str] = None, lease_sec: float = DEFAULT_LEASE_SEC):
+        self.job = job
+        self.engine = engine if engine is not None else get_engine()
+        self.owner = owner if owner is not None else default_owner()
+        self.lease_sec = lease_sec
+
+    def plan(self, from_id: int, to_id: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+        """Splits [from_id, to_id] into chunks; chunks that already exist are kept as they are"""
+        chunks = [dict(job=self.job, start_id=start, end_id=min(start + chunk_size - 1, to_id), done=False, claims=0)
+                  for start in range(from_id, to_id + 1, chunk_size)]
+        if not chunks:
+            return 0
+        count = select(func.count()).select_from(WorkChunkRecord).where(WorkChunkRecord.job == self.job)
+        with Session(self.engine) as session, session.begin():
+            before = session.scalar(count)
+            session.execute(_insert(self.engine).on_conflict_do_nothing(), chunks)
+            return session.scalar(count) - before
+
+    def claim(self) -> Optional[WorkChunk]:
+        """Claims the first chunk that is not done and not leased by a live worker"""
+        while True:
+            now = time.time()
+            claimable = and_(WorkChunkRecord.job == self.job, WorkChunkRecord.done.is_(False),
+                             or_(WorkChunkRecord.lease_expires_at.is_(None), WorkChunkRecord.lease_expires_at < now))
+            with Session(self.engine) as session:
+                candidate = session.scalar(select(WorkChunkRecord.id).where(claimable)
+                                           .order_by(WorkChunkRecord.start_id).limit(1))
+            if candidate is None:
+                return None
+            # The update checks again that the chunk is claimable, so that when workers claim it at once,
+            # only one of them gets it, and the others try the next chunk
+            statement = (update(WorkChunkRecord)
+                         .where(WorkChunkRecord.id == candidate, claimable)
+                         .values(owner=self.owner, lease_expires_at=now + self.lease_sec,
+                                 claims=WorkChunkRecord.claims + 1)
+                         .returning(WorkChunkRecord.id, WorkChunkRecord.start_id, WorkChunkRecord.end_id,
+                                    WorkChunkRecord.checkpoint, WorkChunkRecord.claims))
+            with Session(self.engine) as session, session.begin():
+                row = session.execute(statement).first()
+            if row is not None:
+                break
+        chunk = WorkChunk(*row[:4])
+        if row.claims > 1:
+            logging.info(f"Taking over chunk {chunk.start_id}-{chunk.end_id} from ID {chunk.next_id}")
+        return chunk
+
+    def checkpoint(self, chunk: WorkChunk, last_id: int, done: bool = False):
+        """Records progress and renews the lease; raises `LeaseLostError` if the chunk was claimed by another worker"""
+        statement = (update(WorkChunkRecord)
+                     .where(WorkChunkRecord.id == chunk.id, WorkChunkRecord.owner == self.owner,
+                            WorkChunkRecord.done.is_(False))
+                     .values(checkpoint=last_id, done=done,
+                             lease_expires_at=None if done else time.time() + self.lease_sec))
+        with Session(self.engine) as session, session.begin():
+            if session.execute(statement).rowcount == 0:
+                raise LeaseLostError(f"Lost the lease of chunk {chunk.start_id}-{chunk.end_id}")
+        chunk.checkpoint = last_id
+
+    def status(self) -> dict[str, int]:
+        """Number of chunks that are done, leased by live workers, and waiting"""
+        now = time.time()
+        state = case((WorkChunkRecord.done.is_(True), "done"),
+                     (WorkChunkRecord.lease_expires_at >= now, "leased"),
+                     else_="waiting")
+        with Session(self.engine) as session:
+            rows = session.execute(select(state, func.count())
+                                   .where(WorkChunkRecord.job == self.job).group_by(state))
+            return {name: count for name, count in rows}
+
+    def work(self, process: Callable[[int], None], before_checkpoint: Callable[[], None] = lambda: None,
+             max_chunks: Optional[int] = None) -> int:
+        """
+        Claims chunks and calls `process` for every ID of them, until no chunks are left.
+        `before_checkpoint` must make the results of processed IDs durable (e.g. flush buffered writes),
+        as a checkpoint means the IDs before it are never processed again.
+        Returns the number of completed chunks.
+        """
+        completed = 0
+        while max_chunks is None or completed < max_chunks:
+            chunk = self.claim()
+            if chunk is None:
+                break
+            try:
+                self._work_on(chunk, process, before_checkpoint)
+                completed += 1
+            except LeaseLostError:
+                logging.warning(f"Lost the lease of chunk {chunk.start_id}-{chunk.end_id}, moving on")
+        return completed
+
+    def _work_on(self, chunk: WorkChunk, process: Callable[[int], None], before_checkpoint: Callable[[], None]):
+        logging.info(f"Working on chunk {chunk.start_id}-{chunk.end_id}")
+        unsaved, last_checkpoint_at = 0, time.monotonic()
+        for replay_id in range(chunk.next_id, chunk.end_id + 1):
+            process(replay_id)
+            unsaved += 1
+            if (unsaved >= CHECKPOINT_EVERY or time.monotonic() - last_checkpoint_at >= CHECKPOINT_INTERVAL_SEC) \
+                    and replay_id < chunk.end_id:
+                before_checkpoint()
+                self.checkpoint(chunk, replay_id)
+                unsaved, last_checkpoint_at = 0, time.monotonic()
+        before_checkpoint()
+        self.checkpoint(chunk, chunk.end_id, done=True)
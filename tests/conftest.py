@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+import src.replay_db as replay_db
+import src.storage as storage
+from mock_replay_server import MockReplayServer
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Storage in a temporary directory, with no handles left over from other tests"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, "REPLAY_DIR", str(tmp_path / "replays") + "/")
+    monkeypatch.setattr(storage, "CHAT_DIR", str(tmp_path / "chats") + "/")
+    monkeypatch.setattr(storage, "PROBE_INDEX_FILE", str(tmp_path / "probes.json"))
+    monkeypatch.setattr(storage, "REPLAY_PACK_FILE", str(tmp_path / "replays.pack"))
+    monkeypatch.setattr(storage, "_probe_index", None)
+    monkeypatch.setattr(storage, "_replay_pack", None)
+    monkeypatch.setattr(storage, "_metadata_store", None)
+    monkeypatch.setattr(storage, "_extraction_manifest", None)
+    monkeypatch.setattr(storage, "_extractor_results", None)
+    # The database is created in the working directory
+    monkeypatch.setattr(replay_db, "_engine", None)
+    storage.ensure_dirs()
+    return tmp_path
+
+
+@pytest.fixture
+def replay_server():
+    """Starts a `MockReplayServer` with the given options; returns it and its URL base"""
+    servers = []
+
+    def start(**options):
+        mock = MockReplayServer(**options)
+        server = mock.serve(port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return mock, f"http://127.0.0.1:{server.server_address[1]}/"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
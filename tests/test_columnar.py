@@ -0,0 +1,90 @@
+from sqlalchemy import create_engine, event
+
+import src.columnar as columnar
+from src.columnar import export_columnar, load_columnar
+from src.faf_replay import ReplayMetadata, ReplayPlayerMetadata, ReplayHeader
+from src.metadata_store import MetadataStore
+from src.replay_db import Base, _set_sqlite_pragmas
+from src.replay_events import ChatMessages, CompletionNotifications, ResourceTransfers, NO_RECEIVER
+
+
+def _players(nicknames) -> list[ReplayPlayerMetadata]:
+    return [ReplayPlayerMetadata(player_id=str(100 + i), nickname=nickname, clan="clan", country="DE",
+                                 rating_mean=1000.0, rating_std=100.0, rating=700.0, faction=1, team=2 + i, army=1 + i)
+            for i, nickname in enumerate(nicknames)]
+
+
+def _metadata(replay_id: str, nicknames=("a", "b")) -> ReplayMetadata:
+    chat = ChatMessages()
+    chat.append(False, nicknames[0], f"glhf {replay_id}", 10)
+    transfers = ResourceTransfers()
+    transfers.append(nicknames[0], 2, 100.0, 0.0, 100)
+    transfers.append(nicknames[1], None, 5.0, 50.0, 700)
+    return ReplayMetadata(title="game", replay_id=replay_id, chat_messages=chat,
+                          notifications=CompletionNotifications(), resource_transfer=transfers,
+                          launched_at_ts=int(replay_id), duration=600.0, map="map", game_type="0", desync=False,
+                          players=_players(nicknames))
+
+
+def _header(replay_id: str) -> ReplayHeader:
+    return ReplayHeader(title="game", replay_id=replay_id, launched_at_ts=int(replay_id), map="other",
+                        game_type="0", players=_players(("c",)))
+
+
+def _engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'replays.sqlite3'}")
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def test_exports_known_database(tmp_path):
+    engine = _engine(tmp_path)
+    store = MetadataStore(engine)
+    store.write("1", _metadata("1"), 1)
+    store.write("2", _metadata("2", ("b", "c")), 1)
+    store.write("2", _header("2"), 1)  # superseded by the full metadata
+    store.write("3", _header("3"), 1)
+    store.flush()
+    export_columnar(str(tmp_path / "columnar"), engine)
+    tables = load_columnar(str(tmp_path / "columnar"))
+
+    replays = tables.tables["replays"]
+    assert replays["replay_id"].tolist() == [1, 2, 3]
+    assert replays["has_body"].tolist() == [True, True, False]
+    assert tables.decode("map", replays["map"]).tolist() == ["map", "map", "other"]
+    players = tables.tables["players"]
+    assert players["replay_idx"].tolist() == [0, 0, 1, 1, 2]
+    assert tables.decode("player", players["nickname"]).tolist() == ["a", "b", "b", "c", "c"]
+    assert players["army"].tolist() == [1, 2, 1, 2, 1]
+    chat = tables.tables["chat"]
+    assert chat["replay_idx"].tolist() == [0, 1]
+    assert [tables.chat_message(row) for row in range(2)] == ["glhf 1", "glhf 2"]
+    transfers = tables.tables["resource_transfer"]
+    assert transfers["replay_idx"].tolist() == [0, 0, 1, 1]
+    assert tables.decode("player", transfers["from_player"]).tolist() == ["a", "b", "b", "c"]
+    assert transfers["to_player"].tolist() == [2, NO_RECEIVER, 2, NO_RECEIVER]
+    assert len(tables.tables["notifications"]["replay_idx"]) == 0
+
+
+def test_export_reads_one_snapshot(tmp_path, monkeypatch):
+    engine = _engine(tmp_path)
+    store = MetadataStore(engine)
+    store.write("1", _metadata("1"), 1)
+    store.flush()
+    writer = MetadataStore(_engine(tmp_path))
+    export_table = columnar._export_table
+
+    def export_while_writing(*args, **kwargs):
+        # Another process writes metadata between the statements of the export
+        count = export_table(*args, **kwargs)
+        writer.write("10", _metadata("10"), 1)
+        writer.flush()
+        return count
+
+    monkeypatch.setattr(columnar, "_export_table", export_while_writing)
+    export_columnar(str(tmp_path / "columnar"), engine)
+    tables = load_columnar(str(tmp_path / "columnar"))
+    assert tables.tables["replays"]["replay_id"].tolist() == [1]
+    assert tables.tables["players"]["replay_idx"].tolist() == [0, 0]
+    assert tables.tables["resource_transfer"]["replay_idx"].tolist() == [0, 0]
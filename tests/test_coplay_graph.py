@@ -0,0 +1,36 @@
+from sqlalchemy import create_engine
+
+from src.coplay_graph import CoPlayGraph, Relation
+from src.faf_replay import ReplayHeader, ReplayPlayerMetadata
+from src.metadata_store import MetadataStore
+from src.replay_db import Base
+
+
+def _header(replay_id: str, player_ids: list[str]) -> ReplayHeader:
+    players = [ReplayPlayerMetadata(player_id=player_id, nickname=f"player{player_id}", clan="", country=None,
+                                    rating_mean=1000.0, rating_std=100.0, rating=700.0, faction=1, team=2 + i % 2)
+               for i, player_id in enumerate(player_ids)]
+    return ReplayHeader(title="game", replay_id=replay_id, launched_at_ts=int(replay_id), map="map",
+                        game_type="0", players=players)
+
+
+def test_update_reads_only_new_records(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'replays.sqlite3'}")
+    Base.metadata.create_all(engine)
+    store = MetadataStore(engine)
+    store.write("1", _header("1", ["a", "b"]), 1)
+    store.flush()
+    graph = CoPlayGraph()
+    assert graph.update_from_db(engine) == 1
+    first_mark = graph.last_record_id
+
+    store.write("2", _header("2", ["a", "b", "c", "d"]), 1)
+    store.flush()
+    assert graph.update_from_db(engine) == 1
+    assert graph.last_record_id > first_mark
+    assert graph.update_from_db(engine) == 0
+
+    graph.save(str(tmp_path / "graph.npz"))
+    loaded = CoPlayGraph.load(str(tmp_path / "graph.npz"))
+    assert loaded.last_record_id == graph.last_record_id
+    assert [stats.games for stats in loaded.top("a", relation=Relation.opponent)] == [2, 1]
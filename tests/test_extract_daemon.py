@@ -0,0 +1,38 @@
+from extract_daemon import ExtractionDaemon, RequestStatus
+from src.body_extractors import EXTRACTORS
+from src.replay_generator import ReplaySpec, generate_fafreplay
+from src.storage import write_replay, replace_replay, get_extractor_result
+
+
+def _status(daemon: ExtractionDaemon, replay_id: str) -> str:
+    return daemon.handle({"replay_ids": [replay_id]})["results"][replay_id]["status"]
+
+
+def test_cached_replays_are_checked_against_the_manifest(data_dir, monkeypatch):
+    extractor = next(iter(EXTRACTORS.values()))
+    daemon = ExtractionDaemon((extractor.name,))
+    spec = ReplaySpec(players=2, minutes=0.1, chat_messages=1, notifications=1, resource_shares=1)
+    write_replay("1", generate_fafreplay(spec, 1))
+    assert _status(daemon, "1") == RequestStatus.extracted
+    assert _status(daemon, "1") == RequestStatus.cached
+
+    # A new extractor version re-runs the extractor only
+    monkeypatch.setattr(extractor, "version", extractor.version + 1)
+    response = daemon.handle({"replay_ids": ["1"], "return_metadata": True})["results"]["1"]
+    assert response["status"] == RequestStatus.extracted
+    assert response["metadata"]["replay_id"] == "1"
+    assert _status(daemon, "1") == RequestStatus.cached
+
+    # So does a changed replay, for metadata as well
+    replace_replay("1", generate_fafreplay(ReplaySpec(**dict(spec.__dict__, players=4)), 1))
+    assert _status(daemon, "1") == RequestStatus.extracted
+    assert _status(daemon, "1") == RequestStatus.cached
+
+
+def test_extracts_metadata_only_by_default(data_dir):
+    daemon = ExtractionDaemon()
+    write_replay("1", generate_fafreplay(ReplaySpec(players=2, minutes=0.1), 1))
+    response = daemon.handle({"replay_ids": ["1"], "return_metadata": True})["results"]["1"]
+    assert response["status"] == RequestStatus.extracted
+    assert response["metadata"]["extracted"] == {}
+    assert all(get_extractor_result("1", name, extractor.version) is None for name, extractor in EXTRACTORS.items())
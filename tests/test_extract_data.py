@@ -0,0 +1,68 @@
+import extract_data
+from extract_data import ExtractionTask, extract_all, find_new_replays, stale_task
+from src.body_extractors import EXTRACTORS, BodyExtractor
+from src.replay_generator import ReplaySpec, generate_fafreplay
+from src.storage import write_replay, replace_replay, replay_fingerprint, get_extraction_manifest
+
+SPEC = ReplaySpec(players=2, minutes=0.1, chat_messages=1, notifications=1, resource_shares=1)
+
+
+class TickExtractor(BodyExtractor):
+    """Second extractor, so that extractors can be told apart"""
+    name = "test_ticks"
+
+    def result(self):
+        return self.context.tick
+
+
+def _extract_new(extractors=()):
+    tasks, fingerprints = find_new_replays(extractors=extractors)
+    extract_all(tasks, fingerprints=fingerprints)
+    return tasks
+
+
+def test_only_new_and_changed_replays_are_pending(data_dir):
+    write_replay("1", generate_fafreplay(SPEC, 1))
+    write_replay("2", generate_fafreplay(SPEC, 2))
+    assert sorted(_extract_new(), key=lambda task: task.replay_id) == [ExtractionTask("1"), ExtractionTask("2")]
+    assert find_new_replays()[0] == []
+
+    write_replay("3", generate_fafreplay(SPEC, 3))
+    replace_replay("1", generate_fafreplay(ReplaySpec(**dict(SPEC.__dict__, players=4)), 1))
+    assert sorted(_extract_new(), key=lambda task: task.replay_id) == [ExtractionTask("1"), ExtractionTask("3")]
+    assert find_new_replays()[0] == []
+
+
+def test_metadata_version_bump_makes_replays_pending(data_dir, monkeypatch):
+    write_replay("1", generate_fafreplay(SPEC, 1))
+    _extract_new()
+    tasks, fingerprints = find_new_replays(header_only=True)
+    extract_all(tasks, header_only=True, fingerprints=fingerprints)
+    monkeypatch.setattr(extract_data, "METADATA_VERSION", extract_data.METADATA_VERSION + 1)
+    assert find_new_replays()[0] == [ExtractionTask("1")]
+    # Header-only extraction is tracked under its own kind and version
+    assert find_new_replays(header_only=True)[0] == []
+
+
+def test_extractor_version_bump_reruns_that_extractor_only(data_dir, monkeypatch):
+    monkeypatch.setitem(EXTRACTORS, TickExtractor.name, TickExtractor)
+    first, second = EXTRACTORS["apm"], TickExtractor
+    write_replay("1", generate_fafreplay(SPEC, 1))
+    _extract_new((first.name, second.name))
+    assert find_new_replays(extractors=(first.name, second.name))[0] == []
+
+    monkeypatch.setattr(first, "version", first.version + 1)
+    assert _extract_new((first.name, second.name)) == [ExtractionTask("1", False, (first.name,))]
+    assert find_new_replays(extractors=(first.name, second.name))[0] == []
+    assert stale_task("1", replay_fingerprint("1"), extractors=(first.name, second.name)) is None
+
+
+def test_metadata_extracted_before_the_manifest_is_recorded(data_dir):
+    write_replay("1", generate_fafreplay(SPEC, 1))
+    # Without fingerprints, metadata is stored without a manifest entry
+    extract_all(["1"])
+    version, kind = extract_data.metadata_version(False)
+    assert get_extraction_manifest().get("1", kind) is None
+
+    assert find_new_replays()[0] == []
+    assert get_extraction_manifest().get("1", kind) == (*replay_fingerprint("1"), version)
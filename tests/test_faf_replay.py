@@ -0,0 +1,24 @@
+import src.faf_replay as faf_replay
+from src.faf_replay import extract_scfa_header, _get_parser
+from src.replay_generator import ReplaySpec, generate_fafreplay
+
+
+class CountingParser:
+    def __init__(self, parser):
+        self.parser = parser
+        self.attempts = []
+
+    def parse_header(self, data: bytes) -> dict:
+        self.attempts.append(len(data))
+        return self.parser.parse_header(data)
+
+
+def test_header_is_parsed_from_geometrically_growing_reads(monkeypatch):
+    monkeypatch.setattr(faf_replay, "HEADER_READ_CHUNK_SIZE", 16)
+    data = generate_fafreplay(ReplaySpec(players=8, minutes=0.5), 1)
+    parser = CountingParser(_get_parser([], False))
+    header, _ = extract_scfa_header(data, parser)
+    assert len(header["armies"]) == 8
+    # Every attempt reads as much again as was read before it
+    assert parser.attempts == [16 * (2 ** i - 1) for i in range(1, len(parser.attempts) + 1)]
+    assert len(parser.attempts) <= 12
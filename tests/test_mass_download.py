@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+
+import mass_download
+import src.storage as storage
+from mass_download import download_replay, download_replays, _get_rate_limiter, find_frontier, follow_replays
+from src.probe_index import ProbeStatus
+from src.storage import get_replay, get_probe_index, has_replay
+
+
+def test_retries_server_errors(data_dir, replay_server, monkeypatch):
+    monkeypatch.setattr(mass_download, "RETRY_BACKOFF_SEC", 0.0)
+    mock, url_base = replay_server(first_id=100, backlog=10, late_fraction=0, missing_fraction=0, failures=2)
+    assert download_replay(100, url_base=url_base, rate=0) == ProbeStatus.downloaded
+    assert mock.requests_by_id[100] == 3
+    assert get_replay("100")
+
+
+def test_gives_up_after_retries(data_dir, replay_server, monkeypatch):
+    monkeypatch.setattr(mass_download, "RETRY_BACKOFF_SEC", 0.0)
+    mock, url_base = replay_server(first_id=100, backlog=10, failures=mass_download.RETRY_COUNT)
+    download_replays(100, 101, url_base=url_base, rate=0)
+    assert mock.requests_by_id[100] == mass_download.RETRY_COUNT
+    # Failed replays are retried on the next run
+    assert get_probe_index().get(100)[0] == ProbeStatus.failed
+    assert [replay_id for replay_id, _ in mass_download.replays_to_download(100, 101, False, None)] == [100, 101]
+
+
+def test_rate_limiters_per_host(monkeypatch):
+    monkeypatch.setattr(mass_download, "_rate_limiters", {})
+    limiter = _get_rate_limiter("http://example.com/1", 10.0)
+    # Callers asking for different rates share the limit of the host, which is the lowest rate asked for
+    assert _get_rate_limiter("http://example.com/2", 0) is limiter
+    assert limiter.interval == 0.1
+    assert _get_rate_limiter("http://example.com/3", 1.0) is limiter
+    assert limiter.interval == 1.0
+    assert _get_rate_limiter("http://example.com/4", 10.0).interval == 1.0
+    assert _get_rate_limiter("http://example.org/1", 10.0) is not limiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _published(mock, replay_ids) -> list[int]:
+    elapsed = mock.clock() - mock.started
+    return [replay_id for replay_id in replay_ids
+            if mock.published_at(replay_id) is not None and mock.published_at(replay_id) <= elapsed]
+
+
+def _stored_files() -> list[str]:
+    return [name for name in os.listdir(storage.REPLAY_DIR) if name.endswith(storage.FAF_REPLAY_EXTENSION)]
+
+
+def _wait_for(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_frontier_skips_gaps(data_dir, replay_server):
+    mock, url_base = replay_server(first_id=100, rate=0.01, backlog=60, late_fraction=0.1, late_sec=2000,
+                                   missing_fraction=0.1, seed=1, clock=FakeClock())
+    published = _published(mock, range(100, 200))
+    assert len(published) < 60
+    assert find_frontier(99, url_base, rate=0) == max(published)
+    # Misses found on the way are only recorded in the probe index
+    assert all(os.path.getsize(os.path.join(storage.REPLAY_DIR, name)) for name in _stored_files())
+
+
+def test_follow_retries_late_replays(data_dir, replay_server, monkeypatch):
+    monkeypatch.setattr(mass_download, "RETRY_MISSING_AFTER_SEC", 0.0)
+    clock = FakeClock()
+    mock, url_base = replay_server(first_id=100, rate=0.01, backlog=20, late_fraction=0.3, missing_fraction=0.1,
+                                   clock=clock)
+    late = [replay_id for replay_id in range(100, 118)
+            if mock.published_at(replay_id) not in (None, (replay_id - 100) / mock.rate)]
+    assert late
+    late_id = late[0]
+    mock.late_sec = clock() - mock.started + 1.0 - (late_id - 100) / mock.rate
+    assert late_id not in _published(mock, [late_id])
+    get_probe_index().mark(99, ProbeStatus.downloaded)
+
+    stop = threading.Event()
+    follower = threading.Thread(target=follow_replays, args=(100,), daemon=True, kwargs=dict(
+        url_base=url_base, rate=0, poll_min_sec=0.01, poll_max_sec=0.01, stop=stop))
+    follower.start()
+    try:
+        _wait_for(lambda: get_probe_index().get(late_id) is not None)
+        assert get_probe_index().get(late_id)[0] == ProbeStatus.missing
+        # Publishing the late replay
+        clock.now += 1.0
+        _wait_for(lambda: has_replay(str(late_id)))
+    finally:
+        stop.set()
+        follower.join(30)
+    assert not follower.is_alive()
+    assert mock.requests_by_id[late_id] >= 2
+    assert get_probe_index().get(late_id)[0] == ProbeStatus.downloaded
+    assert sorted(int(name.split(".")[0]) for name in _stored_files()) == _published(mock, range(100, 200))
+
+
+def test_follow_resumes_after_extracted_replays(data_dir, replay_server):
+    mock, url_base = replay_server(first_id=100, rate=0.01, backlog=20, late_fraction=0, missing_fraction=0,
+                                   clock=FakeClock())
+    get_probe_index().mark(110, ProbeStatus.extracted)
+    get_probe_index().mark(105, ProbeStatus.downloaded)
+    stop = threading.Event()
+    stop.set()
+    follow_replays(100, url_base=url_base, rate=0, stop=stop)
+    assert min(mock.requests_by_id) > 110
+    assert has_replay("119")
@@ -0,0 +1,102 @@
+import threading
+
+from sqlalchemy import create_engine, event
+
+from src.faf_replay import ReplayMetadata, ReplayPlayerMetadata
+from src.metadata_store import MetadataStore
+from src.notification_rollups import Dimension, ALL_KEY, GAMES, QuantileSketch, get_rollup, get_rollups, \
+    rebuild_rollups
+from src.replay_db import Base, _set_sqlite_pragmas
+from src.replay_events import ChatMessages, CompletionNotifications, ResourceTransfers, sec_to_ticks
+
+
+def _metadata(replay_id: str, completions: list[tuple[str, str, float]], player_ids=("1", "2")) -> ReplayMetadata:
+    """Full metadata of a game between the players, with (player, completed, sent at) notifications"""
+    players = [ReplayPlayerMetadata(player_id=player_id, nickname=f"player{player_id}", clan="", country=None,
+                                    rating_mean=1000.0, rating_std=100.0, rating=750.0, faction=1 + i, team=2 + i,
+                                    army=1 + i) for i, player_id in enumerate(player_ids)]
+    notifications = CompletionNotifications()
+    for player, completed, sent_at_sec in completions:
+        notifications.append(player, completed, sec_to_ticks(sent_at_sec))
+    return ReplayMetadata(title="game", replay_id=replay_id, chat_messages=ChatMessages(),
+                          notifications=notifications, resource_transfer=ResourceTransfers(),
+                          launched_at_ts=int(replay_id), duration=600.0, map="map", game_type="0", desync=False,
+                          players=players)
+
+
+def _engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'replays.sqlite3'}", connect_args={"timeout": 60})
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def test_concurrent_flushes_keep_every_game(tmp_path):
+    _engine(tmp_path)
+    flushes, writers = 20, 2
+    barrier = threading.Barrier(writers)
+    errors = []
+
+    def write(writer: int):
+        store = MetadataStore(_engine(tmp_path))
+        try:
+            for i in range(flushes):
+                barrier.wait()
+                store.write(str(writer * 1000 + i), _metadata(str(writer * 1000 + i), []), 1)
+                store.flush()
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert get_rollup(Dimension.all, ALL_KEY, engine=_engine(tmp_path)).games == 2 * flushes * writers
+
+
+def test_rollups_merge_and_replaced_games_are_subtracted(tmp_path):
+    engine = _engine(tmp_path)
+    store = MetadataStore(engine)
+    store.write("1", _metadata("1", [("player1", "uel0401", 900.0), ("player1", "uel0401", 1200.0),
+                                     ("observer", "uel0401", 10.0)]), 1)
+    store.write("2", _metadata("2", [("player1", "uel0401", 600.0), ("player3", "url0402", 700.0)],
+                               player_ids=("1", "3")), 1)
+    store.flush()
+    assert get_rollup(Dimension.all, ALL_KEY, engine=engine).games == 4
+    experimental = get_rollup(Dimension.player, "1", "uel0401", engine=engine)
+    # The observer's notification is left out; the mean and quantiles are of the first completion in each game
+    assert (experimental.games, experimental.completions) == (2, 3)
+    assert experimental.mean_first_sec == 750.0
+    assert abs(experimental.quantile(1.0) - 900.0) <= 900.0 * 0.01
+    assert [rollup.completed for rollup in get_rollups(Dimension.player, "1", engine=engine)] == [GAMES, "uel0401"]
+
+    # Writing a game again replaces its rollups
+    store.write("2", _metadata("2", [], player_ids=("1", "3")), 1)
+    store.flush()
+    experimental = get_rollup(Dimension.player, "1", "uel0401", engine=engine)
+    assert (experimental.games, experimental.completions, experimental.mean_first_sec) == (1, 2, 900.0)
+    assert get_rollup(Dimension.player, "3", "url0402", engine=engine) is None
+    assert get_rollup(Dimension.faction, "2", engine=engine).games == 2
+    assert get_rollup(Dimension.rating, "600", engine=engine).games == 4
+
+    # Rebuilding from stored metadata gives the same rollups
+    before = [(r.games, r.completions, r.first_sec.counts) for r in get_rollups(Dimension.all, ALL_KEY, engine=engine)]
+    assert rebuild_rollups(engine) == 2
+    after = [(r.games, r.completions, r.first_sec.counts) for r in get_rollups(Dimension.all, ALL_KEY, engine=engine)]
+    assert after == before
+
+
+def test_sketches_merge_exactly():
+    left, right = QuantileSketch(), QuantileSketch()
+    for value in (10.0, 20.0, 30.0):
+        left.add(value)
+    for value in (40.0, 50.0):
+        right.add(value)
+    left.merge(right)
+    assert len(left) == 5
+    assert abs(left.quantile(0.5) - 30.0) <= 30.0 * 0.01
+    left.merge(right, -1)
+    assert QuantileSketch(left.state()).counts == {QuantileSketch.bucket(v): 1 for v in (10.0, 20.0, 30.0)}
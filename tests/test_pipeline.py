@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+import pipeline
+from pipeline import Pipeline
+from src.probe_index import ProbeStatus
+from src.storage import get_probe_index, has_replay, find_replays
+
+
+def _run(pipeline_, replays, timeout=30):
+    """Runs the pipeline in a thread, failing the test instead of hanging"""
+    errors = []
+
+    def target():
+        try:
+            pipeline_.run(replays)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "pipeline did not stop"
+    return errors
+
+
+def test_marks_unarchived_replays_as_extracted(data_dir, replay_server):
+    _, url_base = replay_server(first_id=100, backlog=10, late_fraction=0, missing_fraction=0)
+    assert _run(Pipeline(url_base=url_base, rate=0), [(100, False), (101, False)]) == []
+    assert get_probe_index().get(100)[0] == ProbeStatus.extracted
+    assert not has_replay("100")
+    assert sorted(find_replays()) == ["100", "101"]
+
+
+def test_stops_when_parsing_stage_fails(data_dir, replay_server, monkeypatch):
+    monkeypatch.setattr(pipeline, "QUEUE_SIZE", 1)
+    monkeypatch.setattr(pipeline, "STOP_POLL_SEC", 0.05)
+
+    def failing_write(replay_id, data):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(pipeline, "write_replay", failing_write)
+    _, url_base = replay_server(first_id=100, backlog=50, late_fraction=0, missing_fraction=0)
+    errors = _run(Pipeline(concurrency=4, archive=True, url_base=url_base, rate=0),
+                  [(replay_id, False) for replay_id in range(100, 150)])
+    assert len(errors) == 1 and isinstance(errors[0], OSError)
+
+
+def test_marks_failed_parses_as_failed(data_dir, replay_server, monkeypatch):
+    parse = pipeline._parse_in_worker
+
+    def failing_parse(replay_id, data, extractors):
+        if replay_id == "101":
+            raise MemoryError("out of memory")
+        return parse(replay_id, data, extractors)
+
+    monkeypatch.setattr(pipeline, "_parse_in_worker", failing_parse)
+    _, url_base = replay_server(first_id=100, backlog=10, late_fraction=0, missing_fraction=0)
+    assert _run(Pipeline(url_base=url_base, rate=0), [(100, False), (101, False)]) == []
+    assert get_probe_index().get(100)[0] == ProbeStatus.extracted
+    assert get_probe_index().get(101)[0] == ProbeStatus.failed
+    assert sorted(find_replays()) == ["100"]
+
+
+def test_flushes_in_batches(data_dir, replay_server, monkeypatch):
+    flushes = []
+    flush_results = pipeline.flush_results
+
+    def counting_flush():
+        flushes.append(len(flushes))
+        flush_results()
+
+    monkeypatch.setattr(pipeline, "FLUSH_EVERY", 4)
+    monkeypatch.setattr(pipeline, "FLUSH_INTERVAL_SEC", 60.0)
+    monkeypatch.setattr(pipeline, "flush_results", counting_flush)
+    _, url_base = replay_server(first_id=100, backlog=20, late_fraction=0, missing_fraction=0)
+    assert _run(Pipeline(url_base=url_base, rate=0), [(replay_id, False) for replay_id in range(100, 110)]) == []
+    # Two full batches, and the rest once the pipeline is done
+    assert len(flushes) == 3
+    assert len(find_replays()) == 10
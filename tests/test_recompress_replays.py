@@ -0,0 +1,62 @@
+import base64
+import json
+import zlib
+
+from extract_data import ExtractionTask, extract_all, find_new_replays
+from recompress_replays import train, recompress_all
+from src.faf_replay import extract_scfa, split_fafreplay
+from src.replay_dictionary import Compression
+from src.replay_generator import ReplaySpec, generate_fafreplay, generate_scfa
+from src.storage import write_replay, replace_replay, get_replay, list_replays
+
+SPEC = ReplaySpec(players=2, minutes=0.5, chat_messages=2, notifications=4, resource_shares=4)
+DICTIONARY_SIZE = 4 * 1024
+
+
+def _zlib_fafreplay(spec: ReplaySpec, replay_id: int) -> bytes:
+    """Replay compressed as Qt's qCompress does, then base64-encoded"""
+    scfa = generate_scfa(spec)
+    body = base64.encodebytes(len(scfa).to_bytes(4, "big") + zlib.compress(scfa))
+    file_header = {"uid": replay_id, "compression": Compression.zlib, "version": 1}
+    return json.dumps(file_header).encode() + b"\n" + body
+
+
+def _write_replays(count: int):
+    for replay_id in range(1, count + 1):
+        spec = ReplaySpec(**dict(SPEC.__dict__, players=2 + replay_id % 4, seed=replay_id))
+        write_replay(str(replay_id), generate_fafreplay(spec, replay_id))
+    write_replay(str(count + 1), _zlib_fafreplay(SPEC, count + 1))
+
+
+def _compression(replay_id: str) -> str:
+    header, body = split_fafreplay(get_replay(replay_id))
+    body.release()
+    return header["compression"]
+
+
+def test_recompression_keeps_replay_content(data_dir):
+    _write_replays(20)
+    original = {replay_id: extract_scfa(get_replay(replay_id))[0] for replay_id in list_replays()}
+    dictionary_id = train(size=DICTIONARY_SIZE)
+    report = recompress_all(dictionary_id)
+    assert report.failed == 0
+    assert report.recompressed + report.skipped == len(original)
+    # zlib replays are normalized even if that does not make them smaller
+    assert _compression("21") == Compression.zstd_dict
+    assert {replay_id: extract_scfa(get_replay(replay_id))[0] for replay_id in list_replays()} == original
+
+    # Replays already compressed with the dictionary are left alone
+    report = recompress_all(dictionary_id)
+    assert report.recompressed == 0 and report.failed == 0
+
+
+def test_recompression_rebases_the_extraction_manifest(data_dir):
+    _write_replays(20)
+    tasks, fingerprints = find_new_replays()
+    extract_all(tasks, fingerprints=fingerprints)
+    # Changed since extraction, so it must stay pending after recompression
+    replace_replay("1", generate_fafreplay(ReplaySpec(**dict(SPEC.__dict__, players=8)), 1))
+
+    report = recompress_all(train(size=DICTIONARY_SIZE))
+    assert report.recompressed > 1
+    assert find_new_replays()[0] == [ExtractionTask("1")]
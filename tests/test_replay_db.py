@@ -0,0 +1,26 @@
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from src.replay_db import Base, SchemaMismatchError, _migrate_columns
+
+
+def _columns(engine, table):
+    return {column["name"] for column in inspect(engine).get_columns(table)}
+
+
+def test_adds_nullable_columns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'replays.sqlite3'}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql('ALTER TABLE "work_chunk" DROP COLUMN "owner"')
+    _migrate_columns(engine)
+    assert "owner" in _columns(engine, "work_chunk")
+
+
+def test_rejects_missing_required_columns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'replays.sqlite3'}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql('ALTER TABLE "work_chunk" DROP COLUMN "end_id"')
+    with pytest.raises(SchemaMismatchError):
+        _migrate_columns(engine)
@@ -0,0 +1,11 @@
+from src.replay_events import ResourceTransfers, ResourceSent, NO_RECEIVER
+
+
+def test_receivers_are_stored_as_army_numbers():
+    transfers = ResourceTransfers()
+    transfers.append("a", 2.0, 10.0, 0.0, 5)
+    transfers.append("a", None, 0.0, 20.0, 15)
+    assert transfers.to_players.typecode == "q"
+    assert transfers.to_players.tolist() == [2, NO_RECEIVER]
+    assert list(transfers) == [ResourceSent("a", 2, 10.0, 0.0, 0.5), ResourceSent("a", None, 0.0, 20.0, 1.5)]
+    assert type(transfers[0].to_player) is int
@@ -0,0 +1,22 @@
+from src.replay_pack import ReplayPack, RECORD_HEADER
+
+
+def test_recovers_records_written_after_a_torn_one(tmp_path):
+    pack_path, index_path = str(tmp_path / "replays.pack"), str(tmp_path / "replays.idx")
+    pack = ReplayPack(pack_path, index_path)
+    pack.write(1, b"first")
+    pack.flush()
+    pack.write(2, b"second")
+    # A crash in the middle of writing a record leaves its header and part of its data
+    pack._pack_file.write(RECORD_HEADER.pack(3, 100) + b"torn")
+    pack._pack_file.close()
+
+    pack = ReplayPack(pack_path, index_path)
+    assert pack.ids() == [1, 2]
+    pack.write(4, b"fourth")
+    pack._pack_file.close()
+
+    pack = ReplayPack(pack_path, index_path)
+    assert pack.ids() == [1, 2, 4]
+    assert pack.get(2) == b"second"
+    assert pack.get(4) == b"fourth"
@@ -0,0 +1,95 @@
+import numpy as np
+from sqlalchemy import create_engine
+
+from src.columnar import ColumnarTables, export_columnar, load_columnar
+from src.faf_replay import ReplayMetadata, ReplayPlayerMetadata
+from src.metadata_store import MetadataStore
+from src.replay_db import Base
+from src.replay_events import ChatMessages, CompletionNotifications, ResourceTransfers, NO_RECEIVER
+from src.resource_flow import ResourceFlows, UNKNOWN_PLAYER
+
+
+def _tables(players: list[tuple], transfers: list[tuple], record_id: int = 1) -> ColumnarTables:
+    """Columnar tables of one game; players are (player ID, nickname, army), transfers (sender, receiver, mass)"""
+    nicknames = [nickname for _, nickname, _ in players]
+    return ColumnarTables(tables={
+        "replays": {"replay_id": np.array([1]), "record_id": np.array([record_id]), "has_body": np.array([True])},
+        "players": {"replay_idx": np.zeros(len(players), dtype=np.int32),
+                    "player_id": np.array([player_id for player_id, _, _ in players]),
+                    "nickname": np.arange(len(players), dtype=np.int32),
+                    "army": np.array([army for _, _, army in players], dtype=np.int16)},
+        "resource_transfer": {"replay_idx": np.zeros(len(transfers), dtype=np.int32),
+                              "from_player": np.array([nicknames.index(sender) for sender, _, _ in transfers]),
+                              "to_player": np.array([receiver for _, receiver, _ in transfers], dtype=np.int16),
+                              "mass": np.array([mass for _, _, mass in transfers], dtype=np.float32),
+                              "energy": np.zeros(len(transfers), dtype=np.float32),
+                              "sent_at_sec": np.zeros(len(transfers), dtype=np.float32)},
+    }, dictionaries={"player": nicknames})
+
+
+def test_receivers_are_resolved_by_army_number():
+    # Army 1 is an AI, which is not listed among players
+    tables = _tables([(10, "a", 2), (20, "b", 3), (30, "c", -1)],
+                     [("a", 3, 100.0), ("b", 2, 50.0), ("a", 1, 5.0), ("b", NO_RECEIVER, 1.0), ("c", 2, 7.0)])
+    flows = ResourceFlows()
+    assert flows.update(tables) == 1
+    assert flows.flows["from_player"].tolist() == [10, 20, 30]
+    assert flows.flows["to_player"].tolist() == [20, 10, 10]
+    assert flows.flows["mass"].tolist() == [100.0, 50.0, 7.0]
+    # To the AI army, and to no army
+    assert flows.unresolved == 2
+    assert UNKNOWN_PLAYER not in flows.flows["to_player"]
+
+
+def test_replays_written_again_are_replaced():
+    players = [(10, "a", 1), (20, "b", 2)]
+    flows = ResourceFlows()
+    assert flows.update(_tables(players, [("a", 2, 100.0), ("a", 3, 1.0)], record_id=1)) == 1
+    assert flows.update(_tables(players, [("a", 2, 100.0), ("a", 3, 1.0)], record_id=1)) == 0
+    assert flows.update(_tables(players, [("b", 1, 30.0)], record_id=5)) == 1
+    assert flows.replay_ids.tolist() == [1]
+    assert flows.flows["from_player"].tolist() == [20]
+    assert flows.flows["mass"].tolist() == [30.0]
+    assert flows.share_curve().mass.tolist() == [30.0]
+    assert flows.unresolved == 0
+    assert flows.last_record_id == 5
+
+
+def _metadata(replay_id: str, mass: float) -> ReplayMetadata:
+    players = [ReplayPlayerMetadata(player_id=str(i), nickname=f"player{i}", clan="", country=None, rating_mean=1000.0,
+                                    rating_std=100.0, rating=700.0, faction=1, team=2, army=i) for i in (1, 2)]
+    transfers = ResourceTransfers()
+    transfers.append("player1", 2, mass, 0.0, 10)
+    return ReplayMetadata(title="game", replay_id=replay_id, chat_messages=ChatMessages(),
+                          notifications=CompletionNotifications(), resource_transfer=transfers,
+                          launched_at_ts=int(replay_id), duration=60.0, map="map", game_type="0", desync=False,
+                          players=players)
+
+
+def test_updates_read_only_records_written_since(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'replays.sqlite3'}")
+    Base.metadata.create_all(engine)
+    store = MetadataStore(engine)
+    flows = ResourceFlows()
+
+    def update(name: str) -> int:
+        export_columnar(str(tmp_path / name), engine, since_record_id=flows.last_record_id)
+        return flows.update(load_columnar(str(tmp_path / name)))
+
+    store.write("1", _metadata("1", 100.0), 1)
+    store.write("2", _metadata("2", 50.0), 1)
+    store.flush()
+    assert update("first") == 2
+    store.write("2", _metadata("2", 20.0), 1)
+    store.flush()
+    assert len(load_columnar(str(tmp_path / "first")).tables["replays"]["replay_id"]) == 2
+    assert update("second") == 1
+    assert load_columnar(str(tmp_path / "second")).tables["replays"]["replay_id"].tolist() == [2]
+    assert update("third") == 0
+
+    flows.save(str(tmp_path / "flows.npz"))
+    loaded = ResourceFlows.load(str(tmp_path / "flows.npz"))
+    assert loaded.last_record_id == flows.last_record_id
+    assert sorted(loaded.replay_ids.tolist()) == [1, 2]
+    _, matrix = loaded.flow_matrix()
+    assert matrix.sum() == 120.0
@@ -0,0 +1,46 @@
+import threading
+
+from sqlalchemy import text
+
+from src.work_chunks import ChunkQueue, get_queue_engine
+
+
+def test_workers_on_a_shared_queue_process_every_id_once(tmp_path):
+    url = f"sqlite:///{tmp_path / 'chunks.sqlite3'}"
+    engine = get_queue_engine(url)
+    with engine.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "delete"
+    assert ChunkQueue("download", engine).plan(1, 100, chunk_size=5) == 20
+    processed, lock = [], threading.Lock()
+
+    def worker(owner: str):
+        # Every worker has its own engine, as processes on other hosts would
+        queue = ChunkQueue("download", get_queue_engine(url), owner=owner)
+
+        def process(replay_id):
+            with lock:
+                processed.append(replay_id)
+
+        queue.work(process)
+
+    threads = [threading.Thread(target=worker, args=(f"host{i}:1",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(processed) == list(range(1, 101))
+    assert ChunkQueue("download", engine).status() == {"done": 20}
+
+
+def test_expired_leases_are_taken_over_from_the_checkpoint(tmp_path):
+    engine = get_queue_engine(f"sqlite:///{tmp_path / 'chunks.sqlite3'}")
+    crashed = ChunkQueue("extract", engine, owner="crashed", lease_sec=-1)
+    crashed.plan(1, 10, chunk_size=10)
+    chunk = crashed.claim()
+    crashed.checkpoint(chunk, 4)
+
+    queue = ChunkQueue("extract", engine, owner="alive")
+    processed = []
+    assert queue.work(processed.append) == 1
+    assert processed == list(range(5, 11))
+    assert queue.claim() is None
@@ -0,0 +1,24 @@
+import argparse
+import logging
+
+from src.coplay_graph import load_coplay_graph, COPLAY_GRAPH_FILE, Relation
+from src.storage import ensure_dirs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add newly extracted replays to the co-play graph")
+    parser.add_argument("--path", type=str, help="Graph file", default=COPLAY_GRAPH_FILE)
+    parser.add_argument("--top", type=str, help="Print top partners and opponents of this player ID", default=None)
+    parser.add_argument("--k", type=int, help="Number of top players to print", default=10)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    ensure_dirs()
+    graph = load_coplay_graph(args.path)
+    added = graph.update_from_db()
+    logging.info(f"Added {added} games, graph has {len(graph.player_ids)} players")
+    if added:
+        graph.save(args.path)
+    if args.top is not None:
+        for relation in (Relation.ally, Relation.opponent):
+            logging.info(f"Top {relation} of {args.top}:")
+            for stats in graph.top(args.top, args.k, relation):
+                logging.info(f"\t{stats}")
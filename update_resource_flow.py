@@ -0,0 +1,43 @@
+import argparse
+import logging
+import tempfile
+
+from src.columnar import load_columnar, export_columnar
+from src.resource_flow import load_resource_flows, RESOURCE_FLOW_FILE, Role
+from src.storage import ensure_dirs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add new and re-extracted replays to the resource sharing flows")
+    parser.add_argument("--columnar", type=str, default=None,
+                        help="Read this columnar export (see export_columnar.py) instead of exporting the metadata "
+                             "records written since the last update")
+    parser.add_argument("--path", type=str, help="Flow cache file", default=RESOURCE_FLOW_FILE)
+    parser.add_argument("--top", type=int, help="Print this many top feeders and receivers", default=0)
+    parser.add_argument("--player", type=int, help="Print the sharing profile of this player ID", default=None)
+    parser.add_argument("--curve", action="store_true", help="Print mass and energy shared per minute", default=False)
+    args = parser.parse_args()
+    logging.basicConfig(encoding='utf-8', level=logging.INFO)
+    ensure_dirs()
+    flows = load_resource_flows(args.path)
+    last_record_id = flows.last_record_id
+    if args.columnar is not None:
+        added = flows.update(load_columnar(args.columnar))
+    else:
+        with tempfile.TemporaryDirectory() as columnar_dir:
+            export_columnar(columnar_dir, since_record_id=flows.last_record_id)
+            added = flows.update(load_columnar(columnar_dir))
+    logging.info(f"Added or replaced {added} games, {len(flows.replay_ids)} games in total, "
+                 f"{flows.unresolved} transfers with unknown sender or receiver")
+    if added or flows.last_record_id != last_record_id:
+        flows.save(args.path)
+    for role in (Role.feeder, Role.receiver) if args.top else ():
+        logging.info(f"Top {role}s:")
+        for profile in flows.top(args.top, role):
+            logging.info(f"\t{profile}")
+    if args.player is not None:
+        logging.info(f"{flows.profile(args.player)}")
+    if args.curve:
+        curve = flows.share_curve()
+        for minute, (mass, energy) in enumerate(zip(curve.mass, curve.energy)):
+            logging.info(f"\tminute {minute}: {mass / max(curve.games, 1):.1f} mass, "
+                         f"{energy / max(curve.games, 1):.1f} energy per game")